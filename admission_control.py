@@ -0,0 +1,197 @@
+import threading
+import time
+from contextlib import contextmanager
+from role_definitions import role_limits
+
+"""
+Admission control for SecureOperations
+
+Limits how much load each role and each user can put on the database, so e.g. one executive running
+a heavy report can't starve the POS traffic of the staff users. Per role and per user there is:
+
+- a token bucket (rate + burst) limiting how many queries are started per second
+- a max number of queries in flight at the same time
+
+A query that doesn't fit waits (queues) up to the role's queue_timeout and is rejected after that.
+The limits are configured in role_limits in role_definitions.py
+"""
+
+
+class AdmissionRejected(TimeoutError):
+    """
+    Raised when a query couldn't be admitted within the role's queue_timeout
+    """
+
+
+class TokenBucket:
+    """
+    Classic token bucket - holds up to burst tokens and refills with rate tokens per second
+    Not thread safe on its own, the AdmissionController's lock protects it
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """
+        Returns:
+                float: seconds until a token is available (0 if there is one now)
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Limiter:
+    """
+    Token bucket and in-flight counter for one role or one user
+    """
+
+    def __init__(self, limits, clock=time.monotonic):
+        rate = limits.get("rate")
+        self.bucket = TokenBucket(rate, limits.get("burst"), clock) if rate else None
+        self.max_in_flight = limits.get("max_in_flight")
+        self.in_flight = 0
+
+    def wait_time(self):
+        """
+        Returns:
+                float: seconds until this limiter could admit a query, 0 if it can right now,
+                       None if it has to wait for a running query to finish
+        """
+        if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+            return None
+        return self.bucket.wait_time() if self.bucket else 0.0
+
+    def acquire(self):
+        if self.bucket:
+            self.bucket.take()
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+
+
+class AdmissionController:
+    """
+    Admits (or queues/rejects) queries per role and per user according to the configured limits
+    Thread safe - one controller is shared by every SecureOperations instance in the process
+    """
+
+    def __init__(self, limits=None, clock=time.monotonic):
+        """
+        Arguments:
+                limits (dict): role -> {"role": {...}, "user": {...}, "queue_timeout": seconds}
+                               (default to role_limits from role_definitions.py)
+                clock (callable): returns the current time in seconds (replaceable in tests)
+        """
+        self.limits = role_limits if limits is None else limits
+        self.clock = clock
+        self._condition = threading.Condition()
+        self._limiters = {}
+        self._metrics = {}
+
+    def _limiters_for(self, role, username):
+        role_config = self.limits.get(role, {})
+        limiters = []
+        for key, config in ((("role", role), role_config.get("role")), (("user", username), role_config.get("user"))):
+            if config:
+                if key not in self._limiters:
+                    self._limiters[key] = _Limiter(config, self.clock)
+                limiters.append(self._limiters[key])
+        return limiters
+
+    def _role_metrics(self, role):
+        if role not in self._metrics:
+            self._metrics[role] = {
+                "admitted": 0,
+                "queued": 0,
+                "rejected": 0,
+                "wait_seconds_total": 0.0,
+                "wait_seconds_max": 0.0,
+                "in_flight": 0,
+            }
+        return self._metrics[role]
+
+    @contextmanager
+    def admit(self, role, username, timeout=None):
+        """
+        Context manager that holds a query slot for role/username while the block runs
+
+        Arguments:
+                role (string): the user's role
+                username (string): the user
+                timeout (float): max seconds to queue (default to the role's queue_timeout, 0 if not configured)
+
+        Raises:
+                AdmissionRejected: if no slot became free within the timeout
+        """
+        if timeout is None:
+            timeout = self.limits.get(role, {}).get("queue_timeout", 0.0)
+
+        start = self.clock()
+        deadline = start + timeout
+        with self._condition:
+            limiters = self._limiters_for(role, username)
+            metrics = self._role_metrics(role)
+            queued = False
+            while True:
+                waits = [limiter.wait_time() for limiter in limiters]
+                if all(wait == 0 for wait in waits):
+                    break
+
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    metrics["rejected"] += 1
+                    error_message = f"Too busy!! {role} query by {username} was not admitted within {timeout}s"
+                    print(error_message)
+                    raise AdmissionRejected(error_message)
+
+                if not queued:
+                    queued = True
+                    metrics["queued"] += 1
+                # wait for a token to be refilled, or until a running query finishes (notify) if slots are full
+                token_waits = [wait for wait in waits if wait]
+                self._condition.wait(min([remaining] + token_waits) if None not in waits else remaining)
+
+            for limiter in limiters:
+                limiter.acquire()
+            waited = self.clock() - start
+            metrics["admitted"] += 1
+            metrics["in_flight"] += 1
+            metrics["wait_seconds_total"] += waited
+            metrics["wait_seconds_max"] = max(metrics["wait_seconds_max"], waited)
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                for limiter in limiters:
+                    limiter.release()
+                metrics["in_flight"] -= 1
+                self._condition.notify_all()
+
+    def metrics(self):
+        """
+        Returns:
+                dict: role -> admitted, queued, rejected, wait_seconds_total, wait_seconds_max and in_flight counts
+        """
+        with self._condition:
+            return {role: dict(values) for role, values in self._metrics.items()}
+
+
+# the controller shared by every SecureOperations instance in this process
+admission_controller = AdmissionController()
@@ -0,0 +1,449 @@
+import argparse
+import ast
+import contextlib
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, date, timedelta
+import db_logger
+import secure_db
+from store_summaries import rebuild_summaries
+from user_auth import load_user_credentials
+
+"""
+Audit log replay - load generator for capacity planning and regression testing
+
+database_access.log records every query each user issued. This tool:
+
+1. parses the log back into SecureOperations calls (select, aggregate, insert, update, delete - exports are
+   replayed as a streamed select of the same rows, without writing the files)
+2. replays them through SecureOperations - so authentication, permission checks, row restrictions,
+   admission control and timeouts are all part of the measurement - against a local stand-in
+   database (seed it with synthetic BikeCorpDB data with --seed)
+3. keeps the original timing between queries (optionally sped up) and the original concurrency:
+   every user gets their own session/thread, replaying their own queries in order
+4. reports throughput and latency percentiles, overall and per action
+
+Records that can't be replayed (joins, key lookups, syncs, upserts, chunked statements with key
+parameters, users without credentials...) are counted as skipped, per action, and listed in the report -
+that part of the original load is missing from the measurement. The replayed queries are audited like any others, but into
+their own log (replay_access.log, see --audit-log) - never into the log being replayed.
+
+Usage:
+        python audit_replay.py --config replay_db_config.json --seed --speedup 10
+        python audit_replay.py --config replay_db_config.json --max-speed --read-only --audit-log /tmp/replay.log
+"""
+
+LOG_LINE_PATTERN = re.compile(
+    r"^(?P<timestamp>\S+ \S+) - \S+ - \w+ - USER: (?P<user>.*?) \| ROLE: (?P<role>.*?) \| "
+    r"ACTION: (?P<action>\w+) \| TABLE: (?P<table>.*?)(?:  \| QUERY: (?P<query>.*))?$"
+)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+
+HINT_PATTERN = re.compile(r"/\*\+.*?\*/\s*")
+SELECT_PATTERN = re.compile(r"^SELECT (?P<columns>.+?) FROM (?P<table>\w+)(?: WHERE (?P<where>.*?))?(?: LIMIT (?P<limit>\d+))?$")
+AGGREGATE_PATTERN = re.compile(
+    r"^SELECT (?P<parts>.+?) FROM (?:\(SELECT [\w, *]+ FROM \w+(?: WHERE .*?)?\) AS )?(?P<table>\w+)(?: WHERE (?P<where>.*?))?(?: GROUP BY (?P<group_by>[\w, ]+?))?"
+    r"(?: ORDER BY [\w, ]+?)?(?: LIMIT (?P<limit>\d+))?$"
+)
+METRIC_PATTERN = re.compile(r"^(?P<function>\w+)\((?P<column>[\w*]+)\) AS (?P<alias>\w+)$", re.IGNORECASE)
+INSERT_PATTERN = re.compile(r"^INSERT INTO (?P<table>\w+) \((?P<columns>[^)]*)\) VALUES \([^)]*\) - (?P<values>\[.*\])$")
+UPDATE_PATTERN = re.compile(r"^UPDATE (?P<table>\w+) SET (?P<set>.+?) WHERE (?P<where>.*) - (?P<values>\[.*\])$")
+DELETE_PATTERN = re.compile(r"^DELETE FROM (?P<table>\w+) WHERE (?P<where>.*?)$")
+EXPORT_SUFFIX_PATTERN = re.compile(r" - \d+ rows to \d+ file\(s\) \(\w+\)$")
+
+WRITE_ACTIONS = ("INSERT", "UPDATE", "DELETE")
+
+
+class ReplayEvent:
+    """
+    One replayable audit record: who ran which SecureOperations method with which arguments, and when
+    """
+
+    def __init__(self, timestamp, username, role, action, table, method, arguments, where=None):
+        self.timestamp = timestamp
+        self.username = username
+        self.role = role
+        self.action = action
+        self.table = table
+        self.method = method
+        self.arguments = arguments
+        # the logged WHERE clause still includes the role's row restriction - it is stripped at replay
+        # time (when the user's session knows its restriction), since SecureOperations adds it again
+        self.where = where
+
+    def call(self, ops):
+        arguments = dict(self.arguments)
+        if self.where is not None:
+            arguments["condition"] = strip_row_restriction(self.where, ops.get_row_restriction(self.table))
+        result = getattr(ops, self.method)(self.table, **arguments)
+        if self.method == "select_stream":
+            # a replayed export reads every row, like the export did
+            for _ in result:
+                pass
+        return result
+
+
+def strip_row_restriction(where, restriction):
+    """
+    Removes the row restriction SecureOperations appended to a logged WHERE clause
+
+    Returns:
+            string: the caller's own condition, or None if the clause was only the restriction
+    """
+    if not where:
+        return None
+    if restriction:
+        if where in (f"({restriction})", restriction):
+            return None
+        for suffix in (f" AND ({restriction})", f" AND {restriction}"):
+            if where.endswith(suffix):
+                return where[:-len(suffix)]
+    return where
+
+
+def parse_record(match):
+    """
+    Turns one parsed log line into a ReplayEvent
+
+    Returns:
+            ReplayEvent, or None if the record can't be replayed
+    """
+    action = match["action"]
+    query = HINT_PATTERN.sub("", match["query"] or "")
+    timestamp = datetime.strptime(match["timestamp"], TIMESTAMP_FORMAT)
+    event = lambda table, method, arguments, where=None: ReplayEvent(
+        timestamp, match["user"], match["role"], action, table, method, arguments, where)
+
+    if action == "SELECT":
+        # selects answered by an identical running query (single flight) are replayed like any other
+        parsed = SELECT_PATTERN.match(query.removesuffix(" - shared result"))
+        if not parsed:
+            return None
+        columns = None if parsed["columns"] == "*" else parsed["columns"].split(", ")
+        limit = int(parsed["limit"]) if parsed["limit"] else None
+        return event(parsed["table"], "select", {"columns": columns, "limit": limit}, parsed["where"] or "")
+
+    if action == "EXPORT":
+        parsed = SELECT_PATTERN.match(EXPORT_SUFFIX_PATTERN.sub("", query))
+        if not parsed:
+            return None
+        columns = None if parsed["columns"] == "*" else parsed["columns"].split(", ")
+        return event(parsed["table"], "select_stream", {"columns": columns}, parsed["where"] or "")
+
+    if action == "AGGREGATE":
+        parsed = AGGREGATE_PATTERN.match(query)
+        if not parsed:
+            return None
+        metrics = {}
+        for part in parsed["parts"].split(", "):
+            metric = METRIC_PATTERN.match(part)
+            if metric:
+                metrics[metric["alias"]] = (metric["function"], metric["column"])
+        group_by = parsed["group_by"].split(", ") if parsed["group_by"] else None
+        limit = int(parsed["limit"]) if parsed["limit"] else None
+        return event(parsed["table"], "aggregate", {"group_by": group_by, "metrics": metrics, "limit": limit},
+                     parsed["where"] or "")
+
+    if action == "INSERT":
+        parsed = INSERT_PATTERN.match(query)
+        if not parsed:
+            return None
+        values = _literal(parsed["values"])
+        columns = parsed["columns"].split(", ")
+        if values is None or len(values) != len(columns):
+            return None
+        return event(parsed["table"], "insert", {"data": dict(zip(columns, values))})
+
+    if action == "UPDATE":
+        parsed = UPDATE_PATTERN.match(query)
+        # chunked updates have key parameters in the WHERE clause - those can't be told apart from the data
+        if not parsed or "%s" in parsed["where"]:
+            return None
+        values = _literal(parsed["values"])
+        columns = [part.split(" = ")[0] for part in parsed["set"].split(", ")]
+        if values is None or len(values) != len(columns):
+            return None
+        return event(parsed["table"], "update", {"data": dict(zip(columns, values))}, parsed["where"])
+
+    if action == "DELETE":
+        parsed = DELETE_PATTERN.match(query)
+        if not parsed or "%s" in parsed["where"]:
+            return None
+        return event(parsed["table"], "delete", {}, parsed["where"])
+
+    return None
+
+
+def _literal(text):
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return None
+
+
+def parse_audit_log(path="database_access.log", include_writes=True):
+    """
+    Parses an audit log into replayable events
+
+    Arguments:
+            path (string): the audit log file
+            include_writes (bool): also replay INSERT/UPDATE/DELETE
+
+    Returns:
+            tuple: (list of ReplayEvents in time order, dict of skipped records per action)
+    """
+    events = []
+    skipped = {}
+    with open(path) as f:
+        for line in f:
+            match = LOG_LINE_PATTERN.match(line.rstrip("\n"))
+            if not match:
+                continue
+            if not include_writes and match["action"] in WRITE_ACTIONS:
+                skipped[match["action"]] = skipped.get(match["action"], 0) + 1
+                continue
+            event = parse_record(match)
+            if event is None:
+                skipped[match["action"]] = skipped.get(match["action"], 0) + 1
+            else:
+                events.append(event)
+    events.sort(key=lambda event: event.timestamp)
+    return events, skipped
+
+
+def replay(events, speedup=1.0):
+    """
+    Replays events through SecureOperations, one session (thread) per user
+
+    Arguments:
+            events (list): ReplayEvents in time order
+            speedup (float): replay speed factor (2 = twice as fast), or None for as fast as possible
+
+    Returns:
+            tuple: (list of result dicts with action, latency, lag and error - one per replayed event,
+                    wall clock seconds, dict of events skipped per action because the user has no credentials)
+    """
+    from secure_operations import SecureOperations
+
+    credentials = load_user_credentials()
+    by_user = {}
+    skipped = {}
+    for event in events:
+        if event.username in credentials:
+            by_user.setdefault(event.username, []).append(event)
+        else:
+            skipped[event.action] = skipped.get(event.action, 0) + 1
+
+    results = []
+    results_lock = threading.Lock()
+    first_timestamp = events[0].timestamp if events else None
+    start = time.perf_counter() + 0.1  # give every thread the time to log in before the first query
+
+    def run_session(username, user_events):
+        try:
+            ops = SecureOperations(username, credentials[username]["password"])
+        except Exception as e:
+            with results_lock:
+                results.extend({"action": event.action, "error": type(e).__name__} for event in user_events)
+            return
+        try:
+            for event in user_events:
+                due = start
+                if speedup:
+                    due += (event.timestamp - first_timestamp).total_seconds() / speedup
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+                began = time.perf_counter()
+                error = None
+                try:
+                    event.call(ops)
+                except Exception as e:
+                    error = type(e).__name__
+                with results_lock:
+                    results.append({
+                        "action": event.action,
+                        "latency": time.perf_counter() - began,
+                        "lag": max(0.0, began - due),  # how far behind schedule the replay was
+                        "error": error,
+                    })
+        finally:
+            ops.close()
+
+    threads = [threading.Thread(target=run_session, args=item) for item in by_user.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start, skipped
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a list of numbers (p between 0 and 100)
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(p / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def report(results, wall_time, skipped=None):
+    """
+    Prints throughput and latency percentiles (in milliseconds), overall and per action, and the records
+    that were not replayed (skipped: dict of counts per action)
+    """
+    skipped = skipped or {}
+    print(f"\nReplayed {len(results)} queries in {wall_time:.2f}s ({len(results) / max(wall_time, 1e-9):.1f} queries/s), "
+          f"skipped {sum(skipped.values())}")
+    print(f"  {'action':<12}{'count':>7}{'errors':>8}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}{'max lag':>10}")
+    groups = {"ALL": results}
+    for result in results:
+        groups.setdefault(result["action"], []).append(result)
+    for action, group in groups.items():
+        latencies = [r["latency"] * 1000 for r in group if "latency" in r]
+        errors = sum(1 for r in group if r["error"])
+        max_lag = max((r.get("lag", 0.0) for r in group), default=0.0) * 1000
+        print(f"  {action:<12}{len(group):>7}{errors:>8}"
+              + "".join(f"{percentile(latencies, p):>9.1f}" for p in (50, 90, 95, 99, 100))
+              + f"{max_lag:>10.1f}")
+
+    error_types = {}
+    for result in results:
+        if result["error"]:
+            error_types[result["error"]] = error_types.get(result["error"], 0) + 1
+    if error_types:
+        print(f"  errors: {error_types}")
+    if skipped:
+        # the load these records stand for is missing from the numbers above
+        print("  not replayed: " + ", ".join(f"{action} {count}" for action, count in sorted(skipped.items())))
+
+
+# SYNTHETIC STAND-IN DATABASE
+
+STAND_IN_SCHEMA = [
+    """CREATE TABLE brands (brand_id INT AUTO_INCREMENT PRIMARY KEY, brand_name VARCHAR(255) NOT NULL)""",
+    """CREATE TABLE categories (category_id INT AUTO_INCREMENT PRIMARY KEY, category_name VARCHAR(255) NOT NULL)""",
+    """CREATE TABLE customers (customer_id INT AUTO_INCREMENT PRIMARY KEY, first_name VARCHAR(255) NOT NULL,
+        last_name VARCHAR(255) NOT NULL, phone VARCHAR(25), email VARCHAR(255) NOT NULL, street VARCHAR(255),
+        city VARCHAR(50), state VARCHAR(25), zip_code VARCHAR(5))""",
+    """CREATE TABLE stores (store_id INT AUTO_INCREMENT PRIMARY KEY, store_name VARCHAR(255) NOT NULL, phone VARCHAR(25),
+        email VARCHAR(255), street VARCHAR(255), city VARCHAR(255), state VARCHAR(10), zip_code VARCHAR(5))""",
+    """CREATE TABLE staffs (staff_id INT AUTO_INCREMENT PRIMARY KEY, first_name VARCHAR(50) NOT NULL, last_name VARCHAR(50) NOT NULL,
+        email VARCHAR(255) NOT NULL, phone VARCHAR(25), active TINYINT NOT NULL, store_id INT NOT NULL, manager_id INT)""",
+    """CREATE TABLE products (product_id INT AUTO_INCREMENT PRIMARY KEY, product_name VARCHAR(255) NOT NULL, brand_id INT NOT NULL,
+        category_id INT NOT NULL, model_year SMALLINT NOT NULL, list_price DECIMAL(10, 2) NOT NULL)""",
+    """CREATE TABLE orders (order_id INT AUTO_INCREMENT PRIMARY KEY, customer_id INT, order_status TINYINT NOT NULL,
+        order_date DATE NOT NULL, required_date DATE NOT NULL, shipped_date DATE, store_id INT NOT NULL, staff_id INT NOT NULL)""",
+    """CREATE TABLE order_items (order_id INT, item_id INT, product_id INT NOT NULL, quantity INT NOT NULL,
+        list_price DECIMAL(10, 2) NOT NULL, discount DECIMAL(4, 2) NOT NULL DEFAULT 0, PRIMARY KEY (order_id, item_id))""",
+    """CREATE TABLE stocks (store_id INT, product_id INT, quantity INT, PRIMARY KEY (store_id, product_id))""",
+    # select_changes() reads change_log - the triggers filling it are in change_tracking.sql
+    """CREATE TABLE change_log (change_seq BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY, table_name VARCHAR(64) NOT NULL,
+        operation CHAR(1) NOT NULL, order_id INT NULL, product_id INT NULL, store_id INT NULL, customer_id INT NULL,
+        changed_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), INDEX idx_change_log_table_seq (table_name, change_seq))""",
+    # the store summaries (see store_summaries.sql) - filled from the seeded rows
+    """CREATE TABLE store_daily_sales (store_id INT NOT NULL, sales_date DATE NOT NULL, orders INT NOT NULL, items INT NOT NULL,
+        revenue DECIMAL(12, 2) NOT NULL, PRIMARY KEY (store_id, sales_date))""",
+    """CREATE TABLE store_low_stock (store_id INT NOT NULL PRIMARY KEY, products INT NOT NULL, low_stock_products INT NOT NULL,
+        out_of_stock_products INT NOT NULL)""",
+]
+STAND_IN_TABLES = ["brands", "categories", "customers", "stores", "staffs", "products", "orders", "order_items", "stocks"]
+# tables without seeded rows of their own
+STAND_IN_DERIVED_TABLES = ["change_log", "store_daily_sales", "store_low_stock"]
+
+
+def seed_synthetic_data(scale=1.0, seed=42):
+    """
+    (Re)creates the BikeCorpDB tables in the configured database and fills them with synthetic data
+    roughly shaped like the real thing (3 stores, ~1500 customers, ~1600 orders per scale unit)
+
+    Only ever run this against a stand-in database - it drops the tables first!
+    """
+    rng = random.Random(seed)
+    connection = secure_db.open_connection()
+    cursor = connection.cursor()
+    try:
+        for table in reversed(STAND_IN_TABLES + STAND_IN_DERIVED_TABLES):
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        for statement in STAND_IN_SCHEMA:
+            cursor.execute(statement)
+
+        n_customers = int(1500 * scale)
+        n_products = 321
+        n_orders = int(1600 * scale)
+        rows = {
+            "brands": [(i, f"Brand {i}") for i in range(1, 10)],
+            "categories": [(i, f"Category {i}") for i in range(1, 8)],
+            "stores": [(i, f"Store {i}", "555-0100", f"store{i}@bikecorp.example", f"{i} Main St", "Springfield", "NY", "10001")
+                       for i in range(1, 4)],
+            "staffs": [(i, f"Staff{i}", "Synthetic", f"staff{i}@bikecorp.example", "555-0101", 1, (i - 1) % 3 + 1, None)
+                       for i in range(1, 11)],
+            "customers": [(i, f"First{i}", f"Last{i}", None, f"customer{i}@example.com", f"{i} Side St", "Springfield", "NY", "10001")
+                          for i in range(1, n_customers + 1)],
+            "products": [(i, f"Bike model {i}", rng.randint(1, 9), rng.randint(1, 7), rng.choice([2016, 2017, 2018, 2019]),
+                          round(rng.uniform(90, 12000), 2)) for i in range(1, n_products + 1)],
+            "stocks": [(store, product, rng.randint(0, 30)) for store in range(1, 4) for product in range(1, n_products + 1)],
+            "orders": [],
+            "order_items": [],
+        }
+        first_day = date(2016, 1, 1)
+        for order_id in range(1, n_orders + 1):
+            order_date = first_day + timedelta(days=rng.randint(0, 1000))
+            store_id = rng.randint(1, 3)
+            rows["orders"].append((order_id, rng.randint(1, n_customers), rng.randint(1, 4), order_date,
+                                   order_date + timedelta(days=2), None, store_id, rng.choice([s for s in range(1, 11) if (s - 1) % 3 + 1 == store_id])))
+            for item_id in range(1, rng.randint(1, 5) + 1):
+                rows["order_items"].append((order_id, item_id, rng.randint(1, n_products), rng.randint(1, 2),
+                                            round(rng.uniform(90, 12000), 2), rng.choice([0.05, 0.07, 0.1, 0.2])))
+
+        for table in STAND_IN_TABLES:
+            placeholders = ", ".join(["%s"] * len(rows[table][0]))
+            cursor.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows[table])
+        connection.commit()
+        summaries = rebuild_summaries(connection)
+        print("Seeded stand-in database: " + ", ".join(f"{table}={len(rows[table])}" for table in STAND_IN_TABLES)
+              + ", " + ", ".join(f"{table}={count}" for table, count in summaries.items()))
+    finally:
+        cursor.close()
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay database_access.log through SecureOperations")
+    parser.add_argument("--log", default="database_access.log", help="the audit log to replay")
+    parser.add_argument("--config", default="replay_db_config.json", help="connection settings of the stand-in database")
+    parser.add_argument("--seed", action="store_true", help="(re)create the stand-in tables with synthetic data first")
+    parser.add_argument("--scale", type=float, default=1.0, help="size of the synthetic data set")
+    parser.add_argument("--speedup", type=float, default=1.0, help="replay speed factor (10 = ten times faster)")
+    parser.add_argument("--max-speed", action="store_true", help="ignore the original timing and replay as fast as possible")
+    parser.add_argument("--read-only", action="store_true", help="skip INSERT/UPDATE/DELETE")
+    parser.add_argument("--verbose", action="store_true", help="show the output of every replayed query")
+    parser.add_argument("--audit-log", default="replay_access.log", help="where the replayed queries are audited")
+    args = parser.parse_args()
+
+    # the replay is audited into its own log - replaying into the log being read would feed on itself
+    if os.path.abspath(args.audit_log) == os.path.abspath(args.log):
+        parser.error("--audit-log must not be the log being replayed")
+    db_logger.AUDIT_LOG_FILE = args.audit_log
+
+    # everything below talks to the stand-in database only
+    secure_db.DB_CONFIG_FILE = args.config
+    if args.seed:
+        seed_synthetic_data(args.scale)
+
+    events, skipped = parse_audit_log(args.log, include_writes=not args.read_only)
+    print(f"Parsed {len(events)} replayable queries from {args.log} ({sum(skipped.values())} records skipped)")
+
+    with contextlib.ExitStack() as output:
+        if not args.verbose:
+            output.enter_context(contextlib.redirect_stdout(output.enter_context(open(os.devnull, "w"))))
+        results, wall_time, no_credentials = replay(events, None if args.max_speed else args.speedup)
+    for action, count in no_credentials.items():
+        skipped[action] = skipped.get(action, 0) + count
+    report(results, wall_time, skipped)
@@ -0,0 +1,130 @@
+import compileall
+import os
+import subprocess
+import sys
+
+"""
+Benchmark: cold start - how long importing secure_operations takes in a fresh interpreter
+
+Runs python -X importtime -c "import <module>" a few times in new processes and reports the best total
+import time plus the slowest imports below it. Also checks what importing leaves behind: the database
+driver shouldn't be imported (it's only needed on the first connect) and the logging setup of the
+importing program (the root logger) shouldn't be touched.
+
+The same import is then timed against an eager baseline that first does what the modules did at import
+time before the driver and the logging setup were made lazy: import mysql.connector, the thread pool,
+temp file and cProfile modules, and configure the root logger.
+
+The modules are byte-compiled first, so compiling the sources isn't counted (like an installed deployment).
+
+Usage:
+        python bench_import.py [module] [repeats]
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SIDE_EFFECTS_CHECK = """
+import sys
+import {module}
+driver = "mysql.connector" in sys.modules
+import logging
+print(driver, len(logging.getLogger().handlers))
+"""
+
+# what importing the package used to cost up front - the baseline for the lazy imports
+EAGER_IMPORTS = """
+import logging
+import mysql.connector
+import concurrent.futures
+import tempfile
+import cProfile
+logging.basicConfig(handlers=[logging.FileHandler(os.devnull)], level=logging.INFO,
+                    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+"""
+
+WALL_TIME_CHECK = """
+import os
+import time
+start = time.perf_counter()
+{prelude}
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def import_times(module):
+    """
+    Imports the module in a new interpreter with -X importtime
+
+    Returns:
+            dict: module name -> (own microseconds, cumulative microseconds) for the module and everything
+                  imported because of it (not the interpreter's own startup imports)
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=HERE, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package - nested imports are indented and come first
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(own), int(cumulative))
+        if not name.startswith("  "):
+            # a top level import is done - keep only the tree of the module itself
+            if name.strip() == module:
+                return times
+            times = {}
+    return times
+
+
+def side_effects(module):
+    """
+    Returns:
+            tuple: (database driver imported, root logger handlers) after importing the module
+    """
+    result = subprocess.run([sys.executable, "-c", SIDE_EFFECTS_CHECK.format(module=module)],
+                            cwd=HERE, capture_output=True, text=True, check=True)
+    driver, handlers = result.stdout.split()
+    return driver == "True", int(handlers)
+
+
+def wall_time(module, prelude=""):
+    """
+    Returns:
+            float: seconds the prelude plus importing the module take in a new interpreter
+    """
+    result = subprocess.run([sys.executable, "-c", WALL_TIME_CHECK.format(prelude=prelude, module=module)],
+                            cwd=HERE, capture_output=True, text=True, check=True)
+    return float(result.stdout)
+
+
+def run(module="secure_operations", repeats=5, top=10):
+    compileall.compile_dir(HERE, maxlevels=0, quiet=1)
+
+    best = None
+    for _ in range(repeats):
+        times = import_times(module)
+        if best is None or times[module][1] < best[module][1]:
+            best = times
+
+    print(f"\nimport {module}: {best[module][1] / 1000:.1f} ms (best of {repeats})")
+    print(f"  {'slowest imports below it':<40}{'own (ms)':>10}{'total (ms)':>12}")
+    slowest = sorted((item for item in best.items() if item[0] != module), key=lambda item: item[1][1], reverse=True)
+    for name, (own, cumulative) in slowest[:top]:
+        print(f"  {name:<40}{own / 1000:>10.1f}{cumulative / 1000:>12.1f}")
+
+    driver, handlers = side_effects(module)
+    print(f"  database driver imported: {driver}")
+    print(f"  root logger handlers added: {handlers}")
+
+    lazy = min(wall_time(module) for _ in range(repeats))
+    eager = min(wall_time(module, EAGER_IMPORTS) for _ in range(repeats))
+    print(f"\nwall time, best of {repeats}:")
+    print(f"  import {module}: {lazy * 1000:.1f} ms")
+    print(f"  eager baseline (driver + logging setup first): {eager * 1000:.1f} ms ({eager / lazy:.1f}x)")
+
+
+if __name__ == "__main__":
+    module = sys.argv[1] if len(sys.argv) > 1 else "secure_operations"
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    run(module, repeats)
@@ -0,0 +1,106 @@
+import argparse
+import contextlib
+import io
+import json
+import time
+import secure_db
+from secure_operations import SecureOperations
+from admission_control import AdmissionController
+
+"""
+Benchmark: a customer's orders with line items and product names
+
+- N+1 pattern: one select on orders, then one select on order_items per order, then one select on products per item
+- select_join: one query joining orders, order_items and products
+
+Runs against the database in db_config.json (or --config), as the given user (default customer1).
+Admission control is switched off for the benchmark user - the rate limits would otherwise throttle
+the N+1 pattern and measure the limits instead of the round trips. The report starts with the server
+it ran against, since the gap depends mostly on the round trip time.
+
+For numbers others can reproduce, run it against the synthetic stand-in database of audit_replay.py:
+
+        python -c "import secure_db, audit_replay; secure_db.DB_CONFIG_FILE = 'replay_db_config.json'; audit_replay.seed_synthetic_data()"
+        python bench_join.py --config replay_db_config.json
+
+Usage:
+        python bench_join.py [username] [password] [repeats] [--config db_config.json]
+"""
+
+
+def orders_n_plus_one(ops):
+    """
+    The per-row lookup pattern select_join replaces. Returns (rows, number of queries)
+    """
+    queries = 1
+    rows = []
+    for order in ops.select("orders", columns=["order_id", "order_date"]):
+        items = ops.select("order_items", columns=["item_id", "product_id", "quantity", "list_price"],
+                           condition=f"order_id = {int(order['order_id'])}")
+        queries += 1
+        for item in items:
+            product = ops.select("products", columns=["product_name"],
+                                 condition=f"product_id = {int(item['product_id'])}")
+            queries += 1
+            rows.append({**order, **item, "product_name": product[0]["product_name"] if product else None})
+    return rows, queries
+
+
+def orders_join(ops):
+    """
+    The same data in one round trip. Returns (rows, number of queries)
+    """
+    rows = ops.select_join(["orders", "order_items", "products"], columns={
+        "orders": ["order_id", "order_date"],
+        "order_items": ["item_id", "product_id", "quantity", "list_price"],
+        "products": ["product_name"],
+    })
+    return rows, 1
+
+
+def describe_database():
+    """
+    Returns a one line description of the database the benchmark runs against (server version, host, database)
+    """
+    with open(secure_db.DB_CONFIG_FILE) as f:
+        config = json.load(f)
+    connection = secure_db.open_connection()
+    try:
+        version = connection.get_server_info()
+    finally:
+        connection.close()
+    return f"MySQL {version} at {config['host']}, database {config['database']} ({secure_db.DB_CONFIG_FILE})"
+
+
+def run(username="customer1", password="customer1_pass", repeats=5):
+    print(f"\nDatabase: {describe_database()}")
+    ops = SecureOperations(username, password)
+    ops.admission = AdmissionController({})
+    # nobody wants to read thousands of "query executed" lines - silence the prints while timing
+    print(f"\n{username}: orders + order_items + products, best of {repeats}")
+    print(f"  {'pattern':<14}{'queries':>10}{'rows':>8}{'time (s)':>12}")
+    results = {}
+    for name, pattern in (("N+1 selects", orders_n_plus_one), ("select_join", orders_join)):
+        best = None
+        for _ in range(repeats):
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                rows, queries = pattern(ops)
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+        print(f"  {name:<14}{queries:>10}{len(rows):>8}{best:>12.4f}")
+    print(f"  select_join is {results['N+1 selects'] / results['select_join']:.1f}x faster")
+    ops.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark select_join against the N+1 select pattern")
+    parser.add_argument("username", nargs="?", default="customer1")
+    parser.add_argument("password", nargs="?", default="customer1_pass")
+    parser.add_argument("repeats", nargs="?", type=int, default=5)
+    parser.add_argument("--config", default=secure_db.DB_CONFIG_FILE, help="connection settings of the database to run against")
+    args = parser.parse_args()
+
+    secure_db.DB_CONFIG_FILE = args.config
+    run(args.username, args.password, args.repeats)
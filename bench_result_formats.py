@@ -0,0 +1,124 @@
+import random
+import time
+import tracemalloc
+from decimal import Decimal
+from operator import attrgetter, itemgetter
+from result_budget import fetch_within_budget
+
+"""
+Benchmark of the select() result formats (dicts, Row objects, columns) on synthetic order_items / stocks shaped data
+
+Doesn't need a database - a small fake cursor hands out the same row tuples the MySQL driver would,
+and the "dicts" mode builds one dict per row the same way the dictionary cursor does. The results are
+built by fetch_within_budget(), the same code select() uses (without a memory budget).
+
+For every format it reports:
+- construction time (fetching + building the result)
+- access time (reading one column from every row by name, e.g. summing quantity - 
+  row["quantity"] for dicts, row.quantity for Row objects)
+- retained memory of the finished result (tracemalloc)
+- peak memory while building it
+
+Usage:
+        python bench_result_formats.py [rows]
+"""
+
+
+class FakeCursor:
+    """
+    Minimal stand-in for a MySQL cursor that returns pre-generated rows
+    """
+
+    def __init__(self, columns, rows, dictionary=False):
+        self.description = [(col,) for col in columns]
+        self.column_names = tuple(columns)
+        self.rows = rows
+        self.position = 0
+        self.dictionary = dictionary
+
+    def _convert(self, batch):
+        if self.dictionary:
+            names = self.column_names
+            return [dict(zip(names, row)) for row in batch]
+        return batch
+
+    def fetchmany(self, size=1):
+        batch = self.rows[self.position:self.position + size]
+        self.position += len(batch)
+        return self._convert(batch)
+
+    def fetchall(self):
+        batch = self.rows[self.position:]
+        self.position = len(self.rows)
+        return self._convert(batch)
+
+
+def make_order_items(n):
+    # order_id, item_id, product_id, quantity, list_price, discount
+    return ["order_id", "item_id", "product_id", "quantity", "list_price", "discount"], [
+        (i // 3 + 1, i % 3 + 1, random.randint(1, 321), random.randint(1, 2),
+         Decimal(f"{random.randint(100, 12000)}.99"), Decimal(random.choice(["0.05", "0.07", "0.10", "0.20"])))
+        for i in range(n)
+    ]
+
+
+def make_stocks(n):
+    # store_id, product_id, quantity, plus a string column to show the list fallback
+    return ["store_id", "product_id", "quantity", "product_name"], [
+        (i % 3 + 1, i // 3 + 1, random.randint(0, 30), f"Bike model {i // 3 + 1}")
+        for i in range(n)
+    ]
+
+
+def access(result, result_format, column):
+    """
+    Reads one column from every row by name - the typical "loop over the result" pattern
+    """
+    if result_format == "columns":
+        return sum(result[column])
+    if result_format == "rows":
+        return sum(map(attrgetter(column), result))
+    return sum(map(itemgetter(column), result))
+
+
+def measure(columns, rows, result_format):
+    """
+    Returns (build seconds, access seconds, retained bytes, peak bytes) for one result in the given format
+    """
+    cursor = FakeCursor(columns, rows, dictionary=(result_format == "dicts"))
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fetch_within_budget(cursor, result_format)
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    start = time.perf_counter()
+    access(result, result_format, "quantity")
+    access_elapsed = time.perf_counter() - start
+    del result
+    return elapsed, access_elapsed, retained, peak
+
+
+def run(n_rows=200000, formats=("dicts", "rows", "columns")):
+    random.seed(42)
+    for name, generator in (("order_items", make_order_items), ("stocks", make_stocks)):
+        columns, rows = generator(n_rows)
+        print(f"\n{name}: {n_rows} rows x {len(columns)} columns")
+        print(f"  {'format':<10}{'build (s)':>12}{'access (s)':>12}{'retained (MB)':>16}{'peak (MB)':>12}")
+        baseline = None
+        for result_format in formats:
+            # untimed warm up run, so imports (numpy) don't count against the first format
+            measure(columns, rows[:100], result_format)
+            elapsed, access_elapsed, retained, peak = measure(columns, rows, result_format)
+            if baseline is None:
+                baseline = (elapsed, retained)
+            # a slower build is shown as "slower", not as "0.8x faster"
+            speed = f"{baseline[0] / elapsed:.1f}x faster" if elapsed <= baseline[0] else f"{elapsed / baseline[0]:.1f}x slower"
+            print(f"  {result_format:<10}{elapsed:>12.3f}{access_elapsed:>12.3f}{retained / 1e6:>16.1f}{peak / 1e6:>12.1f}"
+                  f"   ({speed}, {baseline[1] / max(retained, 1):.1f}x smaller than {formats[0]})")
+
+
+if __name__ == "__main__":
+    import sys
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
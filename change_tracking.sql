@@ -0,0 +1,88 @@
+-- Change tracking for incremental sync (SecureOperations.select_changes)
+--
+-- Every insert/update/delete on the tracked tables (see change_tracking in db_schema.py) is recorded
+-- in change_log with an increasing sequence number. Clients keep the last sequence number they've
+-- seen (the watermark) and only ask for what changed after it.
+--
+-- Besides the key of the changed row, change_log keeps store_id/customer_id so the role's row
+-- restrictions (e.g. "store_id = 1") can be applied to deletions too.
+--
+-- Run once as an administrator:  mysql BikeCorpDB < change_tracking.sql
+
+CREATE TABLE IF NOT EXISTS change_log (
+    change_seq BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    table_name VARCHAR(64) NOT NULL,
+    operation CHAR(1) NOT NULL,               -- I = insert, U = update, D = delete
+    order_id INT NULL,
+    product_id INT NULL,
+    store_id INT NULL,
+    customer_id INT NULL,
+    changed_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    INDEX idx_change_log_table_seq (table_name, change_seq)
+);
+
+DELIMITER //
+
+-- PRODUCTS
+
+CREATE TRIGGER products_change_insert AFTER INSERT ON products FOR EACH ROW
+BEGIN
+    INSERT INTO change_log (table_name, operation, product_id) VALUES ('products', 'I', NEW.product_id);
+END//
+
+CREATE TRIGGER products_change_update AFTER UPDATE ON products FOR EACH ROW
+BEGIN
+    IF NOT (OLD.product_id <=> NEW.product_id) THEN
+        INSERT INTO change_log (table_name, operation, product_id) VALUES ('products', 'D', OLD.product_id);
+    END IF;
+    INSERT INTO change_log (table_name, operation, product_id) VALUES ('products', 'U', NEW.product_id);
+END//
+
+CREATE TRIGGER products_change_delete AFTER DELETE ON products FOR EACH ROW
+BEGIN
+    INSERT INTO change_log (table_name, operation, product_id) VALUES ('products', 'D', OLD.product_id);
+END//
+
+-- STOCKS
+
+CREATE TRIGGER stocks_change_insert AFTER INSERT ON stocks FOR EACH ROW
+BEGIN
+    INSERT INTO change_log (table_name, operation, store_id, product_id) VALUES ('stocks', 'I', NEW.store_id, NEW.product_id);
+END//
+
+CREATE TRIGGER stocks_change_update AFTER UPDATE ON stocks FOR EACH ROW
+BEGIN
+    -- a changed key means the old row is gone from the point of view of the client
+    IF NOT (OLD.store_id <=> NEW.store_id AND OLD.product_id <=> NEW.product_id) THEN
+        INSERT INTO change_log (table_name, operation, store_id, product_id) VALUES ('stocks', 'D', OLD.store_id, OLD.product_id);
+    END IF;
+    INSERT INTO change_log (table_name, operation, store_id, product_id) VALUES ('stocks', 'U', NEW.store_id, NEW.product_id);
+END//
+
+CREATE TRIGGER stocks_change_delete AFTER DELETE ON stocks FOR EACH ROW
+BEGIN
+    INSERT INTO change_log (table_name, operation, store_id, product_id) VALUES ('stocks', 'D', OLD.store_id, OLD.product_id);
+END//
+
+-- ORDERS
+
+CREATE TRIGGER orders_change_insert AFTER INSERT ON orders FOR EACH ROW
+BEGIN
+    INSERT INTO change_log (table_name, operation, order_id, store_id, customer_id) VALUES ('orders', 'I', NEW.order_id, NEW.store_id, NEW.customer_id);
+END//
+
+CREATE TRIGGER orders_change_update AFTER UPDATE ON orders FOR EACH ROW
+BEGIN
+    -- an order moved to another store/customer disappears for the old store's/customer's terminals
+    IF NOT (OLD.order_id <=> NEW.order_id AND OLD.store_id <=> NEW.store_id AND OLD.customer_id <=> NEW.customer_id) THEN
+        INSERT INTO change_log (table_name, operation, order_id, store_id, customer_id) VALUES ('orders', 'D', OLD.order_id, OLD.store_id, OLD.customer_id);
+    END IF;
+    INSERT INTO change_log (table_name, operation, order_id, store_id, customer_id) VALUES ('orders', 'U', NEW.order_id, NEW.store_id, NEW.customer_id);
+END//
+
+CREATE TRIGGER orders_change_delete AFTER DELETE ON orders FOR EACH ROW
+BEGIN
+    INSERT INTO change_log (table_name, operation, order_id, store_id, customer_id) VALUES ('orders', 'D', OLD.order_id, OLD.store_id, OLD.customer_id);
+END//
+
+DELIMITER ;
@@ -0,0 +1,101 @@
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+A small thread safe pool of database connections
+
+Connections are opened lazily up to size, handed out with the connection() context manager and put
+back afterwards (with their transaction rolled back). When all of them are in use, callers wait for one
+to be returned or discarded (up to a timeout).
+A connection that was in use when an error happened is closed instead of reused, so a broken
+connection never goes back into the pool.
+"""
+
+
+class ConnectionPool:
+
+    def __init__(self, factory, size=8):
+        """
+        Arguments:
+                factory (callable): opens a new connection
+                size (int): max number of open connections
+        """
+        self.factory = factory
+        self.size = size
+        self._idle = []  # used as a stack - most recently used first, those are the least likely to have timed out
+        self._created = 0
+        # notified whenever a connection is returned or discarded (which makes room for a new one)
+        self._available = threading.Condition()
+
+    def _take(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._available:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._created < self.size:
+                    self._created += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No database connection became free within {timeout}s (pool size {self.size})")
+                self._available.wait(remaining)
+
+        try:
+            return self.factory()
+        except Exception:
+            with self._available:
+                self._created -= 1
+                self._available.notify()
+            raise
+
+    def _discard(self, connection):
+        with self._available:
+            self._created -= 1
+            self._available.notify()
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _return(self, connection):
+        # mysql.connector has autocommit off - without ending the borrower's transaction the next borrower
+        # would keep reading its REPEATABLE READ snapshot (and see stale rows)
+        try:
+            connection.rollback()
+        except Exception:
+            self._discard(connection)
+            return
+        with self._available:
+            self._idle.append(connection)
+            self._available.notify()
+
+    @contextmanager
+    def connection(self, timeout=30.0):
+        """
+        Context manager that lends a connection from the pool
+        Anything not committed when the block ends is rolled back before the connection is lent again
+
+        Arguments:
+                timeout (float): max seconds to wait for a free connection
+
+        Raises:
+                TimeoutError: if no connection became free in time
+        """
+        connection = self._take(timeout)
+        try:
+            yield connection
+        except BaseException:
+            self._discard(connection)
+            raise
+        self._return(connection)
+
+    def close(self):
+        """
+        Closes the idle connections - connections lent out at the moment go back into the pool as usual
+        """
+        with self._available:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._discard(connection)
@@ -0,0 +1,117 @@
+import csv
+import gzip
+import json
+import os
+
+"""
+File writers for SecureOperations.export()
+
+Rows are written batch by batch as they are streamed from the database, so memory use stays
+the same no matter how big the export is. Supports:
+
+- CSV (with a header row in every file) or JSONL (one JSON object per line)
+- splitting the output into several files of at most rows_per_file rows each
+- gzip compression
+"""
+
+EXPORT_FORMATS = ("csv", "jsonl")
+
+
+class ChunkedFileWriter:
+    """
+    Writes batches of rows to one or more (optionally gzipped) CSV/JSONL files
+
+    With rows_per_file set, "orders.csv" becomes orders.part0001.csv, orders.part0002.csv ...
+    With compress=True ".gz" is added to the file names
+    """
+
+    def __init__(self, path, file_format="csv", rows_per_file=None, compress=False):
+        """
+        Arguments:
+                path (string): the output file (the base name when the output is split)
+                file_format (string): "csv" or "jsonl"
+                rows_per_file (int): max rows per file (default to None meaning everything in one file)
+                compress (bool): gzip the output files
+
+        Raises:
+                ValueError: if the format is unknown or rows_per_file isn't positive
+        """
+        if file_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {file_format!r} - must be one of {EXPORT_FORMATS}")
+        if rows_per_file is not None and rows_per_file < 1:
+            raise ValueError("rows_per_file must be at least 1")
+
+        self.path = path
+        self.file_format = file_format
+        self.rows_per_file = rows_per_file
+        self.compress = compress
+
+        self.files = []          # paths of every file written so far
+        self.rows_written = 0
+        self._file = None
+        self._rows_in_file = 0
+        self._csv_writer = None
+
+    def _next_path(self):
+        path = self.path
+        if self.rows_per_file:
+            base, ext = os.path.splitext(path)
+            path = f"{base}.part{len(self.files) + 1:04d}{ext}"
+        if self.compress and not path.endswith(".gz"):
+            path += ".gz"
+        return path
+
+    def _open_next(self, columns):
+        self._close_current()
+        path = self._next_path()
+        if self.compress:
+            self._file = gzip.open(path, "wt", newline="", encoding="utf-8")
+        else:
+            self._file = open(path, "w", newline="", encoding="utf-8")
+        self.files.append(path)
+        self._rows_in_file = 0
+        if self.file_format == "csv":
+            self._csv_writer = csv.writer(self._file)
+            self._csv_writer.writerow(columns)
+
+    def _close_current(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def write_batch(self, columns, rows):
+        """
+        Writes one batch of rows (tuples in the order of columns)
+        """
+        position = 0
+        while position < len(rows):
+            if self._file is None or (self.rows_per_file and self._rows_in_file >= self.rows_per_file):
+                self._open_next(columns)
+
+            # only as many rows as still fit into the current file
+            room = self.rows_per_file - self._rows_in_file if self.rows_per_file else len(rows)
+            chunk = rows[position:position + room]
+            if self.file_format == "csv":
+                self._csv_writer.writerows(chunk)
+            else:
+                # default=str takes care of Decimals and dates
+                self._file.writelines(json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in chunk)
+
+            position += len(chunk)
+            self._rows_in_file += len(chunk)
+            self.rows_written += len(chunk)
+
+    def close(self, columns=None):
+        """
+        Closes the current file. An export without any rows still gets one (header only) file
+        """
+        if not self.files and columns is not None:
+            self._open_next(columns)
+        self._close_current()
+        return self.files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._close_current()
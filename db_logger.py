@@ -1,14 +1,38 @@
-import logging
-from datetime import datetime
+import threading
+from tracing import tracer
 
 # Sets up a basic logging system...
 
-# first configure the logging per the logging module:
-logging.basicConfig(
-    filename="database_access.log", # the log will be written to this file
-    level=logging.INFO,  # logs information as well as higher level issues
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s" # the log format
-)
+# the audit log gets its own named logger with its own file handler, set up on the first log call -
+# so importing this module doesn't configure the root logger (or anything else) of the program importing it
+AUDIT_LOG_FILE = "database_access.log"
+AUDIT_LOGGER_NAME = "database_access"
+AUDIT_LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s" # the log format
+
+_audit_logger = None
+_setup_lock = threading.Lock()
+
+def get_audit_logger():
+    """
+    Returns the audit logger, configuring it the first time
+    
+    Returns:
+            logging.Logger: writes INFO and higher level messages to AUDIT_LOG_FILE
+    """
+    global _audit_logger
+    if _audit_logger is None:
+        with _setup_lock:
+            if _audit_logger is None:
+                # logging itself is imported lazily too, it's only needed once something is logged
+                import logging
+                logger = logging.getLogger(AUDIT_LOGGER_NAME)
+                logger.setLevel(logging.INFO) # logs information as well as higher level issues
+                logger.propagate = False # audit records only go to the audit log, not to the program's own handlers
+                handler = logging.FileHandler(AUDIT_LOG_FILE, delay=True) # the file is opened on the first record
+                handler.setFormatter(logging.Formatter(AUDIT_LOG_FORMAT))
+                logger.addHandler(handler)
+                _audit_logger = logger
+    return _audit_logger
 
 def log_database_access(username, role, action, table, query=None):
     """
@@ -31,9 +55,10 @@ def log_database_access(username, role, action, table, query=None):
         log_message += f"  | QUERY: {query}"
         
     # the actual writing of the message:
-    logging.info(log_message)
+    with tracer.span("audit", action=action):
+        get_audit_logger().info(log_message)
     
 # Testing the logging function
 if __name__ == "__main__":
     log_database_access("test_user", "admin", "SELECT", "customers", "SELECT * FROM customers LIMIT 5")
-    print("Log entry created. Check database_access.log")
\ No newline at end of file
+    print("Log entry created. Check database_access.log")
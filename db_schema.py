@@ -0,0 +1,77 @@
+# describes the parts of the BikeCorpDB schema the secure operations need to know about
+
+# primary key columns of each table
+primary_keys = {
+    "brands": ["brand_id"],
+    "categories": ["category_id"],
+    "customers": ["customer_id"],
+    "orders": ["order_id"],
+    "order_items": ["order_id", "item_id"],
+    "products": ["product_id"],
+    "staffs": ["staff_id"],
+    "stocks": ["store_id", "product_id"],
+    "stores": ["store_id"],
+    "store_daily_sales": ["store_id", "sales_date"],
+    "store_low_stock": ["store_id"]
+}
+
+# all columns of each table (a role's allowed columns are a subset of these) - used to tell which names in a
+# caller's condition are columns, and for the columns behind "*" in select_join()
+table_columns = {
+    "brands": ["brand_id", "brand_name"],
+    "categories": ["category_id", "category_name"],
+    "customers": ["customer_id", "first_name", "last_name", "phone", "email", "street", "city", "state", "zip_code"],
+    "orders": ["order_id", "customer_id", "order_status", "order_date", "required_date", "shipped_date", "store_id", "staff_id"],
+    "order_items": ["order_id", "item_id", "product_id", "quantity", "list_price", "discount"],
+    "products": ["product_id", "product_name", "brand_id", "category_id", "model_year", "list_price"],
+    "staffs": ["staff_id", "first_name", "last_name", "email", "phone", "active", "store_id", "manager_id"],
+    "stocks": ["store_id", "product_id", "quantity"],
+    "stores": ["store_id", "store_name", "phone", "email", "street", "city", "state", "zip_code"],
+    "store_daily_sales": ["store_id", "sales_date", "orders", "items", "revenue"],
+    "store_low_stock": ["store_id", "products", "low_stock_products", "out_of_stock_products"]
+}
+
+# tables that support incremental "changed since" reads through SecureOperations.select_changes()
+#
+#   "mode": "sequence" - changes are recorded in the change_log table by the triggers in change_tracking.sql
+#                        (this also tracks deletions)
+#   "mode": "column"   - changes are found through a last-updated column of the table itself, given as "column"
+#                        (deletions can't be seen this way)
+change_tracking = {
+    "products": {"mode": "sequence"},
+    "stocks": {"mode": "sequence"},
+    "orders": {"mode": "sequence"}
+}
+
+# the table the change_tracking.sql triggers write to, and the columns it keeps of each changed row
+# (the key columns of the tracked tables plus the columns used by the row restrictions)
+CHANGE_LOG_TABLE = "change_log"
+CHANGE_LOG_COLUMNS = ["order_id", "product_id", "store_id", "customer_id"]
+
+# foreign key relationships used by SecureOperations.select_join() to join tables
+# (table, related table) -> list of (column in table, column in related table)
+relationships = {
+    ("orders", "customers"): [("customer_id", "customer_id")],
+    ("orders", "stores"): [("store_id", "store_id")],
+    ("orders", "staffs"): [("staff_id", "staff_id")],
+    ("order_items", "orders"): [("order_id", "order_id")],
+    ("order_items", "products"): [("product_id", "product_id")],
+    ("products", "brands"): [("brand_id", "brand_id")],
+    ("products", "categories"): [("category_id", "category_id")],
+    ("stocks", "products"): [("product_id", "product_id")],
+    ("stocks", "stores"): [("store_id", "store_id")],
+    ("staffs", "stores"): [("store_id", "store_id")],
+    ("store_daily_sales", "stores"): [("store_id", "store_id")],
+    ("store_low_stock", "stores"): [("store_id", "store_id")]
+}
+
+
+def join_columns(table, other):
+    """
+    Returns the (column in table, column in other) pairs to join two tables on, or None if they aren't related
+    """
+    if (table, other) in relationships:
+        return relationships[(table, other)]
+    if (other, table) in relationships:
+        return [(b, a) for a, b in relationships[(other, table)]]
+    return None
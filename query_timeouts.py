@@ -0,0 +1,149 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from db_logger import log_database_access
+
+"""
+Statement timeouts for SecureOperations
+
+Every role gets a default statement_timeout (role_limits in role_definitions.py), which can be
+overridden per call. It is enforced in two ways:
+
+- server side: SELECTs get a MAX_EXECUTION_TIME optimizer hint, so MySQL stops them itself
+- client side: a watchdog thread cancels the query (KILL QUERY) when it runs past the limit.
+  This covers INSERT/UPDATE/DELETE, which MySQL can't time out, and servers that ignore the hint
+  (for SELECTs with the hint the watchdog only fires after an extra grace period)
+
+Timed out queries raise QueryTimeout and are written to the audit log with their elapsed time
+"""
+
+# MySQL error numbers for "maximum statement execution time exceeded" and "query execution was interrupted"
+ER_QUERY_TIMEOUT = 3024
+ER_QUERY_INTERRUPTED = 1317
+
+# extra seconds the watchdog gives a SELECT that the server should already have stopped itself
+WATCHDOG_GRACE = 1.0
+
+_SELECT_PATTERN = re.compile(r"^\s*SELECT\s", re.IGNORECASE)
+
+
+class QueryTimeout(TimeoutError):
+    """
+    Raised when a query ran past its statement timeout and was stopped
+    """
+
+
+class QueryCancelled(RuntimeError):
+    """
+    Raised in the thread running a query that was cancelled with cancel()
+    """
+
+
+class Watchdog:
+    """
+    Calls on_timeout (from a timer thread) if it isn't stopped within timeout seconds
+    """
+
+    def __init__(self, timeout, on_timeout):
+        self.fired = False
+        self._on_timeout = on_timeout
+        self._timer = threading.Timer(timeout, self._fire)
+        self._timer.daemon = True
+
+    def _fire(self):
+        self.fired = True
+        try:
+            self._on_timeout()
+        except Exception as e:
+            print(f"Watchdog could not cancel the query: {e}")
+
+    def start(self):
+        self._timer.start()
+        return self
+
+    def stop(self):
+        self._timer.cancel()
+
+
+class RunningStatement:
+    """
+    One query running under time_limit(), with its own cancel state - so statements running in parallel
+    for one SecureOperations instance (e.g. the chunks of select_by_keys) don't share a flag, and a
+    watchdog firing late can't cancel the next statement on the connection
+    """
+
+    def __init__(self, operations, connection=None):
+        self.operations = operations
+        self.connection = connection  # None means the user's own connection (looked up when needed)
+        self.cancelled = False
+        self.finished = False
+        # held while a kill is sent - the statement can't finish (and the next one start) in between
+        self.lock = threading.Lock()
+
+    def target(self):
+        """
+        Returns the connection the statement runs on (None if it isn't connected yet)
+        """
+        return self.connection or self.operations.connection
+
+
+def add_server_timeout(query, timeout):
+    """
+    Adds a MAX_EXECUTION_TIME hint (milliseconds) to a SELECT query so the server enforces the timeout
+    Other statements are returned unchanged
+
+    Arguments:
+            query (string): the query
+            timeout (float): seconds, or None for no timeout
+    """
+    if not timeout or not _SELECT_PATTERN.match(query):
+        return query
+    return _SELECT_PATTERN.sub(f"SELECT /*+ MAX_EXECUTION_TIME({int(timeout * 1000)}) */ ", query, count=1)
+
+
+@contextmanager
+def time_limit(operations, action, table, query, timeout, connection=None):
+    """
+    Context manager that enforces the statement timeout on the query run inside the block
+
+    Arguments:
+            operations: the SecureOperations instance running the query (used for cancel() and the audit log)
+            action (string): SELECT, UPDATE ... for the audit record
+            table (string): the table queried
+            query (string): the query (for the audit record)
+            timeout (float): seconds, or None for no timeout
+            connection: the connection the query runs on (default to None meaning the user's own connection)
+
+    Raises:
+            QueryTimeout: if the query was stopped because of the timeout
+            QueryCancelled: if the query was cancelled with cancel() from another thread
+    """
+    statement = RunningStatement(operations, connection)
+    operations.running_statements.add(statement)
+    watchdog = None
+    if timeout:
+        grace = WATCHDOG_GRACE if _SELECT_PATTERN.match(query) else 0.0
+        watchdog = Watchdog(timeout + grace, lambda: operations.cancel(statement=statement)).start()
+
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        elapsed = time.monotonic() - start
+        errno = getattr(e, "errno", None)
+        if (watchdog and watchdog.fired) or errno == ER_QUERY_TIMEOUT:
+            log_database_access(operations.username, operations.role, "TIMEOUT", table,
+                                f"{query} - {action} stopped after {elapsed:.3f}s (timeout {timeout}s)")
+            raise QueryTimeout(f"{action} on {table} exceeded the {timeout}s timeout ({elapsed:.3f}s)") from e
+        if statement.cancelled and errno == ER_QUERY_INTERRUPTED:
+            log_database_access(operations.username, operations.role, "CANCELLED", table,
+                                f"{query} - {action} cancelled after {elapsed:.3f}s")
+            raise QueryCancelled(f"{action} on {table} was cancelled after {elapsed:.3f}s") from e
+        raise
+    finally:
+        if watchdog:
+            watchdog.stop()
+        with statement.lock:
+            statement.finished = True
+        operations.running_statements.discard(statement)
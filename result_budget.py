@@ -0,0 +1,265 @@
+import pickle
+import sys
+import threading
+from result_formats import row_class, build_columnar, DEFAULT_BATCH_SIZE, DEFAULT_COMPACT_ROWS_THRESHOLD
+
+"""
+Memory budgets for query results
+
+select() used to load every result completely into memory, so one broad query could take a worker down.
+Now every role has a result_memory_budget (role_limits in role_definitions.py, can be overridden per call).
+Results are fetched in batches and their size is estimated while fetching. Past the budget, depending on
+over_budget, the result is either:
+
+- "reject": refused with ResultTooLarge (a MemoryError) - nothing more is kept in memory
+- "spill": moved to a temporary file and returned as a SpilledResult, which reads the rows back lazily
+           while iterating over it (columnar results can't be spilled and are always rejected - select()
+           refuses result_format="columns" with over_budget="spill" up front)
+
+A columnar result is charged for its column arrays plus the batch being added, which is what it keeps in
+memory - not for every tuple batch fetched on the way
+
+Sizes are estimates (sys.getsizeof of a sample of the rows of every batch, including their values) - close
+enough to protect a worker, not an exact measurement. Totals are kept in result_memory.metrics()
+"""
+
+OVER_BUDGET_ACTIONS = ("reject", "spill")
+
+# rows per batch that are measured to estimate the size of the whole batch
+SIZE_SAMPLE_ROWS = 16
+
+
+class ResultTooLarge(MemoryError):
+    """
+    Raised when a query result is bigger than the memory budget and can't be spilled to disk
+    """
+
+
+def estimate_size(rows):
+    """
+    Estimates the memory (bytes) a batch of result rows (tuples or dicts) takes, from a sample of the rows
+    """
+    if not rows:
+        return 0
+    step = max(1, len(rows) // SIZE_SAMPLE_ROWS)
+    sample = rows[::step]
+    sample_bytes = 0
+    for row in sample:
+        values = row.values() if isinstance(row, dict) else row
+        sample_bytes += sys.getsizeof(row) + sum(map(sys.getsizeof, values))
+    # plus one list slot per row
+    return int(sample_bytes / len(sample) * len(rows)) + 8 * len(rows)
+
+
+class _SpillFile:
+    """
+    The temporary file behind one or more SpilledResult views - rows are stored as pickled batches
+    """
+
+    def __init__(self):
+        # tempfile is slow to import and only needed once something is spilled
+        import tempfile
+        self.file = tempfile.TemporaryFile()
+        self.offsets = []
+        self.lock = threading.Lock()
+
+    def write(self, rows):
+        with self.lock:
+            self.file.seek(0, 2)
+            self.offsets.append(self.file.tell())
+            pickle.dump(rows, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read(self, index):
+        with self.lock:
+            self.file.seek(self.offsets[index])
+            return pickle.load(self.file)
+
+    def size(self):
+        with self.lock:
+            self.file.seek(0, 2)
+            return self.file.tell()
+
+
+class SpilledResult:
+    """
+    A query result that went over its memory budget and was moved to a temporary file
+
+    Iterate over it (as often as needed) to get the rows - one batch at a time is read back into memory.
+    The rows are dicts or Row objects like the in-memory formats. The file is deleted with close() or when
+    the result is garbage collected
+
+    Attributes:
+            columns (list): the column names in query order
+            bytes_on_disk (int): size of the temporary file
+    """
+
+    def __init__(self, columns, make_row=None, spill_file=None, rows=0):
+        self.columns = list(columns)
+        self._make_row = make_row
+        self._spill = spill_file or _SpillFile()
+        self._rows = rows
+
+    def _write(self, rows):
+        if rows:
+            self._spill.write(rows)
+            self._rows += len(rows)
+
+    def __len__(self):
+        return self._rows
+
+    def __iter__(self):
+        spill = self._spill
+        if spill is None:
+            raise ValueError("The spilled result was closed")
+        for index in range(len(spill.offsets)):
+            batch = spill.read(index)
+            yield from (map(self._make_row, batch) if self._make_row else batch)
+
+    def __repr__(self):
+        return f"SpilledResult({self._rows} rows, {self.bytes_on_disk} bytes on disk)"
+
+    @property
+    def bytes_on_disk(self):
+        return self._spill.size() if self._spill else 0
+
+    def copy(self):
+        """
+        Another view of the same (read-only) rows - the file stays until every view is closed
+        """
+        return SpilledResult(self.columns, self._make_row, self._spill, self._rows)
+
+    def close(self):
+        # the temporary file closes (and disappears) once no view uses it anymore
+        self._spill = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class ResultMemoryMetrics:
+    """
+    Thread safe byte accounting of the results fetched through fetch_within_budget()
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {"results": 0, "bytes_fetched": 0, "largest_result_bytes": 0,
+                         "rejected": 0, "spilled": 0, "bytes_spilled": 0}
+
+    def record(self, size, rejected=False, spilled_bytes=None):
+        with self._lock:
+            metrics = self._metrics
+            metrics["results"] += 1
+            metrics["bytes_fetched"] += size
+            metrics["largest_result_bytes"] = max(metrics["largest_result_bytes"], size)
+            if rejected:
+                metrics["rejected"] += 1
+            if spilled_bytes is not None:
+                metrics["spilled"] += 1
+                metrics["bytes_spilled"] += spilled_bytes
+
+    def metrics(self):
+        """
+        Returns:
+                dict: results fetched, estimated bytes fetched in total and of the largest result,
+                      results rejected and spilled, and bytes written to spill files
+        """
+        with self._lock:
+            return dict(self._metrics)
+
+
+def _drain(cursor, batch_size):
+    # the rest of a refused result still has to be read off the connection before it can be used again
+    # (it is thrown away batch by batch, and the statement timeout still applies)
+    while cursor.fetchmany(batch_size):
+        pass
+
+
+def fetch_within_budget(cursor, result_format="dicts", budget=None, over_budget="reject",
+                        compact_threshold=DEFAULT_COMPACT_ROWS_THRESHOLD, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Fetches all rows from an executed cursor in the requested format, while keeping the result within
+    a memory budget
+
+    Arguments:
+            cursor: the executed cursor (a dictionary cursor for "dicts", a plain one for everything else)
+            result_format (string): one of RESULT_FORMATS
+            budget (int): max estimated bytes the result may take in memory (None or 0 for no limit)
+            over_budget (string): "reject" or "spill" (see OVER_BUDGET_ACTIONS)
+            compact_threshold (int): for "auto" - results with more rows than this are returned as Row objects
+            batch_size (int): rows fetched per round
+
+    Returns:
+            the result in result_format, or a SpilledResult if it went over the budget and over_budget is "spill"
+
+    Raises:
+            ResultTooLarge: if the result went over the budget and over_budget is "reject" (or the format is "columns")
+    """
+    if over_budget not in OVER_BUDGET_ACTIONS:
+        raise ValueError(f"Unknown over_budget action: {over_budget!r} - must be one of {OVER_BUDGET_ACTIONS}")
+
+    if result_format == "columns":
+        # charged for what stays in memory - the column arrays so far plus the batch being added, not every
+        # batch fetched (the builder lets go of each batch once its values are copied into the arrays)
+        size = 0
+
+        def charge(held, rows):
+            nonlocal size
+            size = held + estimate_size(rows)
+            if budget and size > budget:
+                raise ResultTooLarge(f"Columnar result is over the memory budget of {budget} bytes "
+                                     "(columnar results can't be spilled)")
+
+        try:
+            results = build_columnar(cursor, batch_size, on_batch=charge)
+        except ResultTooLarge:
+            result_memory.record(size, rejected=True)
+            _drain(cursor, batch_size)
+            raise
+        result_memory.record(results.nbytes)
+        return results
+
+    columns = [d[0] for d in cursor.description]
+    make_row = row_class(columns)._make if result_format in ("rows", "auto") else None
+    rows = []
+    spilled = None
+    size = 0
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        size += estimate_size(batch)
+        if spilled is None and budget and size > budget:
+            if over_budget == "reject":
+                result_memory.record(size, rejected=True)
+                _drain(cursor, batch_size)
+                raise ResultTooLarge(f"Result is over the memory budget of {budget} bytes "
+                                     f"(more than {len(rows) + len(batch)} rows)")
+            # everything so far goes to disk, and from now on every batch goes straight after it
+            spilled = SpilledResult(columns, make_row)
+            spilled._write(rows)
+            rows = None
+        if spilled is not None:
+            spilled._write(batch)
+        else:
+            rows.extend(batch)
+
+    if spilled is not None:
+        result_memory.record(size, spilled_bytes=spilled.bytes_on_disk)
+        return spilled
+
+    result_memory.record(size)
+    if result_format == "rows" or (result_format == "auto" and len(rows) > compact_threshold):
+        return list(map(make_row, rows))
+    if result_format == "auto":
+        # small result - the familiar dicts are cheap enough
+        return [dict(zip(columns, row)) for row in rows]
+    return rows
+
+
+# byte accounting of all results fetched in this process
+result_memory = ResultMemoryMetrics()
@@ -0,0 +1,329 @@
+import copy
+import keyword
+import sys
+from array import array
+from decimal import Decimal
+from functools import lru_cache
+
+"""
+Result formats for SELECT queries
+
+By default select() returns a list of dicts (one dict per row). That's easy to work with, but every
+row repeats every column name, which gets slow and memory hungry for big result sets. Alternatives:
+
+- "rows": compact Row objects - plain tuples that share one schema per result set, 
+  and support both row["column"] and row.column access
+- "columns": for analytics pulls (order_items, stocks...) one array per column built straight 
+  from the cursor batches. Numeric columns become NumPy arrays (int64/float64) when NumPy is installed, 
+  else array.array. Everything else (strings, dates...) stays a plain list
+- "auto": Row objects for results bigger than a threshold, dicts for the small ones
+
+NumPy is optional - it's only imported the first time a columnar result is built
+"""
+
+# formats select() knows how to return
+RESULT_FORMATS = ("dicts", "rows", "columns", "auto")
+
+# results with more rows than this come back as Row objects in "auto" mode
+DEFAULT_COMPACT_ROWS_THRESHOLD = 10000
+
+# rows fetched from the cursor per batch when building column arrays
+DEFAULT_BATCH_SIZE = 5000
+
+# column kinds from narrowest to widest
+_KIND_ORDER = {"int": 0, "float": 1, "object": 2}
+_INT_TYPES = {int}
+_FLOAT_TYPES = {int, float, Decimal, type(None)}
+
+
+def _column_bytes(values):
+    """
+    Estimated bytes one chunk of column values takes - exact for arrays, from a sample of the values for lists
+    """
+    if hasattr(values, "nbytes"):
+        return int(values.nbytes)
+    if isinstance(values, array):
+        return values.itemsize * len(values)
+    if not values:
+        return sys.getsizeof(values)
+    sample = values[::max(1, len(values) // 16)]
+    return sys.getsizeof(values) + int(sum(map(sys.getsizeof, sample)) / len(sample) * len(values))
+
+
+def _load_numpy():
+    """
+    Returns the numpy module if it is installed, else None (we then fall back to array.array)
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class _ColumnBuilder:
+    """
+    Collects the values of one column batch by batch
+
+    Starts out as the narrowest type that fits the first values ("int" -> "float" -> "object")
+    and widens itself if a later batch doesn't fit, e.g. a NULL in an int column turns it into float (NaN)
+    """
+
+    def __init__(self, numpy):
+        self.numpy = numpy
+        self.kind = None
+        self.chunks = []
+        self.nbytes = 0
+
+    def add(self, values):
+        kind = self._kind_of(values)
+        if self.kind is None:
+            self.kind = kind
+        elif _KIND_ORDER[kind] > _KIND_ORDER[self.kind]:
+            self._widen(kind)
+        chunk = self._convert(values)
+        self.chunks.append(chunk)
+        self.nbytes += _column_bytes(chunk)
+
+    def _kind_of(self, values):
+        types = set(map(type, values))
+        if types <= _INT_TYPES:
+            return "int"
+        if types <= _FLOAT_TYPES:
+            return "float"  # NULL is stored as NaN in numeric columns
+        return "object"
+
+    def _convert(self, values):
+        if self.kind == "object":
+            return list(values)
+        if self.kind == "float":
+            if self.numpy:
+                # numpy turns None into NaN and converts Decimals itself
+                return self.numpy.array(values, dtype="float64")
+            return array("d", [float("nan") if v is None else float(v) for v in values])
+        return self.numpy.array(values, dtype="int64") if self.numpy else array("q", values)
+
+    def _widen(self, kind):
+        # convert what was collected so far to the wider type
+        old = [v for chunk in self.chunks for v in (chunk.tolist() if hasattr(chunk, "tolist") else chunk)]
+        if self.kind == "float" and kind == "object":
+            # NaN only stood for NULL in the numeric column - an object column keeps None
+            old = [None if v != v else v for v in old]
+        self.kind = kind
+        self.chunks = [self._convert(old)] if old else []
+        self.nbytes = sum(map(_column_bytes, self.chunks))
+
+    def build(self):
+        if self.kind == "object" or self.kind is None:
+            return [v for chunk in self.chunks for v in chunk]
+        if self.numpy:
+            if not self.chunks:
+                return self.numpy.empty(0, dtype="int64" if self.kind == "int" else "float64")
+            return self.numpy.concatenate(self.chunks)
+        result = array("q" if self.kind == "int" else "d")
+        for chunk in self.chunks:
+            result.extend(chunk)
+        return result
+
+    def dtype(self):
+        if self.kind == "int":
+            return "int64"
+        if self.kind == "float":
+            return "float64"
+        return "object"
+
+
+class Row(tuple):
+    """
+    Lightweight read-only result row
+
+    A plain tuple underneath - the column names live once on the class made by row_class(), 
+    so a row costs no more memory than a tuple. Supports:
+
+    - row["column"] and row[0] 
+    - row.column for columns that are valid Python names. A column that clashes with a method (count, index,
+      keys, get...) or a keyword is renamed with a trailing underscore: row.count_ (row["count"] still works)
+    - keys(), values(), items(), get() and as_dict() like a dict
+    - pickling (rows pickle as their column names and values, so they can go to other processes)
+
+    Note: iterating a row (or len/in) works on the values like a tuple, not on the keys like a dict
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    # tuple.__new__ takes an iterable, so this makes a Row straight from a driver tuple
+    _make = classmethod(tuple.__new__)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return tuple.__getitem__(self, self._index[key])
+            except KeyError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    def __reduce__(self):
+        return _unpickle_row, (self._fields, tuple(self))
+
+    def __repr__(self):
+        return "Row(" + ", ".join(f"{k}={v!r}" for k, v in zip(self._fields, self)) + ")"
+
+    def keys(self):
+        return self._fields
+
+    def values(self):
+        return tuple(self)
+
+    def items(self):
+        return tuple(zip(self._fields, self))
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def as_dict(self):
+        return dict(zip(self._fields, self))
+
+
+def row_class(columns):
+    """
+    Makes the Row subclass (= the shared schema) for one result set - result sets with the same
+    columns share the class
+
+    Arguments:
+            columns (list): the column names in query order
+    """
+    return _row_class(tuple(columns))
+
+
+@lru_cache(maxsize=256)
+def _row_class(columns):
+    namespace = {
+        "__slots__": (), 
+        "_fields": columns, 
+        "_index": {col: i for i, col in enumerate(columns)},
+    }
+    # like namedtuple, every column with a plain name gets a property for row.column access
+    # (a property per column instead of __getattr__ keeps attribute access as fast as a dict lookup)
+    for i, col in enumerate(columns):
+        if not col.isidentifier():
+            continue
+        name = col
+        if hasattr(Row, name) or keyword.iskeyword(name):
+            name += "_"
+        if name not in namespace and not hasattr(Row, name):
+            namespace[name] = property(lambda row, i=i: tuple.__getitem__(row, i))
+    return type("Row", (Row,), namespace)
+
+
+def _unpickle_row(columns, values):
+    return row_class(columns)._make(values)
+
+
+def build_rows(cursor, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Builds a list of Row objects from an executed (non-dictionary) cursor
+
+    Returns:
+            list: Row objects sharing one schema
+    """
+    make_row = row_class(d[0] for d in cursor.description)._make
+    results = []
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        results.extend(map(make_row, rows))
+    return results
+
+
+class ColumnarResult:
+    """
+    Column-oriented query result
+
+    Attributes:
+            columns (list): the column names in query order
+            data (dict): column name -> array (numeric) or list (everything else)
+            schema (dict): column name -> "int64", "float64" or "object"
+            nbytes (int): estimated bytes the column arrays take
+    """
+
+    def __init__(self, columns, data, schema, nbytes=None):
+        self.columns = columns
+        self.data = data
+        self.schema = schema
+        self.nbytes = nbytes
+
+    def __len__(self):
+        return len(self.data[self.columns[0]]) if self.columns else 0
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    def __repr__(self):
+        return f"ColumnarResult({len(self)} rows, schema={self.schema})"
+
+    def to_dicts(self):
+        """
+        Converts back to the default list of dicts format (handy for printing/small results)
+        """
+        values = [self.data[col].tolist() if hasattr(self.data[col], "tolist") else self.data[col] for col in self.columns]
+        return [dict(zip(self.columns, row)) for row in zip(*values)]
+
+
+def build_columnar(cursor, batch_size=DEFAULT_BATCH_SIZE, on_batch=None):
+    """
+    Builds a ColumnarResult from an executed (non-dictionary) cursor, fetching batch_size rows at a time
+
+    Arguments:
+            cursor: a cursor that has executed a query and returns rows as tuples
+            batch_size (int): number of rows to fetch per round
+            on_batch (callable): called as on_batch(held, rows) before every fetched batch is added - held is the
+                                 estimated bytes of the column arrays so far. It may raise to stop the build
+                                 (result_budget.py keeps the result within a memory budget with it)
+
+    Returns:
+            ColumnarResult
+    """
+    columns = [d[0] for d in cursor.description]
+    numpy = _load_numpy()
+    builders = [_ColumnBuilder(numpy) for _ in columns]
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        if on_batch:
+            on_batch(sum(builder.nbytes for builder in builders), rows)
+        # transpose the batch into one tuple of values per column
+        for builder, values in zip(builders, zip(*rows)):
+            builder.add(values)
+
+    data = {col: builder.build() for col, builder in zip(columns, builders)}
+    schema = {col: builder.dtype() for col, builder in zip(columns, builders)}
+    return ColumnarResult(columns, data, schema, sum(builder.nbytes for builder in builders))
+
+
+def copy_result(results):
+    """
+    Returns a copy of a result that can be changed without affecting the original
+    (used when several callers share one query result). Row objects are immutable and are shared as they are
+    """
+    if isinstance(results, ColumnarResult):
+        data = {col: copy.copy(values) for col, values in results.data.items()}
+        return ColumnarResult(list(results.columns), data, dict(results.schema), results.nbytes)
+    if isinstance(results, list):
+        return [dict(row) if isinstance(row, dict) else row for row in results]
+    # other result types (e.g. a SpilledResult) know how to copy themselves
+    return results.copy()
+
+
+def check_result_format(result_format):
+    """
+    Raises:
+            ValueError: if result_format isn't one of RESULT_FORMATS
+    """
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"Unknown result format: {result_format!r} - must be one of {RESULT_FORMATS}")
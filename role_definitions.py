@@ -14,7 +14,10 @@ role_permissions = {
             "products": ["SELECT", "INSERT", "UPDATE", "DELETE"],
             "staffs": ["SELECT", "INSERT", "UPDATE", "DELETE"],
             "stocks": ["SELECT", "INSERT", "UPDATE", "DELETE"],
-            "stores": ["SELECT", "INSERT", "UPDATE", "DELETE"]
+            "stores": ["SELECT", "INSERT", "UPDATE", "DELETE"],
+            # the summary tables are only written by the secure layer itself (see store_summaries.py)
+            "store_daily_sales": ["SELECT"],
+            "store_low_stock": ["SELECT"]
             
         },
         #dude got no restrictions
@@ -33,7 +36,9 @@ role_permissions = {
             "products": ["SELECT", "INSERT", "UPDATE"],
             "staffs": ["SELECT", "INSERT", "UPDATE"],
             "stocks": ["SELECT"],
-            "stores": ["SELECT", "INSERT", "UPDATE"]
+            "stores": ["SELECT", "INSERT", "UPDATE"],
+            "store_daily_sales": ["SELECT"],
+            "store_low_stock": ["SELECT"]
             
         },
         #no restrictions either
@@ -52,7 +57,9 @@ role_permissions = {
             "products": ["SELECT"],
             "staffs": ["SELECT", "UPDATE"],
             "stocks": ["SELECT", "UPDATE"],
-            "stores": ["SELECT"] 
+            "stores": ["SELECT"],
+            "store_daily_sales": ["SELECT"],
+            "store_low_stock": ["SELECT"]
         },
         # store managers have limited access to customers table
         "column_restrictions": {
@@ -62,7 +69,9 @@ role_permissions = {
         "row_restrictions": {
             "orders": "store_id = {store_id}", #placeholders
             "staffs": "store_id = {store_id}",
-            "stocks": "store_id = {store_id}"
+            "stocks": "store_id = {store_id}",
+            "store_daily_sales": "store_id = {store_id}",
+            "store_low_stock": "store_id = {store_id}"
         }
     },
     
@@ -76,7 +85,9 @@ role_permissions = {
             "order_items": ["SELECT", "INSERT", "UPDATE"],
             "products": ["SELECT"],
             "staffs": ["SELECT"],
-            "stocks": ["SELECT"]           
+            "stocks": ["SELECT"],
+            "store_daily_sales": ["SELECT"],
+            "store_low_stock": ["SELECT"]
         },
         # team leads have limited access to customers table as well as limited access to staff tables
         "column_restrictions": {
@@ -87,7 +98,9 @@ role_permissions = {
         # they are also restricted to only see data from their own store
         "row_restrictions": {
             "orders": "store_id = {store_id}",
-            "stocks": "store_id = {store_id}"
+            "stocks": "store_id = {store_id}",
+            "store_daily_sales": "store_id = {store_id}",
+            "store_low_stock": "store_id = {store_id}"
         }
     },
     
@@ -101,7 +114,8 @@ role_permissions = {
             "order_items": ["SELECT", "INSERT"],
             "products": ["SELECT"],
             "staffs": ["SELECT"],
-            "stocks": ["SELECT"]           
+            "stocks": ["SELECT"],
+            "store_low_stock": ["SELECT"]
         },
         # staff has limited access to customers table 
         "column_restrictions": {
@@ -110,7 +124,8 @@ role_permissions = {
         
         # and can only see order data from their own stores..
         "row_restrictions": {
-            "orders": "store_id = {store_id}"
+            "orders": "store_id = {store_id}",
+            "store_low_stock": "store_id = {store_id}"
         }
     },
         
@@ -132,4 +147,81 @@ role_permissions = {
             "order_items": "order_id IN (SELECT order_id FROM orders WHERE customer_id = {customer_id})"
         }
     }
-}
\ No newline at end of file
+}
+
+# defines how much load each role (and each single user of that role) may put on the database
+# used by the admission control in admission_control.py, the query timeouts in query_timeouts.py
+# and the result memory budgets in result_budget.py
+# roles or keys left out are unlimited
+#
+#   "role": limits shared by all users of the role together
+#   "user": limits for each single user of the role
+#       "rate": queries per second (token bucket refill rate)
+#       "burst": how many queries may be started at once before the rate kicks in (bucket size)
+#       "max_in_flight": max queries running at the same time
+#   "queue_timeout": seconds a query may wait for a free slot before it is rejected
+#   "statement_timeout": default max seconds a single query may run (can be overridden per call)
+#   "result_memory_budget": default max (estimated) bytes a single query result may take in memory
+#   "over_budget": "reject" (raise ResultTooLarge) or "spill" (move the result to a temporary file) past the budget
+#                  see result_budget.py
+
+MB = 1024 * 1024
+
+role_limits = {
+    
+    # admin is trusted, but a single admin session still shouldn't run away with the database
+    "admin": {
+        "user": {"rate": 20, "burst": 40, "max_in_flight": 4},
+        "queue_timeout": 10.0,
+        "statement_timeout": 300.0,
+        "result_memory_budget": 512 * MB,
+        "over_budget": "spill"
+    },
+    
+    # executives run the heavy company-wide reports - few at a time, they can wait a bit longer
+    "executive": {
+        "role": {"rate": 5, "burst": 10, "max_in_flight": 3},
+        "user": {"rate": 2, "burst": 5, "max_in_flight": 1},
+        "queue_timeout": 30.0,
+        "statement_timeout": 120.0,
+        "result_memory_budget": 256 * MB,
+        "over_budget": "spill"
+    },
+    
+    "store_manager": {
+        "role": {"rate": 20, "burst": 40, "max_in_flight": 8},
+        "user": {"rate": 5, "burst": 10, "max_in_flight": 2},
+        "queue_timeout": 10.0,
+        "statement_timeout": 30.0,
+        "result_memory_budget": 64 * MB,
+        "over_budget": "spill"
+    },
+    
+    "team_lead": {
+        "role": {"rate": 20, "burst": 40, "max_in_flight": 8},
+        "user": {"rate": 5, "burst": 10, "max_in_flight": 2},
+        "queue_timeout": 10.0,
+        "statement_timeout": 30.0,
+        "result_memory_budget": 32 * MB,
+        "over_budget": "reject"
+    },
+    
+    # staff are the latency sensitive POS traffic - plenty of room, but short queueing so terminals fail fast
+    "staff": {
+        "role": {"rate": 100, "burst": 200, "max_in_flight": 32},
+        "user": {"rate": 10, "burst": 20, "max_in_flight": 4},
+        "queue_timeout": 2.0,
+        "statement_timeout": 5.0,
+        "result_memory_budget": 16 * MB,
+        "over_budget": "reject"
+    },
+    
+    "customer": {
+        "role": {"rate": 50, "burst": 100, "max_in_flight": 16},
+        "user": {"rate": 2, "burst": 5, "max_in_flight": 1},
+        "queue_timeout": 5.0,
+        "statement_timeout": 5.0,
+        "result_memory_budget": 4 * MB,
+        "over_budget": "reject"
+    }
+}
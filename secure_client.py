@@ -0,0 +1,241 @@
+import json
+import os
+import socket
+
+"""
+Thin client for the secure query daemon (secure_daemon.py)
+
+Cron jobs and CLI scripts that only run a few queries spend most of their time importing the package,
+authenticating and connecting. With the daemon running, they use this module instead - it only needs the
+standard library and talks to the daemon over its Unix domain socket:
+
+        from secure_client import SecureClient
+
+        with SecureClient("store1_manager", "manager1_pass") as client:
+            stocks = client.select("stocks", condition="quantity < 5")
+            for order in client.stream("select", "orders"):   # rows as they arrive, chunk by chunk
+                ...
+
+The calls take the same arguments as the SecureOperations methods (see DAEMON_METHODS) and raise the
+same kinds of errors (PermissionError, ValueError, TimeoutError for query timeouts and admission
+rejections, MemoryError for results over the memory budget). Values JSON can't carry (dates, decimals)
+come back as strings. The daemon caps timeout and memory_budget at the role's defaults - 0 doesn't lift them.
+
+Protocol (one JSON object per line, both ways):
+
+        -> {"op": "login", "username": ..., "password": ...}
+        <- {"ok": true, "role": ...}                                     or {"error": {...}}
+        -> {"id": 1, "op": "call", "method": "select", "args": [...], "kwargs": {...}}
+        <- {"id": 1, "columns": [...]}                                   (row results only)
+        <- {"id": 1, "rows": [[...], ...]}                               (zero or more chunks)
+        <- {"id": 1, "done": true, "rows": 1234}                         or {"id": 1, "done": true, "result": ...}
+        <- {"id": 1, "done": true, "pairs": [[key, row], ...]}           (select_by_keys(as_dict=True))
+        <- {"id": 1, "done": true, "error": {"type": ..., "message": ...}}
+        -> {"id": 2, "op": "logout"}
+        <- {"id": 2, "done": true}
+"""
+
+# where the daemon listens, unless told otherwise
+DEFAULT_SOCKET_PATH = os.environ.get("BIKECORP_DAEMON_SOCKET", "/tmp/bikecorp_secure_daemon.sock")
+
+# the SecureOperations methods the daemon serves (export() isn't one - it writes files on the daemon's machine)
+DAEMON_METHODS = ("select", "aggregate", "select_join", "select_by_keys", "select_changes",
+                  "insert", "update", "delete", "update_chunked", "delete_chunked", "upsert_many")
+
+# error types raised on the client for the error types reported by the daemon (anything else is a DaemonError)
+ERROR_TYPES = {
+    "PermissionError": PermissionError,
+    "ValueError": ValueError,
+    "TypeError": TypeError,
+    "KeyError": KeyError,
+    "QueryTimeout": TimeoutError,
+    "AdmissionRejected": TimeoutError,
+    "TimeoutError": TimeoutError,
+    "ResultTooLarge": MemoryError,
+}
+
+
+class DaemonError(RuntimeError):
+    """
+    Raised for errors of the daemon (or the database) that have no matching built-in error type
+
+    Attributes:
+            type (string): the name of the error type in the daemon
+    """
+
+    def __init__(self, message, error_type=None):
+        super().__init__(message)
+        self.type = error_type
+
+
+def _raise_error(error):
+    error_type = error.get("type")
+    message = error.get("message", "")
+    exception = ERROR_TYPES.get(error_type)
+    if exception is None:
+        raise DaemonError(f"{error_type}: {message}", error_type)
+    raise exception(message)
+
+
+def _result_of(message):
+    # a {key: row} result comes as [key, row] pairs, so keys that aren't strings stay what they were
+    if "pairs" in message:
+        return {key: row for key, row in message["pairs"]}
+    return message["result"]
+
+
+class SecureClient:
+    """
+    A session with the secure query daemon - authenticated once, then any number of calls (one at a time)
+
+    Attributes:
+            username (string)
+            role (string): the user's role, as reported by the daemon
+    """
+
+    def __init__(self, username, password, socket_path=None, timeout=None):
+        """
+        Connects to the daemon and logs in
+
+        Arguments:
+                username (string)
+                password (string)
+                socket_path (string): the daemon's socket (default to DEFAULT_SOCKET_PATH)
+                timeout (float): max seconds to wait for the daemon on any read (None waits as long as it takes)
+
+        Raises:
+                ValueError: if authentication fails
+                ConnectionError: if the daemon isn't running
+        """
+        self.username = username
+        self._next_id = 0
+        self._open_stream = None
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        try:
+            self._socket.connect(socket_path or DEFAULT_SOCKET_PATH)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            self._socket.close()
+            raise ConnectionError(f"The secure query daemon isn't running at {socket_path or DEFAULT_SOCKET_PATH}: {e}") from None
+        self._reader = self._socket.makefile("rb")
+
+        self._send({"op": "login", "username": username, "password": password})
+        reply = self._receive()
+        if "error" in reply:
+            self.close()
+            _raise_error(reply["error"])
+        self.role = reply.get("role")
+
+    def _send(self, message):
+        self._socket.sendall(json.dumps(message).encode() + b"\n")
+
+    def _receive(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("The secure query daemon closed the connection")
+        return json.loads(line)
+
+    def _request(self, op, method=None, args=(), kwargs=None):
+        # a stream that wasn't read to the end is skipped first, so the replies stay in step
+        if self._open_stream is not None:
+            self._drain(self._open_stream)
+        self._next_id += 1
+        self._send({"id": self._next_id, "op": op, "method": method, "args": list(args), "kwargs": kwargs or {}})
+        return self._next_id
+
+    def _drain(self, request_id):
+        while not self._receive().get("done"):
+            pass
+        if self._open_stream == request_id:
+            self._open_stream = None
+
+    def stream(self, method, *args, as_dicts=True, **kwargs):
+        """
+        Runs a SecureOperations method in the daemon and yields the result rows while they arrive in chunks
+
+        Arguments:
+                method (string): one of DAEMON_METHODS
+                as_dicts (bool): rows as dicts (default) or as lists in the order of the columns
+                args, kwargs: the arguments of the method
+
+        Yields:
+                the rows - or the result itself, once, for methods that don't return rows (like update())
+        """
+        if method not in DAEMON_METHODS:
+            raise ValueError(f"Unknown method: {method!r} - must be one of {DAEMON_METHODS}")
+        request_id = self._request("call", method, args, kwargs)
+        self._open_stream = request_id
+        columns = None
+        while True:
+            message = self._receive()
+            if "columns" in message:
+                columns = message["columns"]
+            if "rows" in message and not message.get("done"):
+                for row in message["rows"]:
+                    yield dict(zip(columns, row)) if as_dicts else row
+            if message.get("done"):
+                self._open_stream = None
+                if "error" in message:
+                    _raise_error(message["error"])
+                if "result" in message or "pairs" in message:
+                    yield _result_of(message)
+                return
+
+    def call(self, method, *args, **kwargs):
+        """
+        Runs a SecureOperations method in the daemon and returns its whole result
+
+        Returns:
+                list: the rows as dicts, for methods returning rows - else the method's own return value
+        """
+        if method not in DAEMON_METHODS:
+            raise ValueError(f"Unknown method: {method!r} - must be one of {DAEMON_METHODS}")
+        rows = []
+        request_id = self._request("call", method, args, kwargs)
+        columns = None
+        while True:
+            message = self._receive()
+            if "columns" in message:
+                columns = message["columns"]
+            if message.get("done"):
+                if "error" in message:
+                    _raise_error(message["error"])
+                return _result_of(message) if "result" in message or "pairs" in message else rows
+            if "rows" in message:
+                rows.extend(dict(zip(columns, row)) for row in message["rows"])
+
+    def __getattr__(self, name):
+        # client.select(...), client.update(...) etc. for the methods the daemon serves
+        if name in DAEMON_METHODS:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def metrics(self):
+        """
+        Returns:
+                dict: the daemon's metrics (clients, requests, sessions) plus its admission and result memory metrics
+        """
+        self._request("metrics")
+        message = self._receive()
+        if "error" in message:
+            _raise_error(message["error"])
+        return message["result"]
+
+    def close(self):
+        # logging out (instead of just hanging up) hands the session back to the daemon's cache right away
+        try:
+            self._request("logout")
+            self._drain(self._next_id)
+        except (OSError, ValueError):
+            pass
+        try:
+            self._reader.close()
+        finally:
+            self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
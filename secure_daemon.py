@@ -0,0 +1,482 @@
+import argparse
+import hashlib
+import hmac
+import inspect
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from contextlib import closing
+import secure_db
+from secure_operations import SecureOperations
+from secure_client import DEFAULT_SOCKET_PATH, DAEMON_METHODS
+from admission_control import admission_controller
+from result_budget import result_memory
+from result_formats import ColumnarResult
+from db_logger import get_audit_logger
+
+"""
+Secure query daemon - one long lived process serving SecureOperations calls to short lived clients
+
+Cron jobs and CLI scripts used to import the package, authenticate, connect and only then run their
+few queries. The daemon does all of that once and keeps it warm: the role policies, the audit log writer
+and a cache of authenticated sessions (each with its own open database connection - key lookups also
+borrow from the shared connection pool).
+Clients connect over a Unix domain socket with the thin client in secure_client.py and call the same
+methods with the same arguments - every call still goes through SecureOperations, so permissions,
+row/column restrictions, admission control, timeouts, memory budgets and audit logging all apply.
+
+- many clients are served at the same time (one thread per client connection)
+- select() results are streamed from the server side cursor in chunks of STREAM_CHUNK_ROWS rows as they
+  arrive, so the daemon holds one chunk at a time however big the result. Other row results (joins, key
+  lookups...) are built by SecureOperations within the role's memory budget, then sent in chunks
+- at most max_sessions sessions (= database connections) are open at once. A new client first takes the
+  place of the longest unused idle session, else waits up to session_wait seconds for one to come back
+- a session stays in the cache for session_ttl seconds after its client is done - a new client of the
+  same user with the same password gets it back without authenticating and connecting again. Its
+  transaction is rolled back on the way in, so the next client never reads the previous one's snapshot
+- clients can tighten the role's statement timeout and memory budget per call, never lift them:
+  timeout=0 / memory_budget=0 (no limit) or anything above the role's default is capped to the default,
+  and over_budget="spill" only applies to roles that spill anyway ("reject" is always allowed)
+
+The socket is only accessible to the user running the daemon (mode 0600 by default), and every client
+still has to log in with its own username and password.
+
+Usage:
+        python secure_daemon.py [--socket /tmp/bikecorp_secure_daemon.sock] [--mode 660] [--max-sessions 32]
+"""
+
+# rows per streamed message
+STREAM_CHUNK_ROWS = 500
+
+
+class SessionCache:
+    """
+    Thread safe cache of authenticated SecureOperations sessions, reused by later clients of the same user
+
+    A session is only handed to one client at a time. Passwords aren't kept - only a keyed hash to check
+    that a later client knows the same password. Every session holds its own database connection, so their
+    total (in use, idle and being opened) is capped at max_sessions
+    """
+
+    def __init__(self, session_ttl=300.0, max_idle_per_user=4, max_sessions=32, session_wait=10.0, clock=time.monotonic):
+        """
+        Arguments:
+                session_ttl (float): seconds an unused session (and its connection) is kept
+                max_idle_per_user (int): max unused sessions kept per user
+                max_sessions (int): max sessions (= database connections) open at the same time
+                session_wait (float): max seconds a new client waits for room when max_sessions are in use
+                clock (callable): returns the current time in seconds (replaceable in tests)
+        """
+        self.session_ttl = session_ttl
+        self.max_idle_per_user = max_idle_per_user
+        self.max_sessions = max_sessions
+        self.session_wait = session_wait
+        self.clock = clock
+        self._key = os.urandom(32)
+        self._idle = {}  # username -> list of (session, password hash, time it was returned)
+        self._in_use = {}  # session -> password hash
+        self._opening = 0  # sessions being authenticated/connected right now
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._metrics = {"created": 0, "reused": 0, "expired": 0, "evicted": 0, "refused": 0}
+
+    def _hash(self, password):
+        return hmac.new(self._key, password.encode(), hashlib.sha256).digest()
+
+    def _open_sessions(self):
+        return len(self._in_use) + self._opening + sum(len(idle) for idle in self._idle.values())
+
+    def checkout(self, username, password):
+        """
+        Returns an authenticated session for the user - a cached one if there is one, else a new one
+
+        Raises:
+                ValueError: if authentication fails
+                TimeoutError: if max_sessions stay in use for longer than session_wait
+        """
+        password_hash = self._hash(password)
+        to_close = []
+        session = None
+        with self._available:
+            # every checkout sweeps the expired sessions of all users - not only this one's, or the sessions
+            # (and connections) of users who never come back would stay open for good
+            now = self.clock()
+            for user, idle in list(self._idle.items()):
+                to_close.extend(entry[0] for entry in idle if now - entry[2] > self.session_ttl)
+                idle[:] = [entry for entry in idle if now - entry[2] <= self.session_ttl]
+                if not idle:
+                    del self._idle[user]
+            self._metrics["expired"] += len(to_close)
+            for entry in self._idle.get(username, []):
+                if hmac.compare_digest(entry[1], password_hash):
+                    self._idle[username].remove(entry)
+                    session = entry[0]
+                    break
+            if session is not None:
+                self._metrics["reused"] += 1
+                self._in_use[session] = password_hash
+            else:
+                # room for a new session: make it by closing the longest unused one of any user, else wait
+                deadline = time.monotonic() + self.session_wait
+                while self._open_sessions() >= self.max_sessions:
+                    idle_entries = [(entry[2], user, entry) for user, idle in self._idle.items() for entry in idle]
+                    if idle_entries:
+                        _, user, entry = min(idle_entries, key=lambda item: item[0])
+                        self._idle[user].remove(entry)
+                        to_close.append(entry[0])
+                        self._metrics["evicted"] += 1
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._metrics["refused"] += 1
+                        raise TimeoutError(f"The daemon has {self.max_sessions} sessions in use - try again later")
+                    self._available.wait(remaining)
+                self._opening += 1
+        for old in to_close:
+            old.close()
+        if session is not None:
+            return session
+
+        # a new session authenticates like any SecureOperations user (raises ValueError if it fails)
+        try:
+            session = SecureOperations(username, password)
+        except BaseException:
+            with self._available:
+                self._opening -= 1
+                self._available.notify()
+            raise
+        with self._available:
+            self._opening -= 1
+            self._metrics["created"] += 1
+            self._in_use[session] = password_hash
+        return session
+
+    def checkin(self, session, reusable=True):
+        """
+        Gives a session back after its client is done with it
+
+        Arguments:
+                reusable (bool): False if it had an error its connection might not have survived - it is closed
+        """
+        if reusable and session.connection is not None:
+            # ends the client's transaction - otherwise the next client would keep reading its REPEATABLE READ snapshot
+            try:
+                session.connection.rollback()
+            except Exception as e:
+                print(f"Secure query daemon: could not roll back a returned session, closing it: {e}")
+                reusable = False
+        with self._available:
+            password_hash = self._in_use.pop(session)
+            # a waiting client can now take its place (reusing or evicting it)
+            self._available.notify()
+            idle = self._idle.setdefault(session.username, [])
+            if reusable and len(idle) < self.max_idle_per_user:
+                idle.append((session, password_hash, self.clock()))
+                return
+        session.close()
+
+    def close(self):
+        with self._lock:
+            sessions = [entry[0] for idle in self._idle.values() for entry in idle]
+            self._idle = {}
+        for session in sessions:
+            session.close()
+
+    def metrics(self):
+        """
+        Returns:
+                dict: sessions created, reused, expired, evicted (to make room) and refused (no room), and the
+                      number currently idle and in use
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["idle"] = sum(len(idle) for idle in self._idle.values())
+            metrics["in_use"] = len(self._in_use)
+            return metrics
+
+
+def _rows_of(result):
+    """
+    Returns (columns, iterator of row lists) for results made of rows - or None for any other result
+    """
+    if isinstance(result, ColumnarResult):
+        result = result.to_dicts()
+    if isinstance(result, (str, bytes, dict)) or not hasattr(result, "__iter__"):
+        return None
+    columns = getattr(result, "columns", None)
+    rows = iter(result)
+    first = next(rows, None)
+    if first is None:
+        return (list(columns or []), iter(()))
+    if not hasattr(first, "keys"):
+        return None
+    columns = list(first.keys())
+
+    def values():
+        yield list(first.values())
+        for row in rows:
+            yield list(row.values())
+
+    return (columns, values())
+
+
+def _error(e):
+    return {"type": type(e).__name__, "message": str(e)}
+
+
+def _capped_limits(session, kwargs):
+    """
+    Returns the call's kwargs with timeout and memory_budget capped at the role's defaults - a client may
+    tighten them, but 0 (no limit) or anything above the default becomes the default. Likewise over_budget
+    stays the role's unless the client asks for "reject" - "spill" would let a rejecting role fetch any size
+    """
+    kwargs = dict(kwargs)
+    memory_budget, over_budget = session._memory_budget()
+    limits = {"timeout": session._statement_timeout(None), "memory_budget": memory_budget}
+    for name, limit in limits.items():
+        if name in kwargs and limit and (not kwargs[name] or kwargs[name] > limit):
+            kwargs[name] = limit
+    if "over_budget" in kwargs and kwargs["over_budget"] != "reject":
+        kwargs["over_budget"] = over_budget
+    return kwargs
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one client connection: a login, then calls one at a time until the client disconnects
+    """
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message, default=str).encode() + b"\n")
+
+    def handle(self):
+        server = self.server
+        server.count("clients_total")
+        session = None
+        reusable = True
+        try:
+            login = self._receive()
+            if not login or login.get("op") != "login":
+                self.send({"error": {"type": "ValueError", "message": "The first request must be a login"}})
+                return
+            try:
+                session = server.sessions.checkout(login.get("username"), login.get("password") or "")
+            except Exception as e:
+                server.count("login_failures")
+                self.send({"error": _error(e)})
+                return
+            self.send({"ok": True, "role": session.role})
+
+            while True:
+                request = self._receive()
+                if request is None:
+                    break
+                if request.get("op") == "logout":
+                    # the session is back in the cache before the client hears about it - so its next run can reuse it
+                    server.sessions.checkin(session)
+                    session = None
+                    self.send({"id": request.get("id"), "done": True})
+                    break
+                self._serve(session, request)
+        except ValueError as e:
+            # not a JSON line - the client doesn't speak the protocol, so the connection is dropped
+            print(f"Secure query daemon: invalid request, closing the client connection: {e}")
+        except OSError:
+            # the client went away in the middle of a reply
+            reusable = False
+        finally:
+            if session is not None:
+                server.sessions.checkin(session, reusable)
+
+    def _stream_select(self, session, request_id, args, kwargs):
+        """
+        Serves a select() call straight from the server side cursor (SecureOperations.select_stream()) - every
+        batch is sent on as it arrives, so the daemon never holds more than one batch of the result
+        (result_format, memory_budget and over_budget don't matter here - nothing is kept to budget for)
+        """
+        call = inspect.signature(session.select).bind(*args, **kwargs).arguments
+        stream = session.select_stream(call["table"], call.get("columns"), call.get("condition"), call.get("limit"),
+                                       batch_size=STREAM_CHUNK_ROWS, timeout=call.get("timeout"))
+        count = 0
+        with closing(stream):
+            for position, (columns, rows) in enumerate(stream):
+                if position == 0:
+                    self.send({"id": request_id, "columns": columns})
+                if rows:
+                    self.send({"id": request_id, "rows": rows})
+                    count += len(rows)
+        self.server.count("rows_streamed", count)
+        self.send({"id": request_id, "done": True, "rows": count})
+
+    def _receive(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def _serve(self, session, request):
+        """
+        Runs one request and sends its reply
+        """
+        server = self.server
+        request_id = request.get("id")
+        server.count("requests")
+
+        if request.get("op") == "metrics":
+            self.send({"id": request_id, "done": True, "result": server.metrics()})
+            return
+
+        method = request.get("method")
+        if request.get("op") != "call" or method not in DAEMON_METHODS:
+            self.send({"id": request_id, "done": True,
+                       "error": {"type": "ValueError", "message": f"Unknown request: {request.get('op')} {method}"}})
+            return
+
+        try:
+            kwargs = _capped_limits(session, request.get("kwargs", {}))
+            if method == "select":
+                self._stream_select(session, request_id, request.get("args", []), kwargs)
+                return
+            result = getattr(session, method)(*request.get("args", []), **kwargs)
+        except OSError:
+            # the client went away - nothing left to reply to
+            raise
+        except Exception as e:
+            server.count("errors")
+            # refused calls (permissions, bad arguments, admission, memory budget) never got to use the connection -
+            # after anything else it is closed, the session reconnects on its next call
+            if not isinstance(e, (PermissionError, ValueError, TypeError, TimeoutError, MemoryError)):
+                session.close()
+            self.send({"id": request_id, "done": True, "error": _error(e)})
+            return
+
+        if method == "select_by_keys" and isinstance(result, dict):
+            # {key: row} as [key, row] pairs - as a JSON object its keys would all turn into strings
+            self.send({"id": request_id, "done": True, "pairs": [[key, row] for key, row in result.items()]})
+            return
+
+        rows = _rows_of(result)
+        if rows is None:
+            self.send({"id": request_id, "done": True, "result": result})
+            return
+
+        columns, values = rows
+        self.send({"id": request_id, "columns": columns})
+        count = 0
+        chunk = []
+        for row in values:
+            chunk.append(row)
+            if len(chunk) >= STREAM_CHUNK_ROWS:
+                self.send({"id": request_id, "rows": chunk})
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            self.send({"id": request_id, "rows": chunk})
+            count += len(chunk)
+        if hasattr(result, "close"):
+            # a spilled result - its temporary file can go
+            result.close()
+        server.count("rows_streamed", count)
+        self.send({"id": request_id, "done": True, "rows": count})
+
+
+class SecureDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    The daemon's server - one thread per client, sharing the session cache and everything SecureOperations
+    shares within a process (connection pool, admission control, single flight, audit logger)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, mode=0o600, session_ttl=300.0, max_idle_per_user=4, max_sessions=32):
+        """
+        Arguments:
+                socket_path (string): where to listen
+                mode (int): file permissions of the socket
+                session_ttl (float), max_idle_per_user (int), max_sessions (int): see SessionCache
+
+        Raises:
+                OSError: if another daemon is already listening on socket_path
+        """
+        _remove_stale_socket(socket_path)
+        super().__init__(socket_path, DaemonHandler)
+        os.chmod(socket_path, mode)
+        self.socket_path = socket_path
+        self.sessions = SessionCache(session_ttl, max_idle_per_user, max_sessions)
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._metrics = {"clients_total": 0, "login_failures": 0, "requests": 0, "errors": 0, "rows_streamed": 0}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._metrics[name] += amount
+
+    def metrics(self):
+        """
+        Returns:
+                dict: client, request, error and streamed row counts, the session cache, admission control
+                      and result memory metrics
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics["uptime_seconds"] = round(time.time() - self.started, 1)
+        metrics["sessions"] = self.sessions.metrics()
+        metrics["admission"] = admission_controller.metrics()
+        metrics["result_memory"] = result_memory.metrics()
+        return metrics
+
+    def warm_up(self):
+        """
+        Does the one-off startup work before the first client comes: sets up the audit logger and opens a
+        first database connection (importing the driver and checking the connection settings)
+        """
+        get_audit_logger()
+        try:
+            secure_db.open_connection().close()
+        except Exception as e:
+            print(f"Warning: could not connect to the database yet: {e}")
+
+    def server_close(self):
+        super().server_close()
+        self.sessions.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def _remove_stale_socket(socket_path):
+    # a socket file left behind by a daemon that didn't shut down cleanly is removed - unless a daemon still answers on it
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(socket_path)
+        return
+    finally:
+        probe.close()
+    raise OSError(f"A daemon is already listening on {socket_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve SecureOperations calls to local clients over a Unix domain socket")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="the socket to listen on")
+    parser.add_argument("--mode", default="600", help="file permissions of the socket (octal)")
+    parser.add_argument("--session-ttl", type=float, default=300.0, help="seconds an unused session is kept")
+    parser.add_argument("--max-idle", type=int, default=4, help="max unused sessions kept per user")
+    parser.add_argument("--max-sessions", type=int, default=32, help="max sessions (database connections) open at once")
+    args = parser.parse_args()
+
+    server = SecureDaemon(args.socket, int(args.mode, 8), args.session_ttl, args.max_idle, args.max_sessions)
+    server.warm_up()
+    print(f"Secure query daemon listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("Secure query daemon stopped")
@@ -1,8 +1,37 @@
-import mysql.connector
 import json
+import threading
+from contextlib import contextmanager, ExitStack
 from user_auth import authenticate_user
 from role_definitions import role_permissions
 from db_logger import log_database_access
+from connection_pool import ConnectionPool
+from tracing import tracer
+
+# the database connection settings - point this at another file to run against e.g. a local stand-in database
+DB_CONFIG_FILE = "db_config.json"
+
+def open_connection():
+    """
+    Opens a new connection to the database configured in DB_CONFIG_FILE (db_config.json)
+    
+    Returns:
+            connection <-- mySQL database connection object
+    """
+    # the driver is imported on first connect, not with this module - it takes longer to import than everything
+    # else together, and short lived jobs that never get to connect shouldn't pay for it
+    import mysql.connector
+    
+    # Load database configuration
+    with open(DB_CONFIG_FILE) as f:
+        config = json.load(f)
+    
+    # Connect to the database
+    return mysql.connector.connect(
+        host=config["host"],
+        user=config["user"],
+        password=config["password"],
+        database=config["database"]
+    )
 
 class SecureDatabaseAccess:
     """
@@ -10,6 +39,11 @@ class SecureDatabaseAccess:
     --> It restrict what tables and operations each type of user has permission to access
     """
     
+    # max open connections in the pool shared by all instances (see pooled_connection)
+    pool_size = 8
+    _pool = None
+    _pool_lock = threading.Lock()
+    
     def __init__(self, username, password):
         """
         Constructor that initalizes/instatiates and aunthenticates the user by using the authentication function
@@ -23,8 +57,9 @@ class SecureDatabaseAccess:
                 ValueError -> if authentication fails
         """
         
-        #authenticate the user..
-        success, user_data = authenticate_user(username, password)
+        #authenticate the user.. (traced like the operations when sampled, see tracing.py)
+        with tracer.trace("SecureDatabaseAccess.authenticate", user=username):
+            success, user_data = authenticate_user(username, password)
         
         if not success:
             raise ValueError("Oops, authentication failed - wrong user name or password :<")
@@ -41,6 +76,9 @@ class SecureDatabaseAccess:
         # initializes a database connection (set as None at first)
         self.connection = None
         
+        # the statements running under a time limit right now, each with its own cancel state (see query_timeouts.py)
+        self.running_statements = set()
+        
         print(f"User '{username} authenticated with the role: '{self.role}'")
         
     def connect(self):
@@ -51,20 +89,97 @@ class SecureDatabaseAccess:
                 connection <-- mySQL database connection object
             
         """
-        # Load database configuration
-        with open("db_config.json") as f:
-            config = json.load(f)
-        
-        # Connect to the database
-        self.connection = mysql.connector.connect(
-            host=config["host"],
-            user=config["user"],
-            password=config["password"],
-            database=config["database"]
-        )
+        with tracer.span("acquire connection", pooled=False):
+            self.connection = self._new_connection()
         
         return self.connection
     
+    def _new_connection(self):
+        """
+        Opens a new database connection without storing it on the instance
+        (connect() uses it for the main connection, cancel() for a short lived side connection)
+        """
+        return open_connection()
+    
+    def pooled_connection(self, timeout=30.0):
+        """
+        Context manager lending a connection from the connection pool shared by all users in this process
+        Used for work that runs next to (or in parallel with) the user's own connection
+        
+        Arguments:
+                timeout (float): max seconds to wait for a free connection
+        """
+        cls = SecureDatabaseAccess
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ConnectionPool(open_connection, cls.pool_size)
+        return self._traced_pool_connection(cls._pool, timeout)
+    
+    @contextmanager
+    def _traced_pool_connection(self, pool, timeout):
+        # the span only covers waiting for/opening the connection, not the work done with it
+        with ExitStack() as stack:
+            with tracer.span("acquire connection", pooled=True):
+                connection = stack.enter_context(pool.connection(timeout))
+            yield connection
+    
+    def cancel(self, connection=None, statement=None):
+        """
+        Cancels the query currently running on this user's connection - meant to be called from another thread
+        Sends KILL QUERY over a separate connection, the connection itself stays open
+        
+        Only statements still running under a time limit are cancelled: the kill is sent while holding the
+        statement's lock, so it can't finish in between and the next statement on the connection is never hit
+        
+        Arguments:
+                connection: the connection running the query (default to None meaning the user's own connection)
+                statement: the RunningStatement to cancel (the watchdog passes its own - default to whatever runs
+                           on the connection)
+        
+        Returns:
+                bool: True if a kill was sent, False if nothing was running
+        """
+        if statement is not None:
+            statements = [statement]
+        else:
+            connection = connection or self.connection
+            if not connection:
+                return False
+            statements = [running for running in list(self.running_statements) if running.target() is connection]
+        
+        killed = False
+        for running in statements:
+            with running.lock:
+                target = running.target()
+                if running.finished or not target:
+                    continue
+                # the running query raises an "interrupted" error - remember that it was on purpose
+                running.cancelled = True
+                killed = self._kill_query(target.connection_id) or killed
+        
+        if killed:
+            print(f"Cancelled running query of user '{self.username}'")
+        return killed
+    
+    def _kill_query(self, connection_id):
+        """
+        Sends KILL QUERY for a connection over a separate short lived connection - only if that connection
+        is executing a statement right now
+        """
+        killer = self._new_connection()
+        try:
+            cursor = killer.cursor()
+            cursor.execute("SELECT COMMAND FROM information_schema.PROCESSLIST WHERE ID = %s", (int(connection_id),))
+            row = cursor.fetchone()
+            if not row or row[0] != "Query":
+                cursor.close()
+                return False
+            cursor.execute(f"KILL QUERY {int(connection_id)}")
+            cursor.close()
+            return True
+        finally:
+            killer.close()
+    
     def has_table_permission(self, table, action):
         """
         Method that checks if the user's role has permission to perform an action on a table
@@ -1,5 +1,52 @@
+import re
+import time
+from contextlib import ExitStack, closing, contextmanager
 from secure_db import SecureDatabaseAccess
 from db_logger import log_database_access
+from result_formats import check_result_format, copy_result, DEFAULT_COMPACT_ROWS_THRESHOLD, DEFAULT_BATCH_SIZE
+from data_export import ChunkedFileWriter
+from admission_control import admission_controller
+from query_timeouts import add_server_timeout, time_limit
+from role_definitions import role_limits
+from db_schema import primary_keys, change_tracking, join_columns, table_columns, CHANGE_LOG_TABLE
+from tracing import traced, tracer
+from single_flight import single_flight
+from result_budget import fetch_within_budget, OVER_BUDGET_ACTIONS
+from store_summaries import maintains, keys_for_condition, keys_for_rows, keys_after_update, refresh_summaries, SummaryKeys
+
+# aggregate functions that may be pushed down to the database by aggregate()
+AGGREGATE_FUNCTIONS = {"COUNT", "SUM", "AVG", "MIN", "MAX"}
+
+# plain column/alias names only - no expressions, quotes or whitespace
+IDENTIFIER_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+# quoted string literals, and the names in what is left of a condition once they are taken out
+STRING_LITERAL_PATTERN = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+NAME_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+def settled_watermark(base, changes, gap_timeout):
+    """
+    Finds how far a sync watermark can safely move past base
+    
+    change_seq values are handed out when a change is made, not when it commits - a transaction holding
+    seq 41 can still commit after seq 42 is visible. So the watermark only moves over sequence numbers
+    without gaps below them. A gap is only skipped once the change after it is older than gap_timeout
+    (then the missing number belongs to a rolled back transaction, or one that ran too long to wait for)
+    
+    Arguments:
+            base (int): the watermark to start from
+            changes (list): (change_seq, age in seconds) of the visible changes after base, in seq order
+            gap_timeout (float): seconds after which a gap is taken as permanent
+    
+    Returns:
+            int: the new watermark
+    """
+    watermark = base
+    for change_seq, age in changes:
+        if change_seq > watermark + 1 and age < gap_timeout:
+            break
+        watermark = change_seq
+    return watermark
 
 class SecureOperations(SecureDatabaseAccess):
     """
@@ -11,11 +58,39 @@ class SecureOperations(SecureDatabaseAccess):
     -UPDATE
     -DELETE
     
+    As well as aggregated reads (GROUP BY) run inside the database, reads joining several related tables,
+    streaming exports to CSV/JSONL files and incremental "changed since" reads for keeping client side caches in sync
+    
     Applies security checks before executing SQL queries
     """
     
+    # result format used by select() when none is given - set to "auto" (or "rows") to get
+    # compact Row objects instead of dicts for large results (see result_formats.py)
+    default_result_format = "dicts"
+    
+    # in "auto" mode, results with more rows than this are returned as Row objects
+    compact_rows_threshold = DEFAULT_COMPACT_ROWS_THRESHOLD
+    
+    # per role/user rate and concurrency limits, shared by all instances (limits are in role_limits)
+    admission = admission_controller
+    
+    # identical concurrent selects share one execution - shared by all instances, metrics in single_flight.metrics()
+    coalesce_selects = True
+    single_flight = single_flight
+    
+    # seconds select_changes() waits for an uncommitted change to show up before its gap in change_log
+    # is skipped (transactions writing to tracked tables must be shorter than this)
+    sync_gap_timeout = 60.0
+    
+    # writes to orders, order_items and stocks keep the per store summary tables up to date (see store_summaries.py)
+    # - off by default since it costs extra round trips per write and needs the tables from store_summaries.sql;
+    # switch it on (SecureOperations.maintain_summaries = True) once those tables exist
+    maintain_summaries = False
+    
     # SELECT
-    def select(self, table, columns=None, condition=None, limit=None):
+    @traced
+    def select(self, table, columns=None, condition=None, limit=None, result_format=None, timeout=None,
+               memory_budget=None, over_budget=None):
         """
         Selects(=reads) data from a table if permitted
         
@@ -24,87 +99,942 @@ class SecureOperations(SecureDatabaseAccess):
                 columns (list): the specific columns to be retrieved (default to None meaning all allowed)
                 condition (string): Additional WHERE clauses
                 limit (int): Maximum number of rows to return
+                result_format (string): "dicts" for a list of dicts, "rows" for compact Row objects, 
+                                        "columns" for a ColumnarResult with one array per column, or "auto" 
+                                        for Row objects only above compact_rows_threshold rows (see result_formats.py)
+                                        Defaults to default_result_format
+                timeout (float): max seconds the query may run (default to the role's statement_timeout, 0 for none)
+                memory_budget (int): max estimated bytes the result may take in memory (default to the role's 
+                                     result_memory_budget, 0 for none)
+                over_budget (string): "reject" or "spill" - what happens to a result over the budget 
+                                      (default to the role's over_budget, see result_budget.py)
                 
         Returns: 
-                list: the query result as a list of dicts
+                list: the query result as a list of dicts or Row objects (or a ColumnarResult for result_format="columns")
+                      or a SpilledResult (iterate over it to read the rows from disk) if it was over the budget
                 
         
         Raises:
                 PermissionError: if the user doesn't have the neccessary permission for the operation
+                ValueError: if the result_format is unknown, or "columns" is combined with over_budget="spill"
+                QueryTimeout: if the query ran longer than the timeout
+                ResultTooLarge: if the result was over the memory budget and couldn't be spilled
+        """
+        
+        if result_format is None:
+            result_format = self.default_result_format
+        check_result_format(result_format)
+        
+        query = self._build_select_query(table, columns, condition, limit)
+        
+        # the server stops the SELECT itself when it runs past the timeout
+        timeout = self._statement_timeout(timeout)
+        query = add_server_timeout(query, timeout)
+        
+        if result_format == "columns" and over_budget == "spill":
+            raise ValueError("Columnar results can't be spilled to disk - use over_budget=\"reject\" or another result_format")
+        budget = self._memory_budget(memory_budget, over_budget)
+        
+        if not self.coalesce_selects:
+            return self._run_select(table, query, result_format, timeout, budget)
+        
+        # identical selects running at the same moment share one execution (see single_flight.py)
+        # the key holds everything deciding what the result contains: the query has the row restriction filled in and
+        # the role decides the columns - so users of the same role and store share, other stores and roles never do
+        key = (query, result_format, budget, self.role)
+        with tracer.span("single flight") as span:
+            results, shared = self.single_flight.run(
+                key, lambda: self._run_select(table, query, result_format, timeout, budget), table, copy=copy_result)
+            span.set("shared", shared)
+        if shared:
+            # no query was sent for this call, but the access is still audited
+            log_database_access(self.username, self.role, "SELECT", table, f"{query} - shared result")
+            print(f"SELECT query shared with an identical running query: {query}")
+            print(f"Retrieved {len(results)} rows")
+        return results
+    
+    def _run_select(self, table, query, result_format, timeout, budget=(None, "reject")):
+        """
+        Runs a SELECT built by _build_select_query() and fetches the result in result_format,
+        within budget - the (bytes, over_budget action) pair from _memory_budget()
+        """
+        # wait for a query slot for this role/user first (admission control) - raises AdmissionRejected if overloaded
+        # then run it under the statement timeout - raises QueryTimeout if it runs too long
+        with self._admitted(), time_limit(self, "SELECT", table, query, timeout):
+            #log the access
+            log_database_access(self.username, self.role, "SELECT", table, query)
+        
+            #connect to database if not already connected
+            if not self.connection:
+                self.connect()
+            
+            #create cursor and execute the query built
+            #only the default format needs a dict per row - the others are built from plain tuples
+            cursor = self.connection.cursor(dictionary=(result_format == "dicts"))
+            try:
+                with tracer.span("execute"):
+                    cursor.execute(query)
+                with tracer.span("fetch", result_format=result_format) as span:
+                    results = fetch_within_budget(cursor, result_format, *budget, self.compact_rows_threshold)
+                    span.set("rows", len(results))
+                print(f"SELECT query executed: {query}")
+                print(f"Retrieved {len(results)} rows")
+                return results
+            except Exception as e:
+                print(f"Error executing the following SELECT query: {e}")
+                raise
+            finally:
+                cursor.close()
+            
+    def _build_select_query(self, table, columns=None, condition=None, limit=None):
+        """
+        Builds the SELECT query for a table with the role's table, column and row restrictions applied
+        Shared by select() and everything else that reads through the same security checks
+        
+        Arguments:
+                same as select()
+                
+        Returns:
+                string: the final SELECT query
+                
+        Raises:
+                PermissionError: if the user doesn't have the neccessary permission for the operation
+        """
+        
+        #the role's permissions - timed as one step when the call is traced
+        with tracer.span("policy check", table=table):
+            #checks if the user has permission to select from the spexcific table
+            if not self.has_table_permission(table, "SELECT"):
+                error_message = f"Access denied!!: {self.role} is not permitted to SELECT from {table}!!!!"
+                print(error_message)
+                raise PermissionError(error_message)
+        
+            #applies column restrictions depending on role
+            allowed_columns = self.get_allowed_columns(table)
+        
+            #determine which columns to select and show
+            if allowed_columns == ["*"]: # no restriction columns
+                cols_to_select = "*" if not columns else ", ".join(columns)
+            else:
+                # in case of restrictions
+                if not columns:
+                    # if no specific columns requested in the query, select all allowed columns
+                    cols_to_select = ", ".join(allowed_columns)
+                else:
+                    # if specific columns queried for, filter for allowed columns and raise error if not permitted
+                    filtered_columns = [col for col in columns if col in allowed_columns]     
+                    if not filtered_columns:
+                        raise PermissionError(f"Requested columns not accesible for {self.role}")  
+                    cols_to_select = ", ".join(filtered_columns)         
+                
+                
+            #next restriction are checked for/applied at row-level
+            row_restriction = self.get_row_restriction(table)
+
+        with tracer.span("build"):
+            # do that by building a WHERE clause in sql
+            where_clauses = []
+            if condition:
+                where_clauses.append(f"({condition})")                
+            if row_restriction:
+                where_clauses.append(f"({row_restriction})")
+            
+            where_clause = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
+        
+            limit_clause = f" LIMIT {limit}" if limit is not None else ""
+        
+            # build final query
+            query = f"SELECT {cols_to_select} FROM {table}{where_clause}{limit_clause}"
+
+        return query
+            
+    # AGGREGATE
+    
+    @traced
+    def aggregate(self, table, group_by=None, metrics=None, condition=None, limit=None, timeout=None):
         """
+        Runs an aggregated (GROUP BY) query on a table if permitted, so only the summary rows leave the database
         
-        #checks if the user has permission to select from the spexcific table
+        Arguments:
+                table (string): the table to be aggregated
+                group_by (list): the columns to group by (default to None meaning one summary row for the whole table)
+                metrics (dict): output names mapped to (function, column) pairs, e.g. {"max_id": ("MAX", "category_id")}
+                                function is one of COUNT, SUM, AVG, MIN, MAX. Column may be "*" for COUNT only
+                condition (string): Additional WHERE clauses
+                limit (int): Maximum number of rows to return
+                timeout (float): max seconds the query may run (default to the role's statement_timeout, 0 for none)
+                
+        Returns: 
+                list: one dict per group with the group_by columns and the metrics
+                
+        
+        Raises:
+                PermissionError: if the user doesn't have the neccessary permission or uses a restricted column
+                                 (in group_by, metrics or condition)
+                ValueError: if the group_by columns or metrics are not valid
+        """
+        
+        #same table permission as a normal select - aggregates are still reads
         if not self.has_table_permission(table, "SELECT"):
             error_message = f"Access denied!!: {self.role} is not permitted to SELECT from {table}!!!!"
             print(error_message)
             raise PermissionError(error_message)
         
-        #applies column restrictions depending on role
-        allowed_columns = self.get_allowed_columns(table)
+        group_by = list(group_by or [])
+        metrics = dict(metrics or {})
+        if not metrics:
+            raise ValueError("aggregate requires at least one metric")
         
-        #determine which columns to select and show
-        if allowed_columns == ["*"]: # no restriction columns
-            cols_to_select = "*" if not columns else ", ".join(columns)
-        else:
-            # in case of restrictions
-            if not columns:
-                # if no specific columns requested in the query, select all allowed columns
-                cols_to_select = ", ".join(allowed_columns)
+        #validate every referenced column and alias - they end up in the SQL as-is
+        select_parts = []
+        referenced_columns = list(group_by)
+        for col in group_by:
+            self._check_identifier(col)
+            select_parts.append(col)
+            
+        for alias, (function, column) in metrics.items():
+            self._check_identifier(alias)
+            function = function.upper()
+            if function not in AGGREGATE_FUNCTIONS:
+                raise ValueError(f"Unsupported aggregate function: {function}")
+            if column == "*":
+                # COUNT(*) only counts rows, it doesn't expose any column values
+                if function != "COUNT":
+                    raise ValueError(f"{function}(*) is not supported - only COUNT(*)")
             else:
-                # if specific columns queried for, filter for allowed columns and raise error if not permitted
-                filtered_columns = [col for col in columns if col in allowed_columns]     
-                if not filtered_columns:
-                    raise PermissionError(f"Requested columns not accesible for {self.role}")  
-                cols_to_select = ", ".join(filtered_columns)         
+                self._check_identifier(column)
+                referenced_columns.append(column)
+            select_parts.append(f"{function}({column}) AS {alias}")
+            
+        #unlike select, restricted columns are not silently dropped since that would change the grouping
+        allowed_columns = self.get_allowed_columns(table)
+        if allowed_columns != ["*"]:
+            denied_columns = [col for col in referenced_columns if col not in allowed_columns]
+            if denied_columns:
+                error_message = f"Access denied!! {self.role} cannot aggregate on columns {denied_columns} in {table}"
+                print(error_message)
+                raise PermissionError(error_message)
+            
+        #the condition may only filter on allowed columns too - else counting rows by a restricted column reveals it
+        self._check_condition_columns(table, condition)
+            
+        #the query runs on the table as a subquery with only the allowed columns and the row restriction applied
+        #(like select_join), so groups only cover permitted rows and nothing else of the table is in reach
+        where_clause = f" WHERE ({condition})" if condition else ""
+        group_clause = " GROUP BY " + ", ".join(group_by) if group_by else ""
+        order_clause = " ORDER BY " + ", ".join(group_by) if group_by else ""
+        limit_clause = f" LIMIT {int(limit)}" if limit is not None else ""
+        
+        # build final query
+        query = f"SELECT {', '.join(select_parts)} FROM {self._restricted_table(table)}{where_clause}{group_clause}{order_clause}{limit_clause}"
+        
+        timeout = self._statement_timeout(timeout)
+        query = add_server_timeout(query, timeout)
+        
+        # wait for a query slot (admission control), then run it under the statement timeout
+        with self._admitted(), time_limit(self, "AGGREGATE", table, query, timeout):
+            #log the access
+            log_database_access(self.username, self.role, "AGGREGATE", table, query)
+        
+            #connect to database if not already connected
+            if not self.connection:
+                self.connect()
+            
+            cursor = self.connection.cursor(dictionary=True)
+            try:
+                with tracer.span("execute"):
+                    cursor.execute(query)
+                with tracer.span("fetch") as span:
+                    results = cursor.fetchall()
+                    span.set("rows", len(results))
+                print(f"AGGREGATE query executed: {query}")
+                print(f"Retrieved {len(results)} summary rows")
+                return results
+            except Exception as e:
+                print(f"Error executing the following AGGREGATE query: {e}")
+                raise
+            finally:
+                cursor.close()
+            
+    # JOIN
+    
+    @traced
+    def select_join(self, tables, columns=None, condition=None, limit=None, join_type="INNER", timeout=None,
+                    memory_budget=None, over_budget=None):
+        """
+        Selects data from several related tables in one query (e.g. a customer's orders with their line items
+        and product names), instead of one select per table/row
+        
+        Every table gets its own permission check, column restrictions and row restrictions: each one is 
+        joined as a subquery that only contains the rows and columns the role may see, e.g.
+        (SELECT * FROM orders WHERE (customer_id = 1)) AS orders
+        
+        Arguments:
+                tables (list): the tables to join, e.g. ["orders", "order_items", "products"]
+                               each table is joined to the first table before it that it is related to
+                               (relationships in db_schema.py)
+                columns (dict): table -> list of columns to retrieve (default to None meaning all allowed columns
+                                of every table). Tables left out get all their allowed columns, tables that
+                                aren't joined are refused
+                condition (string): Additional WHERE clauses - refer to columns as table.column
+                limit (int): Maximum number of rows to return
+                join_type (string): "INNER" (default) or "LEFT"
+                timeout (float): max seconds the query may run (default to the role's statement_timeout, 0 for none)
+                memory_budget (int), over_budget (string): memory budget of the result like in select()
+                
+        Returns: 
+                list: the query result as a list of dicts with "table.column" keys (or a SpilledResult like in select())
+                
+        
+        Raises:
+                PermissionError: if the user doesn't have the neccessary permission for one of the tables
+                ValueError: if the tables aren't related or the arguments are invalid
+        """
+        
+        tables = list(tables)
+        columns = dict(columns or {})
+        join_type = join_type.upper()
+        if join_type not in ("INNER", "LEFT"):
+            raise ValueError(f"Unsupported join type: {join_type}")
+        if len(tables) < 2 or len(set(tables)) != len(tables):
+            raise ValueError("select_join needs at least two different tables")
+        unknown_tables = sorted(set(columns) - set(tables))
+        if unknown_tables:
+            raise ValueError(f"columns given for tables that aren't joined: {unknown_tables}")
+        
+        if not self.connection:
+            self.connect()
+            
+        select_parts = []
+        from_parts = []
+        for position, table in enumerate(tables):
+            self._check_identifier(table)
+            
+            #same table permission check as select for each table
+            if not self.has_table_permission(table, "SELECT"):
+                error_message = f"Access denied!!: {self.role} is not permitted to SELECT from {table}!!!!"
+                print(error_message)
+                raise PermissionError(error_message)
+            
+            allowed_columns = self.get_allowed_columns(table)
+            visible_columns = self._table_columns(table) if allowed_columns == ["*"] else allowed_columns
+            
+            #requested columns are filtered to the allowed ones like in select
+            requested = columns.get(table) or visible_columns
+            for col in requested:
+                self._check_identifier(col)
+            output_columns = [col for col in requested if col in visible_columns]
+            if not output_columns:
+                raise PermissionError(f"Requested columns of {table} not accesible for {self.role}")
+            select_parts += [f"{table}.{col} AS `{table}.{col}`" for col in output_columns]
+            
+            #the table as a subquery with its column and row restrictions applied
+            derived_table = self._restricted_table(table)
+            if position == 0:
+                from_parts.append(derived_table)
+                continue
                 
+            #join on the relationship with the first earlier table it is related to
+            for earlier in tables[:position]:
+                pairs = join_columns(table, earlier)
+                if pairs:
+                    break
+            else:
+                raise ValueError(f"{table} is not related to any of {tables[:position]} - see relationships in db_schema.py")
+            for own_col, other_col in pairs:
+                for join_table, join_col in ((table, own_col), (earlier, other_col)):
+                    if self.get_allowed_columns(join_table) != ["*"] and join_col not in self.get_allowed_columns(join_table):
+                        raise PermissionError(f"Access denied!! {self.role} cannot join on {join_table}.{join_col}")
+            on_clause = " AND ".join(f"{table}.{own_col} = {earlier}.{other_col}" for own_col, other_col in pairs)
+            from_parts.append(f"{join_type} JOIN {derived_table} ON {on_clause}")
+            
+        where_clause = f" WHERE ({condition})" if condition else ""
+        limit_clause = f" LIMIT {int(limit)}" if limit is not None else ""
+        
+        # build final query
+        query = f"SELECT {', '.join(select_parts)} FROM {' '.join(from_parts)}{where_clause}{limit_clause}"
+        
+        timeout = self._statement_timeout(timeout)
+        query = add_server_timeout(query, timeout)
+        table_names = ", ".join(tables)
+        budget = self._memory_budget(memory_budget, over_budget)
+        
+        # wait for a query slot (admission control), then run it under the statement timeout
+        with self._admitted(), time_limit(self, "JOIN", table_names, query, timeout):
+            #log the access
+            log_database_access(self.username, self.role, "JOIN", table_names, query)
+            
+            cursor = self.connection.cursor(dictionary=True)
+            try:
+                with tracer.span("execute"):
+                    cursor.execute(query)
+                with tracer.span("fetch") as span:
+                    results = fetch_within_budget(cursor, "dicts", *budget)
+                    span.set("rows", len(results))
+                print(f"JOIN query executed: {query}")
+                print(f"Retrieved {len(results)} rows")
+                return results
+            except Exception as e:
+                print(f"Error executing the following JOIN query: {e}")
+                raise
+            finally:
+                cursor.close()
                 
-        #next restriction are checked for/applied at row-level
+    def _restricted_table(self, table):
+        """
+        Returns the table for a FROM clause, as a subquery with only the role's allowed columns and rows, e.g.
+        (SELECT customer_id, first_name FROM customers WHERE (customer_id = 1)) AS customers
+        - or just the table when the role has no restriction on it
+        """
+        allowed_columns = self.get_allowed_columns(table)
         row_restriction = self.get_row_restriction(table)
+        if allowed_columns == ["*"] and not row_restriction:
+            return table
+        subquery_columns = "*" if allowed_columns == ["*"] else ", ".join(allowed_columns)
+        subquery_where = f" WHERE ({row_restriction})" if row_restriction else ""
+        return f"(SELECT {subquery_columns} FROM {table}{subquery_where}) AS {table}"
+    
+    def _check_condition_columns(self, table, condition):
+        """
+        Helper that refuses a condition naming a column of the table the role isn't allowed to see
+        (names inside quoted strings are values, not columns)
         
-        # do that by building a WHERE clause in sql
-        where_clauses = []
-        if condition:
-            where_clauses.append(f"({condition})")                
-        if row_restriction:
-            where_clauses.append(f"({row_restriction})")
+        Raises:
+                PermissionError: if the condition uses a restricted column
+        """
+        allowed_columns = self.get_allowed_columns(table)
+        if not condition or allowed_columns == ["*"]:
+            return
+        names = set(NAME_PATTERN.findall(STRING_LITERAL_PATTERN.sub("''", condition)))
+        denied_columns = sorted(names & (set(table_columns.get(table, [])) - set(allowed_columns)))
+        if denied_columns:
+            error_message = f"Access denied!! {self.role} cannot filter {table} on columns {denied_columns}"
+            print(error_message)
+            raise PermissionError(error_message)
+    
+    def _table_columns(self, table):
+        """
+        Returns the column names of a table (from table_columns in db_schema.py - nothing is queried)
+        
+        Raises:
+                ValueError: if the table isn't described in db_schema.py
+        """
+        if table not in table_columns:
+            raise ValueError(f"The columns of {table} are unknown - add them to table_columns in db_schema.py")
+        return table_columns[table]
             
-        where_clause = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
+    # KEY LOOKUPS
+    
+    @traced
+    def select_by_keys(self, table, key_column, keys, columns=None, condition=None, chunk_size=1000, 
+                       parallel=False, max_workers=None, as_dict=False, timeout=None):
+        """
+        Selects the rows for a (long) list of keys, e.g. thousands of product_ids, in a few IN (...) queries
+        instead of one select per key. The same table, column and row restrictions as select() apply to every chunk
         
-        limit_clause = f" LIMIT {limit}" if limit is not None else ""
+        The chunks run on connections from the shared connection pool - one after another, or in parallel
         
-        # build final query
-        query = f"SELECT {cols_to_select} FROM {table}{where_clause}{limit_clause}"
+        Arguments:
+                table (string): the table to be queried
+                key_column (string): the column the keys are matched against
+                keys (iterable): the key values (duplicates are looked up once)
+                columns (list): the specific columns to be retrieved (default to None meaning all allowed)
+                                key_column is always added
+                condition (string): Additional WHERE clauses
+                chunk_size (int): max number of keys per IN (...) list
+                parallel (bool): run the chunks in parallel on several pooled connections
+                max_workers (int): max chunks running at the same time when parallel (default to the pool size)
+                as_dict (bool): return {key: row} instead of a list - for unique key columns only
+                timeout (float): max seconds each chunk may run (default to the role's statement_timeout, 0 for none)
+                
+        Returns: 
+                list: the rows of all chunks as a list of dicts (or a dict keyed by key_column if as_dict)
+                
+        
+        Raises:
+                PermissionError: if the user doesn't have the neccessary permission for the operation or key_column
+                ValueError: if key_column or chunk_size is invalid, or the condition contains %s
+        """
+        
+        self._check_identifier(key_column)
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        
+        #the key column has to be readable for the role, else the lookup would reveal restricted data
+        allowed_columns = self.get_allowed_columns(table)
+        if allowed_columns != ["*"] and key_column not in allowed_columns:
+            error_message = f"Access denied!! {self.role} cannot look up {table} by {key_column}"
+            print(error_message)
+            raise PermissionError(error_message)
+        if columns and key_column not in columns:
+            columns = list(columns) + [key_column]
+            
+        keys = list(dict.fromkeys(keys))
+        chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+        
+        # the query gets parameters - the condition goes in unchanged, as long as it has no placeholder of its own
+        self._check_condition(condition)
+        extra_condition = f"({condition}) AND " if condition else ""
+        queries = []
+        for chunk in chunks:
+            placeholders = ", ".join(["%s"] * len(chunk))
+            queries.append(self._build_select_query(table, columns, f"{extra_condition}{key_column} IN ({placeholders})"))
+        if not queries:
+            # no keys - still check the permissions like any other select
+            self._build_select_query(table, columns, condition)
+            
+        timeout = self._statement_timeout(timeout)
+        
+        # parallel chunks run in worker threads - their spans still belong to this call's trace
+        trace = tracer.current()
         
-        #log the access
-        log_database_access(self.username, self.role, "SELECT", table, query)
+        def run_chunk(query, chunk):
+            query = add_server_timeout(query, timeout)
+            with tracer.joined(trace), self._admitted(), self.pooled_connection() as connection:
+                with time_limit(self, "SELECT_KEYS", table, query, timeout, connection):
+                    log_database_access(self.username, self.role, "SELECT_KEYS", table, f"{query} - {chunk}")
+                    cursor = connection.cursor(dictionary=True)
+                    try:
+                        with tracer.span("execute", keys=len(chunk)):
+                            cursor.execute(query, chunk)
+                        with tracer.span("fetch"):
+                            return cursor.fetchall()
+                    finally:
+                        cursor.close()
+                        
+        try:
+            if parallel and len(chunks) > 1:
+                # imported here since most programs never run chunks in parallel (keeps the import of this module fast)
+                from concurrent.futures import ThreadPoolExecutor
+                workers = min(len(chunks), max_workers or self.pool_size)
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    chunk_results = list(executor.map(run_chunk, queries, chunks))
+            else:
+                chunk_results = [run_chunk(query, chunk) for query, chunk in zip(queries, chunks)]
+        except Exception as e:
+            print(f"Error executing SELECT by keys on {table}: {e}")
+            raise
+            
+        results = [row for rows in chunk_results for row in rows]
+        print(f"SELECT by keys executed on {table}: {len(keys)} keys in {len(chunks)} chunk(s)")
+        print(f"Retrieved {len(results)} rows")
+        if as_dict:
+            return {row[key_column]: row for row in results}
+        return results
+            
+    # EXPORT
+    
+    @traced
+    def export(self, table, path, file_format="csv", columns=None, condition=None, rows_per_file=None, 
+               compress=False, batch_size=DEFAULT_BATCH_SIZE, progress=None, timeout=None):
+        """
+        Exports (role-filtered) data from a table to CSV or JSONL files, streaming the rows from the database
+        batch by batch so memory use stays constant however big the table is
+        
+        Uses the same security checks as select() and writes one audit record per export with the total row count
+        
+        Arguments:
+                table (string): the table to export
+                path (string): the output file (the base name when the output is split into parts)
+                file_format (string): "csv" or "jsonl"
+                columns (list): the specific columns to export (default to None meaning all allowed)
+                condition (string): Additional WHERE clauses
+                rows_per_file (int): split the output into files of at most this many rows (default to None meaning one file)
+                compress (bool): gzip the output files
+                batch_size (int): rows fetched from the database per round
+                progress (callable): called after every batch as progress(rows_written, files_written)
+                timeout (float): max seconds for the whole export (default to None - exports are long by nature,
+                                 so the role's statement_timeout isn't applied)
+                
+        Returns: 
+                dict: {"rows": total rows exported, "files": list of the files written}
+                
+        
+        Raises:
+                PermissionError: if the user doesn't have the neccessary permission for the operation
+                ValueError: if the file_format or rows_per_file is invalid
+        """
+        
+        # the writer validates the format options before anything is queried
+        writer = ChunkedFileWriter(path, file_format, rows_per_file, compress)
+        
+        query = self._build_select_query(table, columns, condition)
+        
+        # the slot is held for the whole export
+        with self._admitted(), time_limit(self, "EXPORT", table, query, timeout):
+            status = "failed"
+            try:
+                # closing() cleans up the stream right away if writing fails, not whenever it is garbage collected
+                with writer, closing(self._stream_query(query, batch_size)) as stream:
+                    column_names = None
+                    for column_names, rows in stream:
+                        writer.write_batch(column_names, rows)
+                        if progress:
+                            progress(writer.rows_written, len(writer.files))
+                    files = writer.close(column_names)
+                status = "completed"
+            except Exception as e:
+                print(f"Error exporting {table}: {e}")
+                raise
+            finally:
+                # one audit record for the whole export - also when it fails halfway
+                log_database_access(self.username, self.role, "EXPORT", table, 
+                                    f"{query} - {writer.rows_written} rows to {len(writer.files)} file(s) ({status})")
+            
+            print(f"EXPORT query executed: {query}")
+            print(f"Exported {writer.rows_written} rows to {len(files)} file(s)")
+            return {"rows": writer.rows_written, "files": files}
+    
+    def select_stream(self, table, columns=None, condition=None, limit=None, batch_size=DEFAULT_BATCH_SIZE, timeout=None):
+        """
+        Selects like select(), but hands the rows over batch by batch while they arrive from the server (unbuffered
+        cursor, like export()) - so a big result is never held in memory at once, e.g. in the query daemon
+        
+        The permissions are checked right away. The query slot is held until the rows are read to the end
+        (or the stream is closed)
+        
+        Arguments:
+                table, columns, condition, limit, timeout: same as select()
+                batch_size (int): rows fetched from the database per round
+                
+        Returns: 
+                generator: (column names, list of row tuples) per batch - at least once, with an empty list
+                           for an empty result. Close it when stopping early
+                
+        
+        Raises:
+                PermissionError: if the user doesn't have the neccessary permission for the operation
+                QueryTimeout: (while reading) if the query ran longer than the timeout
+        """
+        
+        query = self._build_select_query(table, columns, condition, limit)
+        timeout = self._statement_timeout(timeout)
+        query = add_server_timeout(query, timeout)
+        
+        def stream():
+            with self._admitted(), time_limit(self, "SELECT", table, query, timeout):
+                log_database_access(self.username, self.role, "SELECT", table, query)
+                with closing(self._stream_query(query, batch_size)) as batches:
+                    yield from batches
+            print(f"SELECT query streamed: {query}")
+        
+        return stream()
+    
+    # SYNC
+    
+    @traced
+    def select_changes(self, table, since=None, columns=None, condition=None, timeout=None):
+        """
+        Incremental select for keeping a client side copy of a table up to date (e.g. POS terminals caching
+        products, stocks and their store's orders). Returns only what changed after the watermark "since",
+        with the same table, column and row restrictions as select()
+        
+        How changes are found depends on change_tracking in db_schema.py:
+        - "sequence" tables: through the change_log table (see change_tracking.sql) - includes deletions
+        - "column" tables: through a last-updated column - deletions can't be detected
+        
+        Arguments:
+                table (string): the table to sync
+                since: the watermark returned by the previous call (default to None meaning a full load)
+                columns (list): the specific columns to be retrieved (default to None meaning all allowed)
+                                the primary key columns are always added
+                condition (string): Additional WHERE clauses
+                timeout (float): max seconds the queries may run (default to the role's statement_timeout, 0 for none)
+                
+        Returns: 
+                dict: {"rows": list of dicts added or changed since the watermark,
+                       "deleted": list of dicts with the primary keys of the rows deleted since the watermark,
+                       "watermark": the value to pass as since next time}
+                
+        
+        Raises:
+                PermissionError: if the user doesn't have the neccessary permission for the operation
+                ValueError: if the table has no change tracking configured, or the condition contains %s
+        """
+        
+        tracking = change_tracking.get(table)
+        if not tracking:
+            raise ValueError(f"{table} has no change tracking configured - see change_tracking in db_schema.py")
+        
+        keys = primary_keys[table]
+        if columns:
+            # the client needs the keys to match changed rows with its cached copy
+            columns = list(columns) + [key for key in keys if key not in columns]
+            
+        if tracking["mode"] == "column":
+            return self._select_changes_by_column(table, tracking["column"], since, columns, condition, timeout)
+        
+        # check the permissions (and build the full load query) before touching change_log
+        query = self._build_select_query(table, columns, condition)
+        row_restriction = self.get_row_restriction(table)
+        timeout = self._statement_timeout(timeout)
+        key_list = ", ".join(keys)
+        
+        with self._admitted(), time_limit(self, "SYNC", table, query, timeout):
+            if not self.connection:
+                self.connect()
+                
+            # a fresh snapshot - otherwise repeated polls would keep reading the one from the first call
+            self.connection.rollback()
+            cursor = self.connection.cursor(dictionary=True)
+            try:
+                # the new watermark is read first, in the same snapshot as the rows - anything changing while
+                # we read gets delivered (again) next time
+                if since is None:
+                    # a full load starts from the last change that has surely settled
+                    cursor.execute(f"SELECT change_seq FROM {CHANGE_LOG_TABLE} WHERE changed_at < NOW(6) - INTERVAL %s SECOND "
+                                   f"ORDER BY change_seq DESC LIMIT 1", [self.sync_gap_timeout])
+                    settled = cursor.fetchall()
+                    base = settled[0]["change_seq"] if settled else 0
+                else:
+                    base = int(since)
+                # every table's changes, since they share one sequence - a gap can be in any of them
+                cursor.execute(f"SELECT change_seq, TIMESTAMPDIFF(MICROSECOND, changed_at, NOW(6)) / 1000000 AS age "
+                               f"FROM {CHANGE_LOG_TABLE} WHERE change_seq > %s ORDER BY change_seq", [base])
+                watermark = settled_watermark(base, [(row["change_seq"], float(row["age"])) for row in cursor.fetchall()],
+                                              self.sync_gap_timeout)
+                
+                deleted = []
+                if since is not None:
+                    change_range = f"table_name = '{table}' AND change_seq > {int(since)} AND change_seq <= {int(watermark)}"
+                    changed = f"({key_list}) IN (SELECT {key_list} FROM {CHANGE_LOG_TABLE} WHERE {change_range})"
+                    query = self._build_select_query(table, columns, f"({condition}) AND {changed}" if condition else changed)
+                    
+                    # deletions - change_log keeps the columns used by the row restrictions, so they apply here too
+                    deleted_query = f"SELECT DISTINCT {key_list} FROM {CHANGE_LOG_TABLE} WHERE {change_range} AND operation = 'D'"
+                    if row_restriction:
+                        deleted_query += f" AND ({row_restriction})"
+                    cursor.execute(deleted_query)
+                    deleted = cursor.fetchall()
+                    
+                log_database_access(self.username, self.role, "SYNC", table, f"{query} - since {since}")
+                cursor.execute(query)
+                rows = cursor.fetchall()
+                
+                # a row deleted and then added again is a change, not a deletion
+                current = {tuple(row[key] for key in keys) for row in rows}
+                deleted = [row for row in deleted if tuple(row[key] for key in keys) not in current]
+                
+                print(f"SYNC query executed: {query}")
+                print(f"Retrieved {len(rows)} changed rows and {len(deleted)} deletions since {since}")
+                return {"rows": rows, "deleted": deleted, "watermark": watermark}
+            except Exception as e:
+                print(f"Error executing the following SYNC query: {e}")
+                raise
+            finally:
+                cursor.close()
+                # nothing was written - ending the read transaction lets the next poll see new changes
+                self.connection.rollback()
+    
+    def _select_changes_by_column(self, table, column, since, columns, condition, timeout):
+        """
+        select_changes() for tables with a last-updated column - the watermark is the highest value seen
+        """
+        allowed_columns = self.get_allowed_columns(table)
+        if allowed_columns != ["*"] and column not in allowed_columns:
+            raise PermissionError(f"Access denied!! {self.role} cannot read {column} in {table}, which is needed to sync it")
+        if columns and column not in columns:
+            columns = columns + [column]
+            
+        params = []
+        if since is not None:
+            # the query gets parameters now - the condition goes in unchanged, as long as it has no placeholder of its own
+            self._check_condition(condition)
+            changed = f"{column} > %s"
+            condition = f"({condition}) AND {changed}" if condition else changed
+            params.append(since)
+        query = self._build_select_query(table, columns, condition)
+        timeout = self._statement_timeout(timeout)
+        
+        with self._admitted(), time_limit(self, "SYNC", table, query, timeout):
+            log_database_access(self.username, self.role, "SYNC", table, f"{query} - since {since}")
+            
+            if not self.connection:
+                self.connect()
+            
+            # a fresh snapshot - otherwise repeated polls would keep reading the one from the first call
+            self.connection.rollback()
+            cursor = self.connection.cursor(dictionary=True)
+            try:
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+                watermark = max((row[column] for row in rows if row[column] is not None), default=since)
+                print(f"SYNC query executed: {query}")
+                print(f"Retrieved {len(rows)} changed rows since {since}")
+                return {"rows": rows, "deleted": [], "watermark": watermark}
+            except Exception as e:
+                print(f"Error executing the following SYNC query: {e}")
+                raise
+            finally:
+                cursor.close()
+                self.connection.rollback()
+            
+    def _stream_query(self, query, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Generator that executes a query on an unbuffered cursor and yields (column names, batch of row tuples)
+        so the rows are streamed from the server instead of being loaded all at once
+        Always yields at least once (with an empty batch for an empty result) so callers get the column names
+        
+        Note: nothing is logged here - callers are responsible for the audit record
+        """
         
         #connect to database if not already connected
         if not self.connection:
             self.connect()
             
-        #create cursor and execute the query built
-        cursor = self.connection.cursor(dictionary=True)
+        cursor = self.connection.cursor()
+        executed = False
+        finished = False
         try:
-            cursor.execute(query)
-            results = cursor.fetchall()
-            print(f"SELECT query executed: {query}")
-            print(f"Retrieved {len(results)} rows")
-            return results
-        except Exception as e:
-            print(f"Error executing the following SELECT query: {e}")
-            raise
+            with tracer.span("execute"):
+                cursor.execute(query)
+            executed = True
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchmany(batch_size)
+            yield columns, rows
+            while rows:
+                rows = cursor.fetchmany(batch_size)
+                if rows:
+                    yield columns, rows
+            finished = True
         finally:
+            if executed and not finished:
+                # stopped halfway (writer error, timeout, caller stopped reading) - the unread rows have to be
+                # read off first, else closing the cursor raises "Unread result found" instead of the real error
+                self._abandon_stream(cursor, batch_size)
+            else:
+                cursor.close()
+    
+    def _abandon_stream(self, cursor, batch_size):
+        """
+        Cleans up an unbuffered cursor whose result wasn't read to the end, without raising
+        If the rest can't be read (e.g. the query was killed), the connection is dropped - the next call reconnects
+        """
+        try:
+            while cursor.fetchmany(batch_size):
+                pass
             cursor.close()
+        except Exception as e:
+            print(f"Dropping the connection after an interrupted stream: {e}")
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+            
+    @contextmanager
+    def _admitted(self):
+        """
+        Context manager holding a query slot for this user and role while a query runs (see admission_control.py)
+        
+        Raises:
+                AdmissionRejected: if the role/user is over its limits for longer than its queue_timeout
+        """
+        with ExitStack() as stack:
+            # the span only covers the wait for the slot, not the query run with it
+            with tracer.span("admission"):
+                stack.enter_context(self.admission.admit(self.role, self.username))
+            yield
+    
+    def _statement_timeout(self, timeout=None):
+        """
+        Resolves the statement timeout for a query: the per call timeout if given, else the role's default
+        (statement_timeout in role_limits). 0 means no timeout
+        """
+        if timeout is None:
+            timeout = role_limits.get(self.role, {}).get("statement_timeout")
+        return timeout or None
+    
+    def _memory_budget(self, memory_budget=None, over_budget=None):
+        """
+        Resolves the memory budget of a result: the per call values if given, else the role's defaults
+        (result_memory_budget and over_budget in role_limits)
+        
+        Returns:
+                tuple: (max bytes or None for no limit, "reject" or "spill")
+        """
+        limits = role_limits.get(self.role, {})
+        if memory_budget is None:
+            memory_budget = limits.get("result_memory_budget")
+        over_budget = over_budget or limits.get("over_budget", "reject")
+        if over_budget not in OVER_BUDGET_ACTIONS:
+            raise ValueError(f"Unknown over_budget action: {over_budget!r} - must be one of {OVER_BUDGET_ACTIONS}")
+        return (memory_budget or None, over_budget)
+    
+    def _summary_keys(self, table, where, params=None):
+        """
+        Finds the store summary rows a write to table with this WHERE clause (without WHERE) is about to touch
+        
+        Returns:
+                SummaryKeys, or None if the table isn't summarized (or the keys couldn't be read)
+        """
+        if not (self.maintain_summaries and maintains(table)):
+            return None
+        try:
+            return keys_for_condition(self.connection, table, where, params)
+        except Exception as e:
+            print(f"Warning: could not read the store summary rows affected by the {table} change: {e}")
+            return None
+    
+    def _refresh_summaries(self, table, before=None, rows=None, data=None):
+        """
+        Brings the store summary tables up to date after a committed write (see store_summaries.py)
+        
+        Arguments:
+                table (string): the table written to
+                before (SummaryKeys): the summary rows of the changed rows before the write (from _summary_keys())
+                rows (list): rows inserted, as dicts
+                data (dict): the values set by an update
+        
+        A failed refresh doesn't undo the write - it is reported, and `python store_summaries.py rebuild` repairs it
+        """
+        if not (self.maintain_summaries and maintains(table)):
+            return
+        try:
+            keys = before or SummaryKeys()
+            if rows:
+                keys = keys | keys_for_rows(self.connection, table, rows)
+            if data and before:
+                keys = keys | keys_after_update(self.connection, table, data, before)
+            if keys:
+                with tracer.span("summaries", store_days=len(keys.sales), stores=len(keys.stores)):
+                    refresh_summaries(self.connection, keys)
+        except Exception as e:
+            print(f"Warning: could not refresh the store summaries after the {table} change "
+                  f"(run store_summaries.py rebuild): {e}")
+    
+    def _check_identifier(self, name):
+        """
+        Helper that makes sure a column or alias name is a plain identifier before it is put into a query
+        
+        Raises:
+                ValueError: if the name contains anything but letters, digits and underscores
+        """
+        if not isinstance(name, str) or not IDENTIFIER_PATTERN.match(name):
+            raise ValueError(f"Invalid column or alias name: {name!r}")
+            
+    def _check_condition(self, condition):
+        """
+        Helper for queries that combine a caller's condition with parameters: mysql.connector fills in every %s
+        of such a query (and leaves %% as it is), so the condition itself must not contain one
+        
+        Raises:
+                ValueError: if the condition contains %s
+        """
+        if condition and "%s" in condition:
+            raise ValueError(f"The condition can't contain %s here - write the value into it instead: {condition!r}")
             
     # INSERT
     
-    def insert(self, table, data): 
+    @traced
+    def insert(self, table, data, timeout=None): 
         """
         Inserts data into a table if permitted
         
         Arguments:
                 table (string): the table to have data inserted
                 data (dict): The data to be inserted, organised as column-value pairs
+                timeout (float): max seconds the query may run (default to the role's statement_timeout, 0 for none)
                 
         Returns: 
                 int: ID of the newly inserted row
@@ -112,6 +1042,7 @@ class SecureOperations(SecureDatabaseAccess):
         
         Raises:
                 PermissionError: if the user doesn't have the neccessary permission for the operation
+                QueryTimeout: if the query ran longer than the timeout
         """
         
         # first check if user has permission to INSERT into the table
@@ -136,32 +1067,174 @@ class SecureOperations(SecureDatabaseAccess):
         
         query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
         
-        #logging it
-        log_database_access(self.username, self.role, "INSERT", table, f"{query} - {values}")
+        timeout = self._statement_timeout(timeout)
+        
+        # wait for a query slot (admission control), then run it under the statement timeout
+        with self._admitted(), time_limit(self, "INSERT", table, query, timeout):
+            #logging it
+            log_database_access(self.username, self.role, "INSERT", table, f"{query} - {values}")
+        
+            # Connect to the database if not already connected
+            if not self.connection:
+                self.connect()
+            
+            # Execute the query
+            cursor = self.connection.cursor()
+            try:
+                with tracer.span("execute"):
+                    cursor.execute(query, values)
+                    self.connection.commit()
+                last_id = cursor.lastrowid
+                self._refresh_summaries(table, rows=[data])
+                print(f"INSERT query execute: {query}")
+                print(f"Inserted row with ID: {last_id}")
+            
+            except Exception as e:
+                self.connection.rollback()
+                print(f"Error when executing INSERT query: {e}")
+                raise
+            finally:
+                cursor.close()
+    
+    @traced
+    def upsert_many(self, table, rows, key_columns=None, chunk_size=500, progress=None, timeout=None):
+        """
+        Inserts rows, or updates them where a row with the same key already exists - in batched
+        INSERT ... ON DUPLICATE KEY UPDATE statements with one commit per batch (e.g. the nightly stock sync,
+        instead of an update() plus an insert() fallback per item)
+        
+        The permissions and the context columns are checked once for the whole call. Existing rows are only
+        updated where the role's row restriction allows it. The new values are referred to through a row alias
+        (VALUES ... AS new ON DUPLICATE KEY UPDATE col = new.col), which needs MySQL 8.0.19 or later
+        
+        The inserted/updated counts come from the keys that already existed, so key_columns must be the key
+        MySQL detects the duplicates on: for tables in db_schema.py only their primary key is accepted (a table
+        with other unique keys could hit those instead and the counts would be wrong)
+        
+        Arguments:
+                table (string): the table to write to
+                rows (list): the rows as dicts of column-value pairs, all with the same columns
+                key_columns (list): the columns of the primary or unique key that decides insert or update
+                                    (default the table's primary key from db_schema.py, which is the only
+                                    key accepted for the tables described there)
+                chunk_size (int): max rows per statement
+                progress (callable): called after every batch with a dict of chunk, inserted and updated
+                timeout (float): max seconds each batch may run (default to the role's statement_timeout, 0 for none)
+                
+        Returns: 
+                dict: {"chunks": number of batches, "inserted": rows inserted, "updated": rows updated,
+                       "per_chunk": list of (inserted, updated) per batch}
+                
+        
+        Raises:
+                PermissionError: if the role may not INSERT and UPDATE the table, a row is outside the user's
+                                 context or an existing row is outside the row restriction
+                ValueError: for missing key columns, key columns that aren't the table's primary key,
+                            or rows with different columns
+                QueryTimeout: if a batch ran longer than the timeout
+        """
+        
+        # an upsert both inserts and updates, so it needs both permissions
+        for action in ("INSERT", "UPDATE"):
+            if not self.has_table_permission(table, action):
+                error_message= f"Access denied!! {self.role} not permitted to {action} {table} (needed for UPSERT)"
+                print(error_message)
+                raise PermissionError(error_message)
+        
+        rows = list(rows)
+        if not rows:
+            return {"chunks": 0, "inserted": 0, "updated": 0, "per_chunk": []}
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        
+        key_columns = list(key_columns or primary_keys.get(table) or [])
+        if not key_columns:
+            raise ValueError(f"{table} has no known primary key - pass key_columns or see primary_keys in db_schema.py")
+        if table in primary_keys and sorted(key_columns) != sorted(primary_keys[table]):
+            raise ValueError(f"key_columns {key_columns} must be the primary key of {table}: {primary_keys[table]}")
+        columns = list(rows[0].keys())
+        for col in columns:
+            self._check_identifier(col)
+        missing = [col for col in key_columns if col not in columns]
+        if missing:
+            raise ValueError(f"UPSERT rows must contain the key columns {missing}")
+        if any(row.keys() != rows[0].keys() for row in rows):
+            raise ValueError("All rows of an UPSERT must have the same columns")
+        
+        # same context rule as insert() - checked once for all rows
+        context_columns = {"store_id", "customer_id", "staff_id"}
+        for col in context_columns.intersection(columns):
+            context_value = self.context.get(col)
+            if context_value is None:
+                continue
+            wrong = {row[col] for row in rows if row[col] != context_value}
+            if wrong:
+                error_message = f"Access denied!! Current user cannot upsert {col}={sorted(wrong, key=str)[0]} - must be {context_value}"
+                print(error_message)
+                raise PermissionError(error_message)
+        
+        update_columns = [col for col in columns if col not in key_columns]
+        # nothing to change on existing rows - assigning a key column to itself makes them a no-op
+        update_clause = ", ".join(f"{col} = new.{col}" for col in (update_columns or key_columns[:1]))
+        key_list = ", ".join(key_columns)
+        key_tuple = f"({key_list})" if len(key_columns) > 1 else key_list
+        key_placeholders = "(" + ", ".join(["%s"] * len(key_columns)) + ")" if len(key_columns) > 1 else "%s"
+        row_placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        row_restriction = self.get_row_restriction(table)
+        visible = f"({row_restriction})" if row_restriction else "1"
+        timeout = self._statement_timeout(timeout)
         
-        # Connect to the database if not already connected
         if not self.connection:
             self.connect()
+        
+        per_chunk = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            keys = list(dict.fromkeys(tuple(row[col] for col in key_columns) for row in chunk))
+            key_params = [value for key in keys for value in key]
+            key_where = f"{key_tuple} IN ({', '.join([key_placeholders] * len(keys))})"
             
-        # Execute the query
-        cursor = self.connection.cursor()
-        try:
-            cursor.execute(query, values)
-            self.connection.commit()
-            last_id = cursor.lastrowid
-            print(f"INSERT query execute: {query}")
-            print(f"Inserted row with ID: {last_id}")
+            query = (f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([row_placeholders] * len(chunk))} "
+                     f"AS new ON DUPLICATE KEY UPDATE {update_clause}")
+            params = [row[col] for row in chunk for col in columns]
             
-        except Exception as e:
-            self.connection.rollback()
-            print(f"Error when executing INSERT query: {e}")
-            raise
-        finally:
-            cursor.close()
+            with self._admitted(), time_limit(self, "UPSERT", table, query, timeout):
+                log_database_access(self.username, self.role, "UPSERT", table, f"{query} - {len(chunk)} rows")
+                summary_keys = self._summary_keys(table, key_where, key_params)
+                cursor = self.connection.cursor()
+                try:
+                    # the rows that already exist (locked until the commit) - those are updated, the rest inserted
+                    cursor.execute(f"SELECT {key_list}, {visible} FROM {table} WHERE {key_where} FOR UPDATE", key_params)
+                    existing = cursor.fetchall()
+                    if not all(row[-1] for row in existing):
+                        raise PermissionError(f"Access denied!! {self.role} cannot update existing {table} rows outside {row_restriction}")
+                    with tracer.span("execute", rows=len(chunk)):
+                        cursor.execute(query, params)
+                        self.connection.commit()
+                    self._refresh_summaries(table, summary_keys, rows=chunk)
+                except Exception as e:
+                    self.connection.rollback()
+                    print(f"Error executing UPSERT chunk {len(per_chunk) + 1} ({start} rows done before it): {e}")
+                    raise
+                finally:
+                    cursor.close()
+            
+            updated = len(existing)
+            inserted = len(keys) - updated
+            per_chunk.append((inserted, updated))
+            print(f"UPSERT chunk {len(per_chunk)}: {inserted} inserted, {updated} updated")
+            if progress:
+                progress({"chunk": len(per_chunk), "inserted": inserted, "updated": updated})
+        
+        result = {"chunks": len(per_chunk), "inserted": sum(i for i, _ in per_chunk),
+                  "updated": sum(u for _, u in per_chunk), "per_chunk": per_chunk}
+        print(f"UPSERT done: {result['inserted']} inserted, {result['updated']} updated in {result['chunks']} chunk(s)")
+        return result
             
     #UPDATE
     
-    def update(self, table, data, condition): 
+    @traced
+    def update(self, table, data, condition, timeout=None): 
         
         """
         Updates data inside a table if permitted
@@ -170,6 +1243,7 @@ class SecureOperations(SecureDatabaseAccess):
                 table (string): the table to update
                 data (dict): The data to be updated, organised as column-value pairs
                 condition (string): the WHERE condition
+                timeout (float): max seconds the query may run (default to the role's statement_timeout, 0 for none)
                 
         Returns: 
                 int: numbers of rows updated
@@ -178,6 +1252,7 @@ class SecureOperations(SecureDatabaseAccess):
         Raises:
                 PermissionError: if the user doesn't have the neccessary permission for the operation
                 ValueError: if no condition is provided
+                QueryTimeout: if the query ran longer than the timeout
         """
         
         # again, check if user has permission for this operation - update
@@ -207,38 +1282,49 @@ class SecureOperations(SecureDatabaseAccess):
         #building the final query...:
         query = f"UPDATE {table} SET {set_clause}{where_clause}"
         
-        #log it
-        log_database_access(self.username, self.role, 'UPDATE', table, f"{query} - {values}")
+        timeout = self._statement_timeout(timeout)
         
-        # Connect to the database if not already connected
-        if not self.connection:
-            self.connect()
+        # wait for a query slot (admission control), then run it under the statement timeout
+        with self._admitted(), time_limit(self, "UPDATE", table, query, timeout):
+            #log it
+            log_database_access(self.username, self.role, 'UPDATE', table, f"{query} - {values}")
+        
+            # Connect to the database if not already connected
+            if not self.connection:
+                self.connect()
             
-        # Execute the query
-        cursor = self.connection.cursor()
-        try:
-            cursor.execute(query, values)
-            self.connection.commit()
-            rows_affected = cursor.rowcount
-            print(f"UPDATE query executed: {query}")
-            print(f"Updated {rows_affected} rows")
-            return rows_affected
-        except Exception as e:
-            self.connection.rollback()
-            print(f"Error when executing UPDATE query: {e}")
-            raise
-        finally:
-            cursor.close()
+            # the summary rows of the rows about to change (for the store summaries)
+            summary_keys = self._summary_keys(table, " AND ".join(where_clauses))
+            
+            # Execute the query
+            cursor = self.connection.cursor()
+            try:
+                with tracer.span("execute"):
+                    cursor.execute(query, values)
+                    self.connection.commit()
+                rows_affected = cursor.rowcount
+                self._refresh_summaries(table, summary_keys, data=data)
+                print(f"UPDATE query executed: {query}")
+                print(f"Updated {rows_affected} rows")
+                return rows_affected
+            except Exception as e:
+                self.connection.rollback()
+                print(f"Error when executing UPDATE query: {e}")
+                raise
+            finally:
+                cursor.close()
             
     #DELETE
     
-    def delete(self, table, condition):
+    @traced
+    def delete(self, table, condition, timeout=None):
         """
         Deletes data inside a table if permitted
         
         Arguments:
                 table (string): the table to delete data from
                 condition (string): the WHERE condition
+                timeout (float): max seconds the query may run (default to the role's statement_timeout, 0 for none)
                 
         Returns: 
                 int: numbers of rows updated
@@ -247,6 +1333,7 @@ class SecureOperations(SecureDatabaseAccess):
         Raises:
                 PermissionError: if the user doesn't have the neccessary permission for the operation
                 ValueError: if no condition is provided
+                QueryTimeout: if the query ran longer than the timeout
         """
         # check if the user has permission to DELETE from this table
         if not self.has_table_permission(table, 'DELETE'):
@@ -271,25 +1358,193 @@ class SecureOperations(SecureDatabaseAccess):
         # Build the final query
         query = f"DELETE FROM {table}{where_clause}"
         
-        # Log the access
-        log_database_access(self.username, self.role, 'DELETE', table, query)
+        timeout = self._statement_timeout(timeout)
+        
+        # wait for a query slot (admission control), then run it under the statement timeout
+        with self._admitted(), time_limit(self, "DELETE", table, query, timeout):
+            # Log the access
+            log_database_access(self.username, self.role, 'DELETE', table, query)
+        
+            # Connect to the database if not already connected
+            if not self.connection:
+                self.connect()
+            
+            # the summary rows of the rows about to be deleted (for the store summaries)
+            summary_keys = self._summary_keys(table, " AND ".join(where_clauses))
+            
+            # Execute the query
+            cursor = self.connection.cursor()
+            try:
+                with tracer.span("execute"):
+                    cursor.execute(query)
+                    self.connection.commit()
+                rows_affected = cursor.rowcount
+                self._refresh_summaries(table, summary_keys)
+                print(f"DELETE query executed: {query}")
+                print(f"Deleted {rows_affected} rows")
+                return rows_affected
+            except Exception as e:
+                self.connection.rollback()
+                print(f"Error executing DELETE query: {e}")
+                raise
+            finally:
+                cursor.close()                
+    # CHUNKED UPDATE/DELETE
+    
+    @traced
+    def update_chunked(self, table, data, condition, chunk_size=1000, sleep=0.0, progress=None, resume_from=None, timeout=None):
+        """
+        Updates data inside a table like update(), but in batches of at most chunk_size rows with a commit
+        (and an optional pause) after every batch - so a big change doesn't hold its locks for a long time
+        
+        The rows are worked through in primary key order. The row restriction is applied to every batch
+        
+        Arguments:
+                table (string): the table to update
+                data (dict): The data to be updated, organised as column-value pairs
+                condition (string): the WHERE condition
+                chunk_size (int): max rows per batch
+                sleep (float): seconds to pause between batches (lets replication and other queries catch up)
+                progress (callable): called after every batch with a dict of chunks, rows and last_key
+                resume_from (tuple): the last_key of an interrupted run - continues after that key
+                timeout (float): max seconds each batch may run (default to the role's statement_timeout, 0 for none)
+                
+        Returns: 
+                dict: {"chunks": number of batches, "rows": rows updated, "last_key": primary key of the last row done}
+                
+        
+        Raises:
+                PermissionError: if the user doesn't have the neccessary permission for the operation
+                ValueError: if no condition is provided, it contains %s, or the table has no known primary key
+        """
+        
+        if not self.has_table_permission(table, "UPDATE"):
+            error_message= f"Access denied!! {self.role} not permitted to UPDATE {table}"
+            print(error_message)
+            raise PermissionError(error_message)
+        
+        if not condition:
+            raise ValueError("UPDATE operation requires a condition argument!!")
+        
+        set_clause = ", ".join([f"{col} = %s" for col in data.keys()])
+        return self._run_chunked("UPDATE", table, f"UPDATE {table} SET {set_clause}", list(data.values()),
+                                 condition, chunk_size, sleep, progress, resume_from, timeout, data=data)
+    
+    @traced
+    def delete_chunked(self, table, condition, chunk_size=1000, sleep=0.0, progress=None, resume_from=None, timeout=None):
+        """
+        Deletes data inside a table like delete(), but in batches of at most chunk_size rows with a commit
+        (and an optional pause) after every batch - e.g. for purging old orders
+        
+        Arguments:
+                same as update_chunked() (without data)
+                
+        Returns: 
+                dict: {"chunks": number of batches, "rows": rows deleted, "last_key": primary key of the last row done}
+                
+        
+        Raises:
+                PermissionError: if the user doesn't have the neccessary permission for the operation
+                ValueError: if no condition is provided, it contains %s, or the table has no known primary key
+        """
+        
+        if not self.has_table_permission(table, 'DELETE'):
+            error_msg = f"Access denied: {self.role} cannot DELETE from {table}"
+            print(error_msg)
+            raise PermissionError(error_msg)
+        
+        if not condition:
+            raise ValueError("DELETE requires a condition")
+        
+        return self._run_chunked("DELETE", table, f"DELETE FROM {table}", [],
+                                 condition, chunk_size, sleep, progress, resume_from, timeout)
+    
+    def _run_chunked(self, action, table, statement, values, condition, chunk_size, sleep, progress, resume_from, timeout, data=None):
+        """
+        Shared batching loop of update_chunked() and delete_chunked()
+        
+        Each round reads the primary keys of the next chunk_size matching rows (after the last key done), 
+        then runs the statement for exactly those keys - with the condition and row restriction repeated, 
+        so rows that changed in between are still checked - and commits
+        """
+        
+        keys = primary_keys.get(table)
+        if not keys:
+            raise ValueError(f"{table} has no known primary key - see primary_keys in db_schema.py")
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        
+        row_restriction = self.get_row_restriction(table)
+        where_clauses = [f"({condition})"]
+        if row_restriction:
+            where_clauses.append(f"({row_restriction})")
+        where_clause = " AND ".join(where_clauses)
+        self._check_condition(where_clause)
+        
+        key_list = ", ".join(keys)
+        key_tuple = f"({key_list})" if len(keys) > 1 else key_list
+        key_placeholders = "(" + ", ".join(["%s"] * len(keys)) + ")" if len(keys) > 1 else "%s"
+        timeout = self._statement_timeout(timeout)
+        
+        last_key = tuple(resume_from) if resume_from is not None else None
+        chunks = 0
+        total_rows = 0
         
-        # Connect to the database if not already connected
         if not self.connection:
             self.connect()
             
-        # Execute the query
-        cursor = self.connection.cursor()
-        try:
-            cursor.execute(query)
-            self.connection.commit()
-            rows_affected = cursor.rowcount
-            print(f"DELETE query executed: {query}")
-            print(f"Deleted {rows_affected} rows")
-            return rows_affected
-        except Exception as e:
-            self.connection.rollback()
-            print(f"Error executing DELETE query: {e}")
-            raise
-        finally:
-            cursor.close()
\ No newline at end of file
+        while True:
+            #the next batch of keys, in primary key order after the last one done
+            select_query = f"SELECT {key_list} FROM {table} WHERE {where_clause}"
+            select_params = []
+            if last_key is not None:
+                select_query += f" AND {key_tuple} > {key_placeholders}"
+                select_params = list(last_key)
+            select_query += f" ORDER BY {key_list} LIMIT {int(chunk_size)}"
+            
+            with self._admitted(), time_limit(self, action, table, select_query, timeout):
+                cursor = self.connection.cursor()
+                try:
+                    cursor.execute(select_query, select_params)
+                    batch = [tuple(row) for row in cursor.fetchall()]
+                finally:
+                    cursor.close()
+            if not batch:
+                break
+            
+            in_list = ", ".join([key_placeholders] * len(batch))
+            batch_where = f"{key_tuple} IN ({in_list}) AND {where_clause}"
+            query = f"{statement} WHERE {batch_where}"
+            key_params = [value for key in batch for value in key]
+            params = values + key_params
+            
+            with self._admitted(), time_limit(self, action, table, query, timeout):
+                log_database_access(self.username, self.role, action, table, f"{query} - {params}")
+                summary_keys = self._summary_keys(table, batch_where, key_params)
+                cursor = self.connection.cursor()
+                try:
+                    cursor.execute(query, params)
+                    self.connection.commit()
+                    rows_affected = cursor.rowcount
+                    self._refresh_summaries(table, summary_keys, data=data)
+                except Exception as e:
+                    self.connection.rollback()
+                    print(f"Error executing chunked {action} query (resume from {last_key}): {e}")
+                    raise
+                finally:
+                    cursor.close()
+                    
+            chunks += 1
+            total_rows += rows_affected
+            last_key = batch[-1]
+            print(f"{action} chunk {chunks}: {rows_affected} rows (last key {last_key})")
+            if progress:
+                progress({"chunks": chunks, "rows": total_rows, "last_key": last_key})
+            
+            if len(batch) < chunk_size:
+                break
+            if sleep:
+                time.sleep(sleep)
+                
+        print(f"Chunked {action} done: {total_rows} rows in {chunks} chunk(s)")
+        return {"chunks": chunks, "rows": total_rows, "last_key": last_key}
@@ -0,0 +1,103 @@
+import threading
+
+"""
+Single-flight coalescing of identical concurrent queries
+
+When a store opens, dozens of terminals run the same select on products or stocks at the same moment.
+With single flight, the first call (the leader) runs the query and every identical call arriving while it
+is still running (a follower) waits for it and gets the same result, instead of sending the query again.
+
+Calls are only identical if they have the same key - SecureOperations uses the final SQL (with the row
+restrictions already filled in), the result format, the memory budget and the role, so results are never
+shared across roles or store/customer restrictions - but are shared by every user the restriction treats alike.
+Nothing is cached: once the leader is done, the next call runs the query again.
+"""
+
+
+class _Call:
+    """
+    One in-flight execution and the result/error the waiting followers get
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def run(self, key, function, label=None, copy=None):
+        """
+        Runs function() unless an identical call (same key) is already running, in which case it waits
+        for that one and returns its result (or raises its error)
+
+        Arguments:
+                key: hashable identity of the call
+                function (callable): runs the query and returns its result
+                label (string): name the call is counted under in metrics(), e.g. the table
+                copy (callable): makes a private copy of a result - when a result is shared, every caller
+                                 (the leader too) gets its own copy so none of them sees another's changes
+
+        Returns:
+                tuple: (result, shared) - shared is True if the result came from another call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+            counts = self._metrics.setdefault(label, {"executed": 0, "coalesced": 0})
+            counts["executed" if leader else "coalesced"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return (copy(call.result) if copy else call.result), True
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            self._finish(key, call)
+            raise
+        return self._finish(key, call, copy), False
+
+    def _finish(self, key, call, copy=None):
+        # new calls from now on run the query again - followers already waiting get this call's result
+        with self._lock:
+            del self._calls[key]
+            shared = call.followers > 0
+        # the leader's copy is made before the followers are released, so they all copy an untouched original
+        result = copy(call.result) if shared and copy else call.result
+        call.done.set()
+        return result
+
+    def metrics(self):
+        """
+        Returns:
+                dict: label -> {"executed": queries run, "coalesced": queries saved by sharing a result},
+                      plus "total" over all labels and "in_flight" (queries running right now)
+        """
+        with self._lock:
+            metrics = {label: dict(counts) for label, counts in self._metrics.items()}
+            in_flight = len(self._calls)
+        metrics["total"] = {
+            "executed": sum(counts["executed"] for counts in metrics.values()),
+            "coalesced": sum(counts["coalesced"] for counts in metrics.values()),
+        }
+        metrics["in_flight"] = in_flight
+        return metrics
+
+
+# the single flight group shared by all SecureOperations instances in this process
+single_flight = SingleFlight()
@@ -0,0 +1,231 @@
+import argparse
+import secure_db
+from db_logger import log_database_access
+
+"""
+Per store summary tables for the manager dashboards
+
+The dashboards show the same aggregates on every page load - sales per store per day and low stock
+counts per store. Instead of aggregating orders, order_items and stocks each time, they are kept in two
+summary tables (created by store_summaries.sql):
+
+- store_daily_sales: orders, items and revenue per store per day
+- store_low_stock: products, low stock and out of stock products per store
+
+With SecureOperations.maintain_summaries = True (off by default - create the tables first),
+SecureOperations keeps them up to date: before a write on orders/order_items/stocks it finds the summary
+rows the write touches (the store/day pairs or stores), and after the write recomputes just those rows from
+the base tables. Users read them through select() like any other table, with the store_id row restriction
+of their role.
+
+Writes that bypass SecureOperations (or a failed refresh) are repaired with a full rebuild:
+
+        python store_summaries.py rebuild [--store 1]
+"""
+
+# products with at most this many items in stock count as low stock
+LOW_STOCK_THRESHOLD = 5
+
+SUMMARY_TABLES = ["store_daily_sales", "store_low_stock"]
+
+# the base tables the summaries are computed from
+SOURCE_TABLES = ("orders", "order_items", "stocks")
+
+# max summary keys recomputed per statement
+KEY_CHUNK_SIZE = 500
+
+SALES_INSERT = "INSERT INTO store_daily_sales (store_id, sales_date, orders, items, revenue) "
+SALES_SELECT = ("SELECT o.store_id, o.order_date, COUNT(DISTINCT o.order_id), COALESCE(SUM(oi.quantity), 0), "
+                "COALESCE(SUM(oi.quantity * oi.list_price * (1 - oi.discount)), 0) "
+                "FROM orders o LEFT JOIN order_items oi ON oi.order_id = o.order_id")
+SALES_GROUP = " GROUP BY o.store_id, o.order_date"
+
+STOCK_INSERT = "INSERT INTO store_low_stock (store_id, products, low_stock_products, out_of_stock_products) "
+STOCK_SELECT = (f"SELECT store_id, COUNT(*), SUM(CASE WHEN COALESCE(quantity, 0) <= {LOW_STOCK_THRESHOLD} THEN 1 ELSE 0 END), "
+                "SUM(CASE WHEN COALESCE(quantity, 0) = 0 THEN 1 ELSE 0 END) FROM stocks")
+STOCK_GROUP = " GROUP BY store_id"
+
+
+class SummaryKeys:
+    """
+    The summary rows a write touches
+
+    Attributes:
+            sales (set): (store_id, sales_date) pairs of store_daily_sales
+            stores (set): store_ids of store_low_stock
+    """
+
+    def __init__(self, sales=(), stores=()):
+        self.sales = set(sales)
+        self.stores = set(stores)
+
+    def __or__(self, other):
+        return SummaryKeys(self.sales | other.sales, self.stores | other.stores)
+
+    def __bool__(self):
+        return bool(self.sales or self.stores)
+
+    def __repr__(self):
+        return f"SummaryKeys({len(self.sales)} store days, {len(self.stores)} stores)"
+
+
+def maintains(table):
+    """
+    Returns True if writes to the table change the summaries
+    """
+    return table in SOURCE_TABLES
+
+
+def _fetch(connection, query, params=None):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(query, params)
+        return [tuple(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def _order_keys(connection, order_ids):
+    order_ids = list(order_ids)
+    keys = set()
+    for i in range(0, len(order_ids), KEY_CHUNK_SIZE):
+        chunk = order_ids[i:i + KEY_CHUNK_SIZE]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        keys.update(_fetch(connection, f"SELECT DISTINCT store_id, order_date FROM orders WHERE order_id IN ({placeholders})", chunk))
+    return keys
+
+
+def keys_for_condition(connection, table, where, params=None):
+    """
+    Finds the summary rows touched by the rows of a base table matching a WHERE clause
+    (run before an update or delete, in the same transaction)
+
+    Arguments:
+            connection: the connection the write runs on
+            table (string): orders, order_items or stocks
+            where (string): the write's WHERE clause (without WHERE), row restrictions included
+            params (list): parameters of the WHERE clause, if any
+
+    Returns:
+            SummaryKeys
+    """
+    if table == "stocks":
+        return SummaryKeys(stores=(row[0] for row in _fetch(connection, f"SELECT DISTINCT store_id FROM stocks WHERE {where}", params)))
+    query = f"SELECT DISTINCT store_id, order_date FROM orders WHERE order_id IN (SELECT order_id FROM {table} WHERE {where})"
+    return SummaryKeys(sales=_fetch(connection, query, params))
+
+
+def keys_for_rows(connection, table, rows):
+    """
+    Finds the summary rows touched by newly written rows
+
+    Arguments:
+            rows (list): the written rows as dicts of column values
+
+    Returns:
+            SummaryKeys
+    """
+    if table == "stocks":
+        return SummaryKeys(stores=(row["store_id"] for row in rows if row.get("store_id") is not None))
+    if table == "orders" and all(row.get("store_id") is not None and row.get("order_date") is not None for row in rows):
+        return SummaryKeys(sales=((row["store_id"], row["order_date"]) for row in rows))
+    return SummaryKeys(sales=_order_keys(connection, {row["order_id"] for row in rows if row.get("order_id") is not None}))
+
+
+def keys_after_update(connection, table, data, before):
+    """
+    Finds the summary rows an update moves rows to - only when it changes which store/day a row counts for
+
+    Arguments:
+            data (dict): the updated column values
+            before (SummaryKeys): the keys of the rows before the update (keys_for_condition)
+
+    Returns:
+            SummaryKeys
+    """
+    if table == "orders" and ("store_id" in data or "order_date" in data):
+        return SummaryKeys(sales=((data.get("store_id", store_id), data.get("order_date", day)) for store_id, day in before.sales))
+    if table == "order_items" and "order_id" in data:
+        return SummaryKeys(sales=_order_keys(connection, [data["order_id"]]))
+    if table == "stocks" and "store_id" in data:
+        return SummaryKeys(stores=[data["store_id"]])
+    return SummaryKeys()
+
+
+def refresh_summaries(connection, keys):
+    """
+    Recomputes the given summary rows from the base tables and commits
+
+    Arguments:
+            connection: the connection to use (after the write was committed)
+            keys (SummaryKeys): the summary rows to recompute
+    """
+    cursor = connection.cursor()
+    try:
+        sales = list(keys.sales)
+        for i in range(0, len(sales), KEY_CHUNK_SIZE):
+            chunk = sales[i:i + KEY_CHUNK_SIZE]
+            pairs = ", ".join(["(%s, %s)"] * len(chunk))
+            params = [value for key in chunk for value in key]
+            cursor.execute(f"DELETE FROM store_daily_sales WHERE (store_id, sales_date) IN ({pairs})", params)
+            cursor.execute(f"{SALES_INSERT}{SALES_SELECT} WHERE (o.store_id, o.order_date) IN ({pairs}){SALES_GROUP}", params)
+
+        stores = list(keys.stores)
+        for i in range(0, len(stores), KEY_CHUNK_SIZE):
+            chunk = stores[i:i + KEY_CHUNK_SIZE]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(f"DELETE FROM store_low_stock WHERE store_id IN ({placeholders})", chunk)
+            cursor.execute(f"{STOCK_INSERT}{STOCK_SELECT} WHERE store_id IN ({placeholders}){STOCK_GROUP}", chunk)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def rebuild_summaries(connection, store_id=None):
+    """
+    Recomputes the summary tables completely from the base tables (for one store or all of them)
+
+    Returns:
+            dict: summary table -> number of rows written
+    """
+    store_filter = " WHERE store_id = %s" if store_id is not None else ""
+    params = [store_id] if store_id is not None else []
+    statements = [
+        ("store_daily_sales", f"DELETE FROM store_daily_sales{store_filter}",
+         f"{SALES_INSERT}{SALES_SELECT}{store_filter.replace('store_id', 'o.store_id')}{SALES_GROUP}"),
+        ("store_low_stock", f"DELETE FROM store_low_stock{store_filter}",
+         f"{STOCK_INSERT}{STOCK_SELECT}{store_filter}{STOCK_GROUP}"),
+    ]
+    counts = {}
+    cursor = connection.cursor()
+    try:
+        for table, delete_query, insert_query in statements:
+            log_database_access("store_summaries", "maintenance", "REBUILD", table, insert_query)
+            cursor.execute(delete_query, params)
+            cursor.execute(insert_query, params)
+            counts[table] = cursor.rowcount
+        # both tables change together, or not at all
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance of the per store summary tables")
+    parser.add_argument("command", choices=["rebuild"], help="rebuild: recompute the summaries from the base tables")
+    parser.add_argument("--store", type=int, default=None, help="only rebuild this store")
+    args = parser.parse_args()
+
+    connection = secure_db.open_connection()
+    try:
+        counts = rebuild_summaries(connection, args.store)
+    finally:
+        connection.close()
+    print("Rebuilt store summaries: " + ", ".join(f"{table}={rows} rows" for table, rows in counts.items()))
@@ -0,0 +1,28 @@
+-- Per store summary tables for the manager dashboards (see store_summaries.py)
+--
+-- Kept up to date by SecureOperations: every insert/update/delete on orders, order_items and stocks
+-- recomputes the summary rows it touched. Writes that bypass SecureOperations (or a failed refresh)
+-- are repaired with a full rebuild:  python store_summaries.py rebuild
+--
+-- Users only ever read these tables (through select() with the usual store_id row restriction).
+--
+-- Run once as an administrator:  mysql BikeCorpDB < store_summaries.sql
+-- then fill them:                python store_summaries.py rebuild
+
+-- sales per store per day
+CREATE TABLE IF NOT EXISTS store_daily_sales (
+    store_id INT NOT NULL,
+    sales_date DATE NOT NULL,
+    orders INT NOT NULL,                      -- number of orders placed that day
+    items INT NOT NULL,                       -- number of items (sum of quantities) sold that day
+    revenue DECIMAL(12, 2) NOT NULL,          -- quantity * list_price * (1 - discount) over all items
+    PRIMARY KEY (store_id, sales_date)
+);
+
+-- stock levels per store (low = at most LOW_STOCK_THRESHOLD in store_summaries.py)
+CREATE TABLE IF NOT EXISTS store_low_stock (
+    store_id INT NOT NULL PRIMARY KEY,
+    products INT NOT NULL,                    -- products the store keeps stock records for
+    low_stock_products INT NOT NULL,          -- products at or below the threshold (including out of stock)
+    out_of_stock_products INT NOT NULL        -- products with no stock left
+);
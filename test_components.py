@@ -0,0 +1,789 @@
+import contextlib
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+import db_logger
+
+# the audit records of these checks go to a scratch file, not the real audit log
+db_logger.AUDIT_LOG_FILE = os.path.join(tempfile.gettempdir(), "test_components_access.log")
+
+from secure_operations import SecureOperations, settled_watermark
+from admission_control import TokenBucket, AdmissionController, AdmissionRejected
+from connection_pool import ConnectionPool
+from audit_replay import LOG_LINE_PATTERN, parse_audit_log, parse_record, report
+from data_export import ChunkedFileWriter
+from single_flight import SingleFlight
+from result_formats import build_columnar, build_rows
+from result_budget import fetch_within_budget, estimate_size, ResultTooLarge
+from role_definitions import role_limits
+from secure_daemon import SessionCache, DaemonHandler, _capped_limits
+from secure_client import SecureClient
+from query_timeouts import time_limit, RunningStatement, QueryTimeout, QueryCancelled, ER_QUERY_TIMEOUT, ER_QUERY_INTERRUPTED
+
+"""
+Checks of the building blocks that don't need a database: fake connections/cursors stand in for
+mysql.connector where a SecureOperations method is involved, clocks are injected where time matters.
+
+Run with pytest, or as a script: python test_components.py
+"""
+
+
+class FakeCursor:
+    """
+    Unbuffered mysql.connector cursor stand-in - like the real one, closing it with unread rows raises
+    """
+
+    def __init__(self, connection, dictionary=False):
+        self.connection = connection
+        self.dictionary = dictionary
+        self.description = None
+        self.rowcount = 0
+        self.lastrowid = None
+        self.closed = False
+        self._rows = []
+
+    def execute(self, query, params=None):
+        self.connection.queries.append((query, params))
+        columns, rows, self.rowcount = self.connection.respond(query, params)
+        self.description = [(column,) for column in columns] if columns else None
+        self._rows = [dict(zip(columns, row)) if self.dictionary else tuple(row) for row in rows]
+
+    def fetchmany(self, size=1):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        if self._rows:
+            raise RuntimeError("Unread result found")
+        self.closed = True
+
+
+class FakeConnection:
+    """
+    Connection stand-in answering every query with respond(query, params) -> (columns, rows, rowcount)
+    """
+
+    def __init__(self, respond=None, connection_id=1):
+        self.respond = respond or (lambda query, params: ([], [], 0))
+        self.connection_id = connection_id
+        self.queries = []
+        self.cursors = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+
+    def cursor(self, dictionary=False, **kwargs):
+        cursor = FakeCursor(self, dictionary)
+        self.cursors.append(cursor)
+        return cursor
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock:
+    """
+    Clock that only moves when told to
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class DriverError(Exception):
+    """
+    mysql.connector style error with an errno
+    """
+
+    def __init__(self, errno):
+        super().__init__(f"error {errno}")
+        self.errno = errno
+
+
+def operations(username="admin", password="admin_pass", respond=None):
+    """
+    A SecureOperations session on a FakeConnection - KILL QUERY is recorded in ops.kills instead of sent
+    """
+    ops = SecureOperations(username, password)
+    ops.connection = FakeConnection(respond)
+    ops.kills = []
+    ops._kill_query = lambda connection_id: ops.kills.append(connection_id) or True
+    return ops
+
+
+def test_export_failure_keeps_real_error():
+    # 2500 rows, streamed in batches of 1000 - the export fails after the first batch
+    rows = [(i, f"Bike {i}") for i in range(2500)]
+    ops = operations(respond=lambda query, params: (["product_id", "product_name"], rows, len(rows)))
+
+    def failing_progress(rows_written, files):
+        raise OSError("disk full")
+
+    path = os.path.join(tempfile.mkdtemp(), "products.csv")
+    try:
+        ops.export("products", path, batch_size=1000, progress=failing_progress)
+        raise AssertionError("the export should have failed")
+    except OSError as e:
+        assert str(e) == "disk full"
+    # the unread rows were read off and the cursor closed right away, so the connection can be used again
+    assert ops.connection is not None
+    assert all(cursor.closed for cursor in ops.connection.cursors)
+
+
+def test_file_writer_splits_batches_across_files():
+    path = os.path.join(tempfile.mkdtemp(), "orders.csv")
+    with ChunkedFileWriter(path, rows_per_file=2) as writer:
+        writer.write_batch(["order_id"], [(1,), (2,), (3,)])
+        writer.write_batch(["order_id"], [(4,), (5,)])
+        files = writer.close()
+    assert [os.path.basename(file) for file in files] == ["orders.part0001.csv", "orders.part0002.csv", "orders.part0003.csv"]
+    contents = []
+    for file in files:
+        with open(file, encoding="utf-8") as f:
+            contents.append(f.read().split())
+    # every file has its own header
+    assert contents == [["order_id", "1", "2"], ["order_id", "3", "4"], ["order_id", "5"]]
+    assert writer.rows_written == 5
+
+
+def test_chunked_delete_resumes_after_a_failed_batch():
+    customer_ids = [1, 2, 3, 4, 5]
+    failing = {3}
+
+    def respond(query, params):
+        if query.startswith("SELECT"):
+            after = params[0] if params else 0
+            batch = [(key,) for key in customer_ids if key > after][:2]
+            return (["customer_id"], batch, len(batch))
+        if failing & set(params):
+            raise DriverError(1205)
+        return ([], [], len(params))
+
+    ops = operations(respond=respond)
+    condition = "email LIKE '%@bikes.com'"
+    done = []
+    try:
+        ops.delete_chunked("customers", condition, chunk_size=2, progress=done.append)
+        raise AssertionError("the second batch should have failed")
+    except DriverError:
+        pass
+    # the first batch is committed, the failed one rolled back
+    assert (ops.connection.commits, ops.connection.rollbacks) == (1, 1)
+    assert done[-1]["last_key"] == (2,)
+
+    failing.clear()
+    result = ops.delete_chunked("customers", condition, chunk_size=2, resume_from=done[-1]["last_key"])
+    assert result == {"chunks": 2, "rows": 3, "last_key": (5,)}
+    # the condition reaches the driver unchanged - a literal % is not a placeholder
+    assert all(condition in query for query, params in ops.connection.queries)
+
+    # a %s in the condition would be taken for a placeholder
+    try:
+        ops.delete_chunked("customers", "email LIKE '%s@bikes.com'", chunk_size=2)
+        raise AssertionError("a condition with %s should be refused")
+    except ValueError:
+        pass
+
+
+def test_columnar_widening_keeps_nulls():
+    connection = FakeConnection(lambda query, params: (["discount"], [(0.5,), (None,), ("n/a",)], 3))
+    cursor = connection.cursor()
+    cursor.execute("SELECT discount FROM order_items")
+    # the first batch makes a float column (NULL as NaN), the second turns it into an object column
+    result = build_columnar(cursor, batch_size=2)
+    assert result.schema == {"discount": "object"}
+    assert result["discount"] == [0.5, None, "n/a"]
+
+
+def test_rows_pickle_and_rename_clashing_columns():
+    connection = FakeConnection(lambda query, params: (["store_id", "count", "index", "from"], [(1, 12, 3, "web")], 1))
+    cursor = connection.cursor()
+    cursor.execute("SELECT store_id, COUNT(*) AS count, ... FROM orders")
+    row = build_rows(cursor)[0]
+    # tuple and Row methods keep working - the clashing columns get a trailing underscore
+    assert row.count(12) == 1 and row.index(3) == 2 and row.keys() == ("store_id", "count", "index", "from")
+    assert (row.count_, row.index_, row.from_) == (12, 3, "web")
+    assert row["count"] == 12 and row.store_id == 1
+
+    # rows pickle as (column names, values) - e.g. to go to another process
+    copy = pickle.loads(pickle.dumps(row))
+    assert copy == row and copy.as_dict() == row.as_dict() and copy.count_ == 12
+
+
+def test_columnar_budget_charges_what_stays_in_memory():
+    # order_items shaped: the tuples fetched on the way take far more memory than the finished column arrays
+    rows = [(i // 3 + 1, i % 3 + 1, i % 321 + 1, i % 2 + 1, 100.0 + i % 997, 0.05) for i in range(50000)]
+    tuple_bytes = estimate_size(rows)
+
+    def cursor():
+        connection = FakeConnection(lambda query, params: (["order_id", "item_id", "product_id", "quantity", "list_price", "discount"], rows, len(rows)))
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM order_items")
+        return cursor
+
+    result = fetch_within_budget(cursor(), "columns", budget=tuple_bytes // 2)
+    assert len(result) == 50000
+    assert result.nbytes < tuple_bytes // 4
+    try:
+        fetch_within_budget(cursor(), "columns", budget=result.nbytes // 2)
+        raise AssertionError("a result twice the budget should be refused")
+    except ResultTooLarge:
+        pass
+
+    # spilling a columnar result isn't possible - refused before any query runs
+    ops = operations()
+    try:
+        ops.select("order_items", result_format="columns", over_budget="spill")
+        raise AssertionError("columns with spill should be refused")
+    except ValueError:
+        pass
+    assert not ops.connection.queries
+
+
+def test_aggregate_only_reaches_allowed_columns_and_rows():
+    ops = operations("store1_manager", "manager1_pass", respond=lambda query, params: (["store_id", "total"], [(1, 42)], 1))
+    ops.aggregate("stocks", group_by=["store_id"], metrics={"total": ("SUM", "quantity")}, condition="quantity > 0", timeout=0)
+    query = ops.connection.queries[-1][0]
+    assert query == ("SELECT store_id, SUM(quantity) AS total FROM (SELECT * FROM stocks WHERE (store_id = 1)) AS stocks "
+                     "WHERE (quantity > 0) GROUP BY store_id ORDER BY store_id")
+
+    ops.aggregate("customers", metrics={"n": ("COUNT", "*")}, condition="first_name = 'city'", timeout=0)
+    query = ops.connection.queries[-1][0]
+    assert query == ("SELECT COUNT(*) AS n FROM (SELECT customer_id, first_name, last_name, email, phone FROM customers) AS customers "
+                     "WHERE (first_name = 'city')")
+
+    # a restricted column is refused wherever it appears - counting rows by city would reveal it as well
+    for arguments in ({"metrics": {"n": ("COUNT", "city")}},
+                      {"group_by": ["city"], "metrics": {"n": ("COUNT", "*")}},
+                      {"metrics": {"n": ("COUNT", "*")}, "condition": "city = 'Houston'"},
+                      {"metrics": {"n": ("COUNT", "*")}, "condition": "`city` LIKE 'H%'"}):
+        try:
+            ops.aggregate("customers", **arguments)
+            raise AssertionError(f"{arguments} should be refused")
+        except PermissionError:
+            pass
+    assert len(ops.connection.queries) == 2
+
+
+def test_join_applies_each_tables_restrictions():
+    ops = operations("store1_manager", "manager1_pass", respond=lambda query, params: (["orders.order_id"], [], 0))
+    ops.select_join(["orders", "customers"], columns={"orders": ["order_id", "store_id"]}, condition="orders.order_status = 4", timeout=0)
+    query = ops.connection.queries[-1][0]
+    # every table is a subquery with only the role's columns and rows - nothing else is queried
+    assert len(ops.connection.queries) == 1
+    assert query == ("SELECT orders.order_id AS `orders.order_id`, orders.store_id AS `orders.store_id`, "
+                     "customers.customer_id AS `customers.customer_id`, customers.first_name AS `customers.first_name`, "
+                     "customers.last_name AS `customers.last_name`, customers.email AS `customers.email`, customers.phone AS `customers.phone` "
+                     "FROM (SELECT * FROM orders WHERE (store_id = 1)) AS orders "
+                     "INNER JOIN (SELECT customer_id, first_name, last_name, email, phone FROM customers) AS customers "
+                     "ON customers.customer_id = orders.customer_id WHERE (orders.order_status = 4)")
+
+    # restricted columns are dropped from the request, a request of only restricted columns is refused
+    ops.select_join(["orders", "customers"], columns={"orders": ["order_id"], "customers": ["customer_id", "city"]}, timeout=0)
+    assert "city" not in ops.connection.queries[-1][0]
+    for columns in ({"orders": ["order_id"], "customers": ["city"]}, {"orders": ["order_id"], "products": ["product_name"]}):
+        try:
+            ops.select_join(["orders", "customers"], columns=columns, timeout=0)
+            raise AssertionError(f"{columns} should be refused")
+        except (PermissionError, ValueError):
+            pass
+    assert len(ops.connection.queries) == 2
+
+
+def test_upsert_refuses_rows_outside_the_restriction():
+    # the SELECT ... FOR UPDATE finds an existing order the team lead's row restriction hides (visible = 0)
+    def respond(query, params):
+        if "FOR UPDATE" in query:
+            return (["order_id", "visible"], [(7, 0)], 1)
+        return ([], [], 1)
+
+    ops = operations("team_lead1", "team1_pass", respond=respond)
+    try:
+        ops.upsert_many("orders", [{"order_id": 7, "order_status": 4}], timeout=0)
+        raise AssertionError("an existing row outside the restriction should be refused")
+    except PermissionError:
+        pass
+    assert not any(query.startswith("INSERT") for query, params in ops.connection.queries)
+    assert ops.connection.rollbacks == 1 and ops.connection.commits == 0
+
+    # the new values come from the row alias, and only the primary key decides insert or update
+    ops.connection = FakeConnection()
+    ops.upsert_many("orders", [{"order_id": 7, "order_status": 4}], timeout=0)
+    assert ops.connection.queries[-1][0] == ("INSERT INTO orders (order_id, order_status) VALUES (%s, %s) "
+                                             "AS new ON DUPLICATE KEY UPDATE order_status = new.order_status")
+    try:
+        ops.upsert_many("orders", [{"order_id": 7, "order_status": 4}], key_columns=["order_id", "order_status"])
+        raise AssertionError("a key that isn't the primary key should be refused")
+    except ValueError:
+        pass
+
+
+def test_token_bucket_refills_at_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=2, clock=clock)
+    for _ in range(2):
+        assert bucket.wait_time() == 0
+        bucket.take()
+    # empty - the next token comes after 1/rate seconds
+    assert bucket.wait_time() == 0.5
+    clock.advance(0.25)
+    assert bucket.wait_time() == 0.25
+    clock.advance(10)
+    # refilled, but never above the burst
+    assert bucket.wait_time() == 0
+    assert bucket.tokens == 2
+
+
+def test_admission_rejects_when_slots_are_full():
+    controller = AdmissionController({"staff": {"role": {"max_in_flight": 1}, "queue_timeout": 0}}, clock=FakeClock())
+    with controller.admit("staff", "sales1"):
+        try:
+            with controller.admit("staff", "sales2"):
+                raise AssertionError("a second query should not fit into one slot")
+        except AdmissionRejected:
+            pass
+    # the slot is free again
+    with controller.admit("staff", "sales2"):
+        pass
+    metrics = controller.metrics()["staff"]
+    assert (metrics["admitted"], metrics["rejected"], metrics["in_flight"]) == (2, 1, 0)
+
+
+def test_admission_rate_limit_per_user():
+    clock = FakeClock()
+    controller = AdmissionController({"staff": {"user": {"rate": 1, "burst": 1}, "queue_timeout": 0}}, clock=clock)
+    with controller.admit("staff", "sales1"):
+        pass
+    try:
+        with controller.admit("staff", "sales1"):
+            raise AssertionError("the user's token should be used up")
+    except AdmissionRejected:
+        pass
+    # other users have their own bucket
+    with controller.admit("staff", "sales2"):
+        pass
+    clock.advance(1)
+    with controller.admit("staff", "sales1"):
+        pass
+
+
+
+def test_time_limit_maps_driver_errors():
+    ops = operations()
+    try:
+        with time_limit(ops, "SELECT", "orders", "SELECT * FROM orders", 5):
+            raise DriverError(ER_QUERY_TIMEOUT)
+        raise AssertionError("a server side timeout should raise QueryTimeout")
+    except QueryTimeout:
+        pass
+    # an interrupted query that nobody cancelled is an ordinary error
+    try:
+        with time_limit(ops, "SELECT", "orders", "SELECT * FROM orders", 5):
+            raise DriverError(ER_QUERY_INTERRUPTED)
+    except DriverError:
+        pass
+    assert not ops.running_statements and not ops.kills
+
+
+def test_watchdog_cancels_only_its_own_statement():
+    ops = operations()
+
+    def slow_statement():
+        # runs until the watchdog kills it, then fails like the driver does
+        deadline = time.monotonic() + 5
+        while not ops.kills and time.monotonic() < deadline:
+            time.sleep(0.01)
+        raise DriverError(ER_QUERY_INTERRUPTED)
+
+    try:
+        with time_limit(ops, "UPDATE", "stocks", "UPDATE stocks SET quantity = 0", 0.05):
+            slow_statement()
+        raise AssertionError("the watchdog should have stopped the statement")
+    except QueryTimeout:
+        pass
+    assert ops.kills == [1]
+
+    # a watchdog firing after its statement is done doesn't touch the connection anymore
+    finished = RunningStatement(ops)
+    finished.finished = True
+    assert ops.cancel(statement=finished) is False
+    assert ops.kills == [1]
+
+
+def test_cancel_state_is_per_statement():
+    ops = operations()
+    other_connection = FakeConnection(connection_id=2)
+    inside = threading.Barrier(3)
+    cancelled = threading.Event()
+    outcomes = {}
+
+    def run(name, connection):
+        try:
+            with time_limit(ops, "SELECT_KEYS", "orders", "SELECT * FROM orders", None, connection):
+                inside.wait()
+                cancelled.wait(5)
+                if name == "own":
+                    raise DriverError(ER_QUERY_INTERRUPTED)
+            outcomes[name] = "done"
+        except QueryCancelled:
+            outcomes[name] = "cancelled"
+
+    threads = [threading.Thread(target=run, args=("own", None)), threading.Thread(target=run, args=("other", other_connection))]
+    for thread in threads:
+        thread.start()
+    inside.wait()
+    # cancelling the user's own connection leaves the statement on the other connection alone
+    assert ops.cancel() is True
+    cancelled.set()
+    for thread in threads:
+        thread.join()
+    assert outcomes == {"own": "cancelled", "other": "done"}
+    assert ops.kills == [1]
+
+
+
+def test_sync_watermark_stops_at_recent_gaps():
+    # 43 is missing and 44 is only a second old - 43 may still commit, so the watermark stays at 42
+    assert settled_watermark(40, [(41, 5.0), (42, 3.0), (44, 1.0)], 60) == 42
+    # the same gap an hour later is a rolled back transaction - skipped
+    assert settled_watermark(40, [(41, 3605.0), (42, 3603.0), (44, 3601.0)], 60) == 44
+    # a gap right after the base counts too
+    assert settled_watermark(40, [(42, 1.0)], 60) == 40
+    assert settled_watermark(40, [], 60) == 40
+
+
+def test_sync_reads_a_fresh_snapshot_every_poll():
+    ops = operations("store1_manager", "manager1_pass")
+    snapshots = []
+
+    def respond(query, params):
+        snapshots.append(ops.connection.rollbacks)
+        if "AS age" in query:
+            return (["change_seq", "age"], [(41, 5.0), (42, 3.0), (44, 1.0)], 3)
+        return (["product_id", "store_id", "quantity"], [(1, 1, 5)], 1)
+
+    ops.connection.respond = respond
+    for poll in range(2):
+        result = ops.select_changes("stocks", since=40)
+        assert result["watermark"] == 42
+        # every poll starts a new read transaction before its first query, and ends it afterwards
+        assert snapshots[0] == 2 * poll + 1
+        assert ops.connection.rollbacks == 2 * poll + 2
+        snapshots.clear()
+
+
+
+def test_pool_ends_the_borrowers_transaction():
+    pool = ConnectionPool(FakeConnection, size=2)
+    with pool.connection() as connection:
+        pass
+    # rolled back on the way back in, so the next borrower reads a fresh snapshot
+    assert connection.rollbacks == 1
+    with pool.connection() as again:
+        assert again is connection
+
+
+def test_pool_wakes_waiters_when_a_connection_is_discarded():
+    pool = ConnectionPool(FakeConnection, size=1)
+    borrowed = threading.Event()
+    release = threading.Event()
+
+    def failing_borrower():
+        try:
+            with pool.connection():
+                borrowed.set()
+                release.wait(5)
+                raise RuntimeError("connection broke")
+        except RuntimeError:
+            pass
+
+    thread = threading.Thread(target=failing_borrower)
+    thread.start()
+    borrowed.wait(5)
+    # the pool is full - nothing frees up within a short timeout
+    try:
+        with pool.connection(timeout=0.05):
+            raise AssertionError("the only connection is lent out")
+    except TimeoutError:
+        pass
+
+    # the broken connection is discarded - a waiter gets a new one right away instead of after its timeout
+    threading.Timer(0.05, release.set).start()
+    start = time.monotonic()
+    with pool.connection(timeout=10) as connection:
+        assert connection.rollbacks == 0
+    assert time.monotonic() - start < 5
+    thread.join()
+
+
+def test_single_flight_shares_one_execution():
+    flight = SingleFlight()
+    release = threading.Event()
+    executions = []
+
+    def query():
+        executions.append(1)
+        release.wait(5)
+        return [{"product_id": 1}]
+
+    results = {}
+    leader = threading.Thread(target=lambda: results.update(leader=flight.run("key", query, "products", copy=list)))
+    leader.start()
+    while flight.metrics()["in_flight"] == 0:
+        time.sleep(0.001)
+    follower = threading.Thread(target=lambda: results.update(follower=flight.run("key", query, "products", copy=list)))
+    follower.start()
+    while flight.metrics().get("products", {}).get("coalesced", 0) == 0:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert len(executions) == 1
+    assert results["leader"] == ([{"product_id": 1}], False) and results["follower"] == ([{"product_id": 1}], True)
+    # every caller has its own copy
+    assert results["leader"][0] is not results["follower"][0]
+    # nothing is cached - the next call runs again
+    assert flight.run("key", lambda: [], "products") == ([], False)
+    assert flight.metrics()["products"] == {"executed": 2, "coalesced": 1}
+
+
+def test_single_flight_key_ignores_who_within_the_restriction():
+    keys = []
+
+    class KeyRecorder:
+        def run(self, key, function, label=None, copy=None):
+            keys.append(key)
+            return function(), False
+
+    respond = lambda query, params: (["product_id", "quantity"], [(1, 5)], 1)
+    manager, colleague, other_store = (operations("store1_manager", "manager1_pass", respond),
+                                       operations("store1_manager", "manager1_pass", respond),
+                                       operations("store2_manager", "manager2_pass", respond))
+    # another user of the same store and role - only their staff_id differs
+    colleague.context["staff_id"] = 99
+    for ops in (manager, colleague, other_store):
+        ops.single_flight = KeyRecorder()
+        ops.select("stocks")
+    assert keys[0] == keys[1]
+    assert keys[2] != keys[0]
+
+
+def audit_record(user, role, action, table, query):
+    return LOG_LINE_PATTERN.match(f"2025-04-24 19:27:03,928 - database_access - INFO - USER: {user} | ROLE: {role} | "
+                                  f"ACTION: {action} | TABLE: {table}  | QUERY: {query}")
+
+
+def test_replay_parses_audit_records():
+    select = parse_record(audit_record("store1_manager", "store_manager", "SELECT", "stocks",
+                                       "SELECT product_id, quantity FROM stocks WHERE (quantity < 5) AND (store_id = 1) LIMIT 10"))
+    assert (select.method, select.table, select.arguments) == ("select", "stocks", {"columns": ["product_id", "quantity"], "limit": 10})
+    assert select.where == "(quantity < 5) AND (store_id = 1)"
+
+    update = parse_record(audit_record("store1_manager", "store_manager", "UPDATE", "stocks",
+                                       "UPDATE stocks SET quantity = %s WHERE (product_id = 1) AND store_id = 1 - [50]"))
+    assert (update.method, update.arguments, update.where) == ("update", {"data": {"quantity": 50}}, "(product_id = 1) AND store_id = 1")
+
+    insert = parse_record(audit_record("admin", "admin", "INSERT", "categories",
+                                       "INSERT INTO categories (category_name) VALUES (%s) - ['Test Category']"))
+    assert (insert.method, insert.arguments) == ("insert", {"data": {"category_name": "Test Category"}})
+
+    aggregate = parse_record(audit_record("admin", "admin", "AGGREGATE", "orders",
+                                          "SELECT store_id, COUNT(*) AS orders FROM orders GROUP BY store_id"))
+    assert aggregate.arguments == {"group_by": ["store_id"], "metrics": {"orders": ("COUNT", "*")}, "limit": None}
+
+
+def test_replay_skips_what_it_cant_replay():
+    # chunked statements have key parameters in their WHERE clause
+    chunked = audit_record("admin", "admin", "DELETE", "orders", "DELETE FROM orders WHERE order_id IN (%s, %s) AND (order_status = 3)")
+    assert parse_record(chunked) is None
+    assert parse_record(audit_record("admin", "admin", "SYNC", "orders", "SELECT * FROM orders - since 40")) is None
+    # a logged value list that doesn't match the columns
+    assert parse_record(audit_record("admin", "admin", "INSERT", "brands", "INSERT INTO brands (brand_name) VALUES (%s) - ['a', 'b']")) is None
+
+
+def test_replay_counts_skipped_records_per_action():
+    records = [
+        ("admin", "admin", "SELECT", "brands", "SELECT * FROM brands"),
+        ("admin", "admin", "EXPORT", "orders", "SELECT order_id, store_id FROM orders WHERE (order_status = 4) - 120 rows to 1 file(s) (completed)"),
+        ("admin", "admin", "JOIN", "orders, customers", "SELECT o.order_id FROM orders AS o JOIN customers AS c ON o.customer_id = c.customer_id"),
+        ("admin", "admin", "SYNC", "orders", "SELECT * FROM orders - since 40"),
+        ("admin", "admin", "SYNC", "stocks", "SELECT * FROM stocks - since 12"),
+        ("admin", "admin", "UPSERT", "stocks", "INSERT INTO stocks (store_id, product_id, quantity) VALUES (%s, %s, %s) - 2 rows"),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        log = os.path.join(directory, "access.log")
+        with open(log, "w") as f:
+            f.writelines(audit_record(*record).string + "\n" for record in records)
+        events, skipped = parse_audit_log(log)
+    assert [event.action for event in events] == ["SELECT", "EXPORT"]
+    # an export is replayed as a streamed read of the same rows
+    assert (events[1].method, events[1].arguments, events[1].where) == ("select_stream", {"columns": ["order_id", "store_id"]}, "(order_status = 4)")
+    assert skipped == {"JOIN": 1, "SYNC": 2, "UPSERT": 1}
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        report([], 1.0, skipped)
+    assert "not replayed: JOIN 1, SYNC 2, UPSERT 1" in output.getvalue()
+
+
+def test_daemon_sessions_are_rolled_back_and_swept():
+    clock = FakeClock()
+    cache = SessionCache(session_ttl=60, clock=clock)
+    session = cache.checkout("admin", "admin_pass")
+    session.connection = FakeConnection()
+    cache.checkin(session)
+    # the next client starts with a fresh snapshot
+    assert session.connection.rollbacks == 1
+    assert cache.checkout("admin", "admin_pass") is session
+
+    # a connection that can't even roll back isn't handed out again
+    broken = session.connection
+
+    def lost_connection():
+        raise DriverError(2013)
+
+    broken.rollback = lost_connection
+    cache.checkin(session)
+    assert broken.closed and cache.metrics()["idle"] == 0
+
+    # an expired session goes on the next checkout of any user, not only on its own user's
+    manager = cache.checkout("store1_manager", "manager1_pass")
+    manager.connection = FakeConnection()
+    idle_connection = manager.connection
+    cache.checkin(manager)
+    clock.advance(61)
+    cache.checkin(cache.checkout("admin", "admin_pass"))
+    assert idle_connection.closed
+    assert cache.metrics()["expired"] == 1
+
+
+class FakeServer:
+    def count(self, name, amount=1):
+        pass
+
+
+class NoSocket:
+    def sendall(self, data):
+        pass
+
+
+def daemon_reply(session, method, *args, **kwargs):
+    """
+    Serves one call like the daemon does - returns the reply lines it sent
+    """
+    handler = object.__new__(DaemonHandler)
+    handler.server = FakeServer()
+    handler.wfile = io.BytesIO()
+    handler._serve(session, {"id": 1, "op": "call", "method": method, "args": list(args), "kwargs": kwargs})
+    return handler.wfile.getvalue().splitlines(keepends=True)
+
+
+def daemon_call(session, method, *args, **kwargs):
+    """
+    Serves one call like the daemon does and reads the reply back like the client does - without a socket
+    """
+    client = object.__new__(SecureClient)
+    client._socket = NoSocket()
+    client._reader = io.BytesIO(b"".join(daemon_reply(session, method, *args, **kwargs)))
+    client._next_id = 0
+    client._open_stream = None
+    return client.call(method, *args, **kwargs)
+
+
+def test_daemon_keeps_select_by_keys_keys():
+    respond = lambda query, params: (["product_id", "product_name"], [(key, f"Bike {key}") for key in params], len(params))
+    ops = operations(respond=respond)
+    pool = ConnectionPool(lambda: FakeConnection(respond), 1)
+    ops.pooled_connection = lambda timeout=30.0: ops._traced_pool_connection(pool, timeout)
+    result = daemon_call(ops, "select_by_keys", "products", "product_id", [1, 2], as_dict=True)
+    assert result == {1: {"product_id": 1, "product_name": "Bike 1"}, 2: {"product_id": 2, "product_name": "Bike 2"}}
+
+
+def test_daemon_streams_selects_from_the_cursor():
+    rows = [(i, f"Bike {i}") for i in range(1200)]
+    ops = operations(respond=lambda query, params: (["product_id", "product_name"], rows, len(rows)))
+    replies = [json.loads(line) for line in daemon_reply(ops, "select", "products", condition="product_id > 0", timeout=0)]
+    # the result goes out batch by batch as the cursor hands it over - never built up as a whole
+    assert [len(reply["rows"]) for reply in replies if "rows" in reply and not reply.get("done")] == [500, 500, 200]
+    assert replies[0] == {"id": 1, "columns": ["product_id", "product_name"]}
+    assert replies[-1] == {"id": 1, "done": True, "rows": 1200}
+    # one query - with the role's timeout, since timeout=0 can't lift it
+    [(query, params)] = ops.connection.queries
+    assert query == "SELECT /*+ MAX_EXECUTION_TIME(300000) */ * FROM products WHERE (product_id > 0)"
+    assert all(cursor.closed for cursor in ops.connection.cursors)
+
+    result = daemon_call(ops, "select", "products")
+    assert len(result) == 1200 and result[0] == {"product_id": 0, "product_name": "Bike 0"}
+    # refused before anything is sent
+    try:
+        daemon_call(operations("customer1", "customer1_pass"), "select", "staffs")
+        raise AssertionError("a customer can't read staffs")
+    except PermissionError:
+        pass
+
+
+def test_daemon_caps_open_sessions():
+    cache = SessionCache(max_sessions=1, session_wait=0)
+    admin = cache.checkout("admin", "admin_pass")
+    admin.connection = FakeConnection()
+    try:
+        cache.checkout("store1_manager", "manager1_pass")
+        raise AssertionError("the only session is in use")
+    except TimeoutError:
+        pass
+    # an idle session makes room for another user's
+    cache.checkin(admin)
+    manager = cache.checkout("store1_manager", "manager1_pass")
+    assert admin.connection is None
+    assert cache.metrics()["evicted"] == 1 and cache.metrics()["refused"] == 1
+    cache.checkin(manager)
+
+
+def test_daemon_caps_limits_at_the_role_defaults():
+    ops = operations()
+    timeout, budget = role_limits["admin"]["statement_timeout"], role_limits["admin"]["result_memory_budget"]
+    # "no limit" and anything above the role's default become the default
+    assert _capped_limits(ops, {"timeout": 0, "memory_budget": 0}) == {"timeout": timeout, "memory_budget": budget}
+    assert _capped_limits(ops, {"timeout": timeout * 10, "memory_budget": budget * 10}) == {"timeout": timeout, "memory_budget": budget}
+    # tighter limits are kept
+    assert _capped_limits(ops, {"timeout": 1, "memory_budget": 1024, "limit": 5}) == {"timeout": 1, "memory_budget": 1024, "limit": 5}
+
+
+def test_daemon_keeps_the_roles_over_budget_action():
+    # staff results over the budget are rejected - a client can't switch that to spilling them
+    staff = operations("sales1", "sales1_pass")
+    assert role_limits["staff"]["over_budget"] == "reject"
+    assert _capped_limits(staff, {"over_budget": "spill"}) == {"over_budget": "reject"}
+    # admin results spill by default - asking for "reject" instead is fine
+    admin = operations()
+    assert _capped_limits(admin, {"over_budget": "reject"}) == {"over_budget": "reject"}
+    assert _capped_limits(admin, {"over_budget": "spill"}) == {"over_budget": "spill"}
+
+
+if __name__ == "__main__":
+    for name, check in list(globals().items()):
+        if name.startswith("test_") and callable(check):
+            check()
+            print(f"{name}: ok")
+    print("\nAll component checks passed!")
@@ -1,4 +1,10 @@
 from secure_operations import SecureOperations
+from tracing import tracer, read_trace
+from result_budget import result_memory, ResultTooLarge
+from secure_daemon import SecureDaemon
+from secure_client import SecureClient
+import os
+import threading
 import time
 
 def separator(title):
@@ -26,7 +32,7 @@ def test_admin_operations():
         # Test INSERT - admin can insert anywhere
         separator("Admin INSERT Test")
         # First, get the maximum category_id to avoid duplicate key errors
-        max_category = admin.select("categories", columns=["MAX(category_id) as max_id"])
+        max_category = admin.aggregate("categories", metrics={"max_id": ("MAX", "category_id")})
         new_id = 1
         if max_category and max_category[0]['max_id'] is not None:
             new_id = max_category[0]['max_id'] + 1
@@ -54,6 +60,14 @@ def test_admin_operations():
         except Exception as e:
             print(f"Error with category operations: {e}")
         
+        # Test UPSERT - the stock sync writes a batch of stock levels in one statement per chunk
+        # (the current levels of store 1 are written back, so existing rows are updated with the same values)
+        separator("Admin UPSERT Test")
+        stock_levels = admin.select("stocks", columns=["store_id", "product_id", "quantity"], condition="store_id = 1", limit=20)
+        upsert_result = admin.upsert_many("stocks", stock_levels, key_columns=["store_id", "product_id"], chunk_size=8)
+        print(f"Admin synced {len(stock_levels)} stock levels: {upsert_result['inserted']} inserted, "
+              f"{upsert_result['updated']} updated, per chunk {upsert_result['per_chunk']}")
+        
         # Close connection
         admin.close()
         
@@ -84,6 +98,52 @@ def test_store_manager_operations():
         for s in staff[:2]:
             print(f"  {s}")
         
+        # Test AGGREGATE - manager gets stock totals for their own store only
+        separator("Store Manager AGGREGATE Test")
+        stock_totals = manager.aggregate("stocks", group_by=["store_id"], 
+                                         metrics={"products": ("COUNT", "*"), "total_quantity": ("SUM", "quantity")})
+        print(f"Store Manager stock summary: {stock_totals}")
+        
+        # aggregating on a restricted column should be denied, not silently ignored
+        try:
+            manager.aggregate("customers", group_by=["city"], metrics={"customers": ("COUNT", "*")})
+            print("ERROR: Store Manager should not be able to group customers by city")
+        except PermissionError as e:
+            print(f"Correctly denied: {e}")
+        
+        # Test SUMMARIES - the dashboard reads the precomputed per store summaries instead of aggregating
+        # (needs store_summaries.sql and `python store_summaries.py rebuild`)
+        separator("Store Manager Summary Tables Test")
+        low_stock = manager.select("store_low_stock")
+        print(f"Store Manager low stock summary: {low_stock}")
+        daily_sales = manager.select("store_daily_sales", condition="sales_date >= '2018-01-01'")
+        print(f"Store Manager has {len(daily_sales)} days of sales in the summary")
+        
+        # Test EXPORT - manager exports their store's orders, streamed in batches to gzipped CSV parts
+        separator("Store Manager EXPORT Test")
+        export_result = manager.export("orders", "store1_orders.csv", rows_per_file=500, compress=True,
+                                       progress=lambda rows, files: print(f"  ...{rows} rows written to {files} file(s)"))
+        print(f"Store Manager exported {export_result['rows']} orders to {export_result['files']}")
+        
+        # Test MEMORY BUDGET - a result over the budget is spilled to a temporary file and read back lazily
+        separator("Store Manager Memory Budget Test")
+        order_items = manager.select("order_items", memory_budget=64 * 1024, over_budget="spill")
+        print(f"Store Manager order items: {order_items!r}")
+        print(f"First order item: {next(iter(order_items))}")
+        print(f"Result memory metrics: {result_memory.metrics()}")
+        
+        # Test SINGLE FLIGHT - terminals opening at the same time share one stock query
+        separator("Store Manager Single Flight Test")
+        terminals = [SecureOperations("store1_manager", "manager1_pass") for _ in range(5)]
+        threads = [threading.Thread(target=terminal.select, args=("stocks",)) for terminal in terminals]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(f"Single flight metrics: {SecureOperations.single_flight.metrics()}")
+        for terminal in terminals:
+            terminal.close()
+        
         # Test UPDATE - manager can update stock in their store
         separator("Store Manager UPDATE Test")
         stock_update = {
@@ -136,9 +196,8 @@ def test_sales_staff_operations():
         separator("Sales Staff INSERT Test")
         
         # First, get the maximum order_id to avoid duplicate key errors
-        # Query for maximum order_id across ALL stores, not just the current store
-        max_order = sales.select("orders", columns=["MAX(order_id) as max_id"], 
-                         condition="1=1")  # This condition is a trick to bypass row restrictions
+        # Row restrictions still apply, so this is the maximum order_id in the staff's own store
+        max_order = sales.aggregate("orders", metrics={"max_id": ("MAX", "order_id")})
 
         new_order_id = 10000  # Start with a high number
         if max_order and max_order[0]['max_id'] is not None:
@@ -159,8 +218,8 @@ def test_sales_staff_operations():
             print(f"Sales Staff created new order with ID: {new_order_id}")
             
             # Get the maximum item_id for this order
-            max_item = sales.select("order_items", columns=["MAX(item_id) as max_id"], 
-                                   condition=f"order_id = {new_order_id}")
+            max_item = sales.aggregate("order_items", metrics={"max_id": ("MAX", "item_id")}, 
+                                       condition=f"order_id = {new_order_id}")
             new_item_id = 1
             if max_item and max_item[0]['max_id'] is not None:
                 new_item_id = max_item[0]['max_id'] + 1
@@ -179,6 +238,16 @@ def test_sales_staff_operations():
         except Exception as e:
             print(f"Error creating order: {e}")
         
+        # Test SYNC - a POS terminal loads its store's stock once, then only fetches what changed
+        separator("Sales Staff SYNC Test")
+        try:
+            stock_sync = sales.select_changes("stocks")
+            print(f"Initial stock load: {len(stock_sync['rows'])} rows, watermark {stock_sync['watermark']}")
+            stock_sync = sales.select_changes("stocks", since=stock_sync["watermark"])
+            print(f"Refresh: {len(stock_sync['rows'])} changed rows, {len(stock_sync['deleted'])} deleted rows")
+        except Exception as e:
+            print(f"Error syncing stocks (is change_tracking.sql installed?): {e}")
+        
         # Test trying to update product prices (should fail)
         separator("Sales Staff Unauthorized Test")
         product_update = {
@@ -218,6 +287,39 @@ def test_customer_operations():
         for product in products:
             print(f"  {product}")
         
+        # Test JOIN - customer sees their orders with line items and product names in one query
+        separator("Customer JOIN Test")
+        order_lines = customer.select_join(["orders", "order_items", "products"], columns={
+            "orders": ["order_id", "order_date"],
+            "order_items": ["item_id", "quantity", "list_price"],
+            "products": ["product_name"]
+        })
+        print(f"Customer retrieved {len(order_lines)} order lines:")
+        for line in order_lines[:3]:
+            print(f"  {line}")
+        
+        # joining a table the customer can't read should fail
+        try:
+            customer.select_join(["orders", "customers"])
+            print("ERROR: Customer should not be able to join the customer table")
+        except PermissionError as e:
+            print(f"Correctly denied: {e}")
+        
+        # a result over the customer's memory budget is refused
+        try:
+            customer.select("products", memory_budget=1024)
+            print("ERROR: Customer should not get a result over their memory budget")
+        except ResultTooLarge as e:
+            print(f"Correctly refused: {e}")
+        
+        # Test tracing - trace every call for a moment and look at the steps recorded
+        separator("Customer Tracing Test")
+        tracer.configure(sample_rate=1.0, path="customer_trace.json")
+        customer.select("products", columns=["product_id", "product_name"], limit=3)
+        tracer.configure(sample_rate=0.0)
+        steps = [event["name"] for event in read_trace("customer_trace.json")]
+        print(f"Traced steps: {steps}")
+        
         # Test trying to see other customers' data (should fail)
         separator("Customer Unauthorized Test")
         try:
@@ -232,6 +334,46 @@ def test_customer_operations():
     except Exception as e:
         print(f"Customer test error: {e}")
 
+def test_daemon_operations():
+    """Test the secure query daemon with short lived clients."""
+    separator("SECURE QUERY DAEMON")
+    
+    socket_path = f"test_daemon_{os.getpid()}.sock"
+    try:
+        daemon = SecureDaemon(socket_path)
+        threading.Thread(target=daemon.serve_forever, daemon=True).start()
+        
+        try:
+            # a cron job style client - same calls and same restrictions as SecureOperations
+            separator("Daemon Client Test")
+            with SecureClient("store1_manager", "manager1_pass", socket_path) as client:
+                low_stock = client.select("stocks", condition="quantity < 5")
+                print(f"Daemon client ({client.role}) got {len(low_stock)} low stock rows")
+                streamed = sum(1 for _ in client.stream("select", "order_items"))
+                print(f"Daemon client streamed {streamed} order items")
+                try:
+                    client.select("customers", columns=["city"])
+                    print("ERROR: Store Manager should not be able to read customer cities through the daemon")
+                except PermissionError as e:
+                    print(f"Correctly denied: {e}")
+            
+            # the next client of the same user gets the cached session back (no new login or connection)
+            with SecureClient("store1_manager", "manager1_pass", socket_path) as client:
+                client.select("stocks", limit=1)
+                print(f"Daemon metrics: {client.metrics()['sessions']}")
+            
+            try:
+                SecureClient("store1_manager", "wrong_pass", socket_path)
+                print("ERROR: a wrong password should not get a daemon session")
+            except ValueError as e:
+                print(f"Correctly denied: {e}")
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+            
+    except Exception as e:
+        print(f"Daemon test error: {e}")
+
 if __name__ == "__main__":
     # Run all tests
     try:
@@ -239,6 +381,7 @@ if __name__ == "__main__":
         test_store_manager_operations()
         test_sales_staff_operations()
         test_customer_operations()
+        test_daemon_operations()
         print("\nAll tests completed!")
     except Exception as e:
         print(f"Test suite error: {e}")
\ No newline at end of file
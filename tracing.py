@@ -0,0 +1,296 @@
+import functools
+import heapq
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Opt-in tracing and profiling of SecureOperations calls
+
+A sample of the calls (sample_rate, 0.05 = 5% of the calls, default off) is traced: the call itself and
+the steps inside it (authenticate, policy check, build, admission, acquire connection, execute, fetch, audit)
+are recorded as nested spans with their durations and attributes, and appended to a trace file in the
+Chrome trace event format - open it in chrome://tracing or https://ui.perfetto.dev for a flame graph view.
+
+With profile_slowest = N, sampled calls also run under cProfile and the profiles of the N slowest calls are
+kept, to be written out with dump_profiles() and read with pstats / snakeviz.
+
+Switched on without code changes through environment variables:
+
+        BIKECORP_TRACE_SAMPLE=0.05               trace 5% of the calls
+        BIKECORP_TRACE_FILE=trace.json           where the spans go (default secure_operations_trace.json)
+        BIKECORP_PROFILE_SLOWEST=10              keep cProfile data of the 10 slowest sampled calls
+
+or at runtime with tracer.configure(sample_rate=0.05, ...). Calls that aren't sampled only cost a random() call.
+"""
+
+DEFAULT_TRACE_FILE = "secure_operations_trace.json"
+
+# perf_counter() has no fixed start - this turns its values into wall clock microseconds for the trace file
+_CLOCK_OFFSET = time.time() - time.perf_counter()
+
+
+class _NullSpan:
+    """
+    Stand-in for a span when the current call isn't traced - does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, key, value):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """
+    The spans recorded for one sampled call (from any thread working on it)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, attributes):
+        event = {
+            "name": name,
+            "cat": "secure_operations",
+            "ph": "X",  # a "complete" event: start and duration
+            "ts": round((_CLOCK_OFFSET + start) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": attributes,
+        }
+        with self._lock:
+            self.events.append(event)
+
+
+class Span:
+    """
+    One timed step of a traced call. Use as a context manager, attributes can be added with set()
+    """
+
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.attributes["error"] = exc_type.__name__
+        self.trace.add(self.name, self.start, time.perf_counter(), self.attributes)
+        return False
+
+
+class _RootSpan(Span):
+    """
+    The span of a whole sampled call - makes its trace the current one of the thread while it runs,
+    profiles it if asked to and hands the finished trace to the tracer
+    """
+
+    def __init__(self, tracer, name, attributes):
+        super().__init__(Trace(name), name, attributes)
+        self.tracer = tracer
+        self.profiler = None
+
+    def __enter__(self):
+        self.tracer._local.trace = self.trace
+        if self.tracer.profile_slowest:
+            # only imported when profiling is switched on
+            import cProfile
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # another profiler is already running (only one at a time on newer Pythons)
+                self.profiler = None
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        if self.profiler:
+            self.profiler.disable()
+        self.tracer._local.trace = None
+        self.tracer._finish(self)
+        return False
+
+
+class Tracer:
+    """
+    Decides which calls are traced and collects their spans and profiles
+    """
+
+    def __init__(self, sample_rate=0.0, path=DEFAULT_TRACE_FILE, profile_slowest=0):
+        self.sample_rate = sample_rate
+        self.path = path
+        self.profile_slowest = profile_slowest
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._profiles = []  # min-heap of (duration, sequence number, info, profiler)
+        self._sequence = 0
+
+    def configure(self, sample_rate=None, path=None, profile_slowest=None):
+        """
+        Changes the tracing settings at runtime (arguments left as None are kept)
+
+        Arguments:
+                sample_rate (float): share of the calls to trace, from 0 (off) to 1 (every call)
+                path (string): the trace file
+                profile_slowest (int): number of slowest sampled calls to keep cProfile data for (0 for none)
+        """
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError(f"sample_rate must be between 0 and 1, not {sample_rate}")
+            self.sample_rate = sample_rate
+        if path is not None:
+            self.path = path
+        if profile_slowest is not None:
+            self.profile_slowest = int(profile_slowest)
+
+    def trace(self, name, **attributes):
+        """
+        Span for a whole call - sampled at sample_rate. Inside a call that is already traced it is an ordinary span
+        """
+        trace = getattr(self._local, "trace", None)
+        if trace is not None:
+            return Span(trace, name, attributes)
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return NULL_SPAN
+        return _RootSpan(self, name, attributes)
+
+    def span(self, name, **attributes):
+        """
+        Span for a step inside the current call - does nothing if the call isn't traced
+        """
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            return NULL_SPAN
+        return Span(trace, name, attributes)
+
+    def current(self):
+        """
+        Returns the trace of the call running in this thread (None if it isn't traced) - see joined()
+        """
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def joined(self, trace):
+        """
+        Context manager that records the spans of a worker thread into the trace of the call it works for
+
+        Arguments:
+                trace: the Trace from current() in the calling thread (None does nothing)
+        """
+        previous = getattr(self._local, "trace", None)
+        self._local.trace = trace if trace is not None else previous
+        try:
+            yield
+        finally:
+            self._local.trace = previous
+
+    def _finish(self, root):
+        duration = time.perf_counter() - root.start
+        self._write(root.trace.events)
+
+        if root.profiler and self.profile_slowest:
+            info = {"name": root.name, "duration": duration, "attributes": root.attributes}
+            with self._write_lock:
+                self._sequence += 1
+                entry = (duration, self._sequence, info, root.profiler)
+                if len(self._profiles) < self.profile_slowest:
+                    heapq.heappush(self._profiles, entry)
+                elif duration > self._profiles[0][0]:
+                    heapq.heapreplace(self._profiles, entry)
+
+    def _write(self, events):
+        # the JSON array format allows leaving out the closing ] - so events can simply be appended
+        lines = "".join(json.dumps(event, default=str) + ",\n" for event in events)
+        with self._write_lock:
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, "a") as f:
+                if new_file:
+                    f.write("[\n")
+                f.write(lines)
+
+    def slowest_calls(self):
+        """
+        Returns:
+                list: name, duration (seconds) and attributes of the slowest profiled calls, slowest first
+        """
+        with self._write_lock:
+            return [info for _, _, info, _ in sorted(self._profiles, key=lambda entry: entry[:2], reverse=True)]
+
+    def dump_profiles(self, directory="profiles"):
+        """
+        Writes the cProfile data of the slowest profiled calls to .prof files (slowest first)
+
+        Returns:
+                list: the files written
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self._write_lock:
+            profiles = sorted(self._profiles, key=lambda entry: entry[:2], reverse=True)
+        files = []
+        for rank, (duration, _, info, profiler) in enumerate(profiles, 1):
+            path = os.path.join(directory, f"{rank:02d}_{info['name']}_{duration * 1000:.0f}ms.prof")
+            profiler.dump_stats(path)
+            files.append(path)
+        return files
+
+
+def read_trace(path=DEFAULT_TRACE_FILE):
+    """
+    Reads a trace file written by the tracer back into a list of events
+    """
+    with open(path) as f:
+        text = f.read().strip().rstrip(",")
+    if not text:
+        return []
+    if not text.endswith("]"):
+        text += "]"
+    return json.loads(text)
+
+
+def traced(method):
+    """
+    Decorator that traces a (sampled share of the) calls of a SecureOperations method,
+    with the user, role and table as attributes
+    """
+    name = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not tracer.sample_rate and tracer.current() is None:
+            return method(self, *args, **kwargs)
+        table = args[0] if args else kwargs.get("table", kwargs.get("tables"))
+        with tracer.trace(name, user=self.username, role=self.role, table=table):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# the tracer used by SecureOperations, configured from the environment
+tracer = Tracer(
+    sample_rate=float(os.environ.get("BIKECORP_TRACE_SAMPLE", 0)),
+    path=os.environ.get("BIKECORP_TRACE_FILE", DEFAULT_TRACE_FILE),
+    profile_slowest=int(os.environ.get("BIKECORP_PROFILE_SLOWEST", 0)),
+)